@@ -0,0 +1,384 @@
+"""
+Seeded microbenchmarks of the hot paths of training and evaluation, run at the training env configs of
+multi_agent_training.py and the 80 agents Test_5 config of evaluate_agent.py.
+
+    python benchmarks/benchmark.py run -o benchmarks/baseline.json
+    python benchmarks/benchmark.py run -o benchmarks/results.json --baseline benchmarks/baseline.json
+    python benchmarks/benchmark.py compare benchmarks/baseline.json benchmarks/results.json
+
+Baselines are machine specific and aren't committed: generate one locally before the changes to compare.
+"""
+
+import json
+import os
+import platform
+import random
+import sys
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from timeit import default_timer
+
+import numpy as np
+import torch
+from flatland.core.env_observation_builder import DummyObservationBuilder
+from flatland.envs.observations import TreeObsForRailEnv
+from flatland.envs.predictions import ShortestPathPredictorForRailEnv
+
+base_dir = Path(__file__).resolve().parent.parent
+sys.path.append(str(base_dir))
+
+from reinforcement_learning import evaluate_agent, multi_agent_training
+from reinforcement_learning.dddqn_policy import DDDQNPolicy, ReplayBuffer
+from utils.deadlock_check import check_if_all_blocked
+from utils.observation_utils import normalize_observation, normalize_observations
+
+# Version of the results file written by run
+RESULTS_VERSION = 1
+
+# Number of timed laps of each benchmark, multiplied by --scale
+BENCHMARK_LAPS = {
+    "env_reset": 5,
+    "env_step": 200,
+    "env_step_reward_shaping": 200,
+    "tree_obs_get_many": 50,
+    "normalize_observation": 500,
+    "normalize_observations": 100,
+    "replay_buffer_add": 1000,
+    "replay_buffer_add_batch": 1000,
+    "replay_buffer_sample": 500,
+    "policy_act": 500,
+    "policy_act_batch": 500,
+    "policy_learn": 50,
+    "check_if_all_blocked": 500,
+}
+
+# Number of steps run with random actions before the benchmarks which need a running episode
+WARMUP_STEPS = 10
+
+# Training parameters of the benchmarked policy, the defaults of multi_agent_training.py
+POLICY_PARAMS = Namespace(
+    hidden_size=128, buffer_size=int(1e5), batch_size=128, update_every=8, learning_rate=0.5e-4, tau=1e-3, gamma=0.99,
+    buffer_min_size=0, use_gpu=False
+)
+
+
+def benchmark_configs():
+    """
+    :return: dict of the benchmarked configs, name -> (env params, observation params, function creating the env)
+    """
+    configs = {}
+    obs_params = Namespace(**multi_agent_training.OBSERVATION_PARAMS)
+    for index, params in enumerate(multi_agent_training.TRAINING_ENV_PARAMS):
+        env_params = Namespace(**params)
+        configs["Test_{}".format(index - 1)] = (env_params, obs_params, partial(multi_agent_training.create_env, env_params, obs_params))
+
+    env_params = Namespace(**evaluate_agent.TEST5_PARAMS)
+    configs["Test_5"] = (env_params, env_params, partial(evaluate_agent.create_env, env_params))
+    return configs
+
+
+def time_laps(function, n_laps, timed=False):
+    """
+    :param function: called once per lap, after a first untimed call
+    :param timed: the function times itself and returns the duration to record, eg to leave out some setup
+    :return: array with the duration of each lap
+    """
+    function()
+    laps = np.zeros(n_laps)
+    for lap in range(n_laps):
+        start = default_timer()
+        result = function()
+        laps[lap] = result if timed else default_timer() - start
+    return laps
+
+
+def lap_stats(rounds):
+    """
+    :param rounds: laps of each round of a benchmark
+    :return: dict of stats, the median is the one of the fastest round, which is the least affected by other loads
+             of the machine, the other stats are over all the laps
+    """
+    laps = np.concatenate(rounds)
+    round_medians = [float(np.median(round_laps)) for round_laps in rounds]
+    return {
+        "median": min(round_medians),
+        "round_medians": round_medians,
+        "mean": float(np.mean(laps)),
+        "std": float(np.std(laps)),
+        "p95": float(np.percentile(laps, 95)),
+        "min": float(np.min(laps)),
+        "laps": len(laps),
+    }
+
+
+def random_actions(rng, n_agents):
+    return dict(enumerate(rng.randint(5, size=n_agents).tolist()))
+
+
+def env_benchmarks(create_env, n_agents, seed, benchmarks):
+    """
+    Benchmarks reset and step without observations, the observation builder is replaced by a dummy one
+    """
+    env = create_env()
+    env.obs_builder = DummyObservationBuilder()
+    env.obs_builder.set_env(env)
+    rng = np.random.RandomState(seed)
+    reset_seeds = iter(range(seed, seed + 1000000))
+
+    def reset():
+        env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=next(reset_seeds))
+
+    def step(reward_shaping):
+        # Episodes are restarted without timing the reset
+        if env.dones["__all__"] or env._elapsed_steps >= env._max_episode_steps - 1:
+            reset()
+        start = default_timer()
+        env.step(random_actions(rng, n_agents), reward_shaping=reward_shaping)
+        return default_timer() - start
+
+    laps = {}
+    if "env_reset" in benchmarks:
+        laps["env_reset"] = time_laps(reset, benchmarks["env_reset"])
+    for name, reward_shaping in (("env_step", False), ("env_step_reward_shaping", True)):
+        if name in benchmarks:
+            reset_seeds = iter(range(seed, seed + 1000000))
+            rng = np.random.RandomState(seed)
+            reset()
+            laps[name] = time_laps(partial(step, reward_shaping), benchmarks[name], timed=True)
+    return laps
+
+
+def observation_benchmarks(create_env, obs_params, seed, benchmarks):
+    """
+    Benchmarks the observations and the deadlock check on an episode run for WARMUP_STEPS random steps
+    :return: laps of the benchmarks, and the normalized observations of the agents
+    """
+    env = create_env()
+    tree_observation = TreeObsForRailEnv(
+        max_depth=obs_params.observation_tree_depth,
+        predictor=ShortestPathPredictorForRailEnv(obs_params.observation_max_path_depth)
+    )
+    env.obs_builder = tree_observation
+    tree_observation.set_env(env)
+
+    rng = np.random.RandomState(seed)
+    env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=seed)
+    for _ in range(WARMUP_STEPS):
+        env.step(random_actions(rng, env.get_num_agents()))
+
+    handles = env.get_agent_handles()
+    observations = tree_observation.get_many(handles)
+    observed = [handle for handle in handles if observations[handle]]
+    tree_depth = obs_params.observation_tree_depth
+    radius = obs_params.observation_radius
+    agent_obs = np.zeros((env.get_num_agents(), tree_observation.observation_dim * sum(4 ** i for i in range(tree_depth + 1))))
+    normalize_observations(observations, observed, tree_depth, observation_radius=radius, out=agent_obs)
+    agents = iter(np.resize(observed, 2 * benchmarks.get("normalize_observation", 1)))
+
+    laps = {}
+    if "tree_obs_get_many" in benchmarks:
+        laps["tree_obs_get_many"] = time_laps(partial(tree_observation.get_many, handles), benchmarks["tree_obs_get_many"])
+    if "normalize_observation" in benchmarks and observed:
+        laps["normalize_observation"] = time_laps(
+            lambda: normalize_observation(observations[next(agents)], tree_depth, observation_radius=radius),
+            benchmarks["normalize_observation"]
+        )
+    if "normalize_observations" in benchmarks:
+        laps["normalize_observations"] = time_laps(
+            partial(normalize_observations, observations, observed, tree_depth, observation_radius=radius, out=agent_obs),
+            benchmarks["normalize_observations"]
+        )
+    if "check_if_all_blocked" in benchmarks:
+        laps["check_if_all_blocked"] = time_laps(partial(check_if_all_blocked, env), benchmarks["check_if_all_blocked"])
+    return laps, agent_obs.astype(np.float32)
+
+
+def learning_benchmarks(agent_obs, seed, benchmarks):
+    """
+    Benchmarks the replay buffer and the policy, with random experiences and the observations of the agents
+    """
+    n_agents, state_size = agent_obs.shape
+    rng = np.random.RandomState(seed)
+    n_experiences = 20000
+
+    def experiences(n):
+        return (rng.rand(n, state_size).astype(np.float32), rng.randint(5, size=n), rng.normal(size=n),
+                rng.rand(n, state_size).astype(np.float32), rng.rand(n) < 0.01)
+
+    memory = ReplayBuffer(5, POLICY_PARAMS.buffer_size, POLICY_PARAMS.batch_size, torch.device("cpu"), state_size)
+    memory.add_batch(*experiences(n_experiences))
+    states, actions, rewards, next_states, dones = experiences(n_agents)
+
+    policy = DDDQNPolicy(state_size, 5, POLICY_PARAMS)
+    policy.memory.add_batch(*experiences(n_experiences))
+
+    laps = {}
+    if "replay_buffer_add" in benchmarks:
+        laps["replay_buffer_add"] = time_laps(
+            partial(memory.add, states[0], actions[0], rewards[0], next_states[0], dones[0]), benchmarks["replay_buffer_add"]
+        )
+    if "replay_buffer_add_batch" in benchmarks:
+        laps["replay_buffer_add_batch"] = time_laps(
+            partial(memory.add_batch, states, actions, rewards, next_states, dones), benchmarks["replay_buffer_add_batch"]
+        )
+    if "replay_buffer_sample" in benchmarks:
+        laps["replay_buffer_sample"] = time_laps(memory.sample, benchmarks["replay_buffer_sample"])
+    if "policy_act" in benchmarks:
+        laps["policy_act"] = time_laps(partial(policy.act, agent_obs[0]), benchmarks["policy_act"])
+    if "policy_act_batch" in benchmarks:
+        laps["policy_act_batch"] = time_laps(partial(policy.act_batch, agent_obs), benchmarks["policy_act_batch"])
+    if "policy_learn" in benchmarks:
+        laps["policy_learn"] = time_laps(policy._learn, benchmarks["policy_learn"])
+    return laps
+
+
+def run_benchmarks(config_names, benchmark_names, seed=1, scale=1.0, n_rounds=3):
+    """
+    :param config_names: configs to run, see benchmark_configs
+    :param benchmark_names: benchmarks to run, see BENCHMARK_LAPS
+    :param scale: multiplies the number of laps of each benchmark
+    :param n_rounds: number of rounds over all the configs, each round running every benchmark with the same seed
+    :return: dict of the stats of each benchmark, keyed by "<config>/<benchmark>"
+    """
+    configs = benchmark_configs()
+    benchmarks = {name: max(1, int(round(BENCHMARK_LAPS[name] * scale))) for name in benchmark_names}
+
+    # Rounds are interleaved, so a slower period of the machine only slows down some of the rounds of a benchmark
+    rounds = {}
+    for _ in range(n_rounds):
+        for config_name in config_names:
+            env_params, obs_params, create_env = configs[config_name]
+            random.seed(seed)
+            np.random.seed(seed)
+            torch.manual_seed(seed)
+
+            laps = env_benchmarks(create_env, env_params.n_agents, seed, benchmarks)
+            observation_laps, agent_obs = observation_benchmarks(create_env, obs_params, seed, benchmarks)
+            laps.update(observation_laps)
+            laps.update(learning_benchmarks(agent_obs, seed, benchmarks))
+            for name, benchmark_laps in laps.items():
+                rounds.setdefault("{}/{}".format(config_name, name), []).append(benchmark_laps)
+
+    results = {}
+    for config_name in config_names:
+        for name in benchmark_names:
+            key = "{}/{}".format(config_name, name)
+            if key in rounds:
+                results[key] = stats = lap_stats(rounds[key])
+                print("{:<40} median {:10.1f} us \tp95 {:10.1f} us \t{} laps".format(
+                    key, 1e6 * stats["median"], 1e6 * stats["p95"], stats["laps"]))
+    return results
+
+
+def machine_info():
+    """
+    :return: dict describing the machine and the versions the benchmarks ran with
+    """
+    import flatland
+
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "flatland": getattr(flatland, "__version__", None),
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def compare(baseline, results, threshold=0.2):
+    """
+    Prints the median of each benchmark against the baseline
+    :param baseline: results file content of the baseline
+    :param results: results file content to check
+    :param threshold: relative slowdown of the median above which a benchmark is a regression
+    :return: names of the regressed benchmarks
+    """
+    if baseline["machine"] != results["machine"]:
+        print("⚠️  The baseline was measured on another machine or with other versions, the timings may not be comparable:")
+        for key in sorted(set(baseline["machine"]) | set(results["machine"])):
+            if baseline["machine"].get(key) != results["machine"].get(key):
+                print("    {}: {} -> {}".format(key, baseline["machine"].get(key), results["machine"].get(key)))
+
+    regressions = []
+    # Benchmarks of the baseline left out of the results, eg by --configs, are only counted
+    not_run = len(set(baseline["results"]) - set(results["results"]))
+    for name in sorted(results["results"]):
+        if name not in baseline["results"]:
+            print("{:<40} not in the baseline".format(name))
+            continue
+
+        before = baseline["results"][name]["median"]
+        after = results["results"][name]["median"]
+        ratio = after / before if before > 0 else float("inf")
+        if ratio > 1 + threshold:
+            status = "🛑 REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            status = "⚡ faster"
+        else:
+            status = ""
+        print("{:<40} {:10.1f} us -> {:10.1f} us \t{:6.2f}x \t{}".format(name, 1e6 * before, 1e6 * after, ratio, status))
+
+    print("\n{} regressions over {:.0f}% in {} benchmarks".format(len(regressions), 100 * threshold, len(results["results"])))
+    if not_run:
+        print("{} benchmarks of the baseline weren't run".format(not_run))
+    return regressions
+
+
+def load_results(filename):
+    with open(filename) as f:
+        results = json.load(f)
+    if results.get("version") != RESULTS_VERSION:
+        raise ValueError("{} isn't a results file of version {}".format(filename, RESULTS_VERSION))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Microbenchmarks of the hot paths of training and evaluation")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="runs the benchmarks and saves their results")
+    run_parser.add_argument("-o", "--output", help="JSON file the results are saved to", default=str(Path(__file__).resolve().parent / "results.json"), type=str)
+    run_parser.add_argument("--configs", help="env configs to run, {}".format(", ".join(benchmark_configs())), nargs="+", default=list(benchmark_configs()), choices=list(benchmark_configs()), metavar="CONFIG")
+    run_parser.add_argument("--benchmarks", help="benchmarks to run, see BENCHMARK_LAPS in benchmark.py", nargs="+", default=list(BENCHMARK_LAPS), choices=list(BENCHMARK_LAPS), metavar="BENCHMARK")
+    run_parser.add_argument("--scale", help="multiplies the number of laps of each benchmark", default=1.0, type=float)
+    run_parser.add_argument("--rounds", help="number of rounds, the median of the fastest one is compared", default=3, type=int)
+    run_parser.add_argument("--seed", help="seed of the envs, actions and experiences", default=1, type=int)
+    run_parser.add_argument("--num_threads", help="number of threads PyTorch can use, like on the evaluation server", default=1, type=int)
+    run_parser.add_argument("--baseline", help="results file to compare the results with", default=None, type=str)
+    run_parser.add_argument("--threshold", help="relative slowdown of the median above which a benchmark is a regression", default=0.2, type=float)
+
+    compare_parser = subparsers.add_parser("compare", help="compares results with a baseline, exits with an error on regressions")
+    compare_parser.add_argument("baseline", help="results file of the baseline", type=str)
+    compare_parser.add_argument("results", help="results file to check", type=str)
+    compare_parser.add_argument("--threshold", help="relative slowdown of the median above which a benchmark is a regression", default=0.2, type=float)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        torch.set_num_threads(args.num_threads)
+        results = {
+            "version": RESULTS_VERSION,
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "machine": machine_info(),
+            "seed": args.seed,
+            "scale": args.scale,
+            "rounds": args.rounds,
+            "results": run_benchmarks(args.configs, args.benchmarks, args.seed, args.scale, args.rounds),
+        }
+        output_directory = os.path.dirname(args.output)
+        if output_directory:
+            os.makedirs(output_directory, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to {}".format(args.output))
+
+        if args.baseline:
+            print()
+            sys.exit(1 if compare(load_results(args.baseline), results, args.threshold) else 0)
+    else:
+        sys.exit(1 if compare(load_results(args.baseline), load_results(args.results), args.threshold) else 0)
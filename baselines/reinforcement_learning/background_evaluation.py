@@ -0,0 +1,132 @@
+import multiprocessing
+
+import numpy as np
+import torch
+
+from utils.observation_utils import normalize_observations
+
+
+def evaluate_episode(env, policy, tree_depth, observation_radius=0, random_seed=None):
+    """
+    Runs one greedy episode without reward shaping
+    :param random_seed: seed of the generated episode, the env keeps drawing from its own random state if None
+    :return: normalized score, completion and number of steps of the episode
+    """
+    obs, info = env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=random_seed)
+    max_steps = env._max_episode_steps
+
+    agent_obs = np.zeros((env.get_num_agents(), policy.state_size))
+    action_required = np.zeros(env.get_num_agents(), dtype=bool)
+    score = 0.0
+    final_step = 0
+
+    for step in range(max_steps - 1):
+        observed = [agent for agent in env.get_agent_handles() if obs[agent]]
+        normalize_observations(obs, observed, tree_depth, observation_radius=observation_radius, out=agent_obs)
+        for agent in env.get_agent_handles():
+            action_required[agent] = info['action_required'][agent]
+
+        actions = policy.act_batch(agent_obs, eps=0.0, mask=action_required)
+        obs, _, done, info = env.step(dict(enumerate(actions.tolist())), reward_shaping=False)
+
+        score += np.sum(env.step_rewards)
+
+        final_step = step
+
+        if done['__all__']:
+            break
+
+    normalized_score = score / (max_steps * env.get_num_agents())
+
+    tasks_finished = sum(done[idx] for idx in env.get_agent_handles())
+    completion = tasks_finished / max(1, env.get_num_agents())
+
+    return normalized_score, completion, final_step
+
+
+class BackgroundEvaluator:
+    """
+    Evaluates snapshots of a network in a pool of worker processes, so training can go on meanwhile.
+
+    Each worker creates its env and policy once. The weights of a snapshot are copied once into a slot of shared
+    memory, and the episodes of its evaluation only carry the slot, the evaluation id and their seed: a worker
+    copies the weights into its network on its first episode of each evaluation. A slot is reused once its
+    evaluation is finished, submitting waits for the oldest evaluation when all the slots are in use.
+    Evaluations are collected in the order they were submitted.
+    """
+
+    def __init__(self, env_fn, policy_fn, seeds, tree_depth, observation_radius=0, processes=2, max_pending=4):
+        """
+        :param env_fn: picklable function returning the evaluation env of a worker
+        :param policy_fn: picklable function returning the CPU policy of a worker
+        :param seeds: seeds the episodes of each evaluation are generated with, so all the snapshots are evaluated
+                      on the same episodes
+        :param max_pending: number of weight slots, and thus of evaluations run or queued at once
+        """
+        self.seeds = list(seeds)
+        n_params = sum(param.numel() for param in policy_fn().qnetwork_local.parameters())
+        self._slots = [multiprocessing.RawArray('f', n_params) for _ in range(max_pending)]
+        self._pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(env_fn, policy_fn, tree_depth, observation_radius, self._slots))
+        self._pending = []
+        self._n_evaluations = 0
+
+    def submit(self, episode_idx, model):
+        """
+        Starts evaluating a snapshot of the model weights
+        :param episode_idx: training episode the evaluation is reported for
+        """
+        slot = self._free_slot()
+        weights = torch.nn.utils.parameters_to_vector(model.parameters()).detach().cpu().numpy()
+        np.frombuffer(self._slots[slot], dtype=np.float32)[:] = weights
+
+        evaluation_id = self._n_evaluations
+        self._n_evaluations += 1
+        result = self._pool.starmap_async(_evaluate_episode, [(slot, evaluation_id, seed) for seed in self.seeds])
+        self._pending.append((episode_idx, slot, result))
+
+    def _free_slot(self):
+        """
+        :return: index of a slot whose evaluation is finished, after waiting for the oldest running one if needed
+        """
+        while True:
+            busy = {slot for _, slot, result in self._pending if not result.ready()}
+            free = [slot for slot in range(len(self._slots)) if slot not in busy]
+            if free:
+                return free[0]
+            next(result for _, _, result in self._pending if not result.ready()).wait()
+
+    def collect(self, wait=False):
+        """
+        :param wait: wait for all the pending evaluations
+        :return: list of (episode_idx, scores, completions, nb_steps) for the finished evaluations
+        """
+        finished = []
+        while self._pending and (wait or self._pending[0][2].ready()):
+            episode_idx, _, result = self._pending.pop(0)
+            scores, completions, nb_steps = map(list, zip(*result.get()))
+            finished.append((episode_idx, scores, completions, nb_steps))
+        return finished
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+# State of an evaluation worker process
+_worker = {}
+
+
+def _init_worker(env_fn, policy_fn, tree_depth, observation_radius, weight_slots):
+    torch.set_num_threads(1)
+    _worker.update(env=env_fn(), policy=policy_fn(), tree_depth=tree_depth, observation_radius=observation_radius,
+                   weight_slots=weight_slots, evaluation_id=None)
+
+
+def _evaluate_episode(slot, evaluation_id, seed):
+    policy = _worker["policy"]
+    if _worker["evaluation_id"] != evaluation_id:
+        # The slot isn't reused before all the episodes of its evaluation are finished
+        weights = torch.from_numpy(np.frombuffer(_worker["weight_slots"][slot], dtype=np.float32).copy())
+        torch.nn.utils.vector_to_parameters(weights, policy.qnetwork_local.parameters())
+        _worker["evaluation_id"] = evaluation_id
+    return evaluate_episode(_worker["env"], policy, _worker["tree_depth"], _worker["observation_radius"], random_seed=seed)
@@ -0,0 +1,39 @@
+import sys
+from argparse import ArgumentParser, Namespace
+from functools import partial
+from pathlib import Path
+
+base_dir = Path(__file__).resolve().parent.parent
+sys.path.append(str(base_dir))
+
+from reinforcement_learning.multi_agent_training import OBSERVATION_PARAMS, TRAINING_ENV_PARAMS, create_env
+from utils.agent_arrays import compare_step_engines
+
+
+def check_vectorized_step(training_env_configs, seeds):
+    """
+    Runs the same random episodes with RailEnv.step and with --vectorized_step, with and without reward shaping
+    :return: number of episodes which differ
+    """
+    obs_params = Namespace(**OBSERVATION_PARAMS)
+    n_differences = 0
+    for config in training_env_configs:
+        env_params = Namespace(**TRAINING_ENV_PARAMS[config])
+        for seed in seeds:
+            for reward_shaping in (False, True):
+                difference = compare_step_engines(partial(create_env, env_params, obs_params), seed, reward_shaping)
+                status = "✅ same" if difference is None else "🛑 " + difference
+                print("Test_{} seed {} reward shaping {}: {}".format(config - 1, seed, reward_shaping, status))
+                n_differences += difference is not None
+    return n_differences
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Checks that --vectorized_step runs the same episodes as RailEnv.step")
+    parser.add_argument("-t", "--training_env_configs", help="training env configs to check", nargs="+", default=list(range(len(TRAINING_ENV_PARAMS))), type=int)
+    parser.add_argument("-n", "--n_seeds", help="number of seeds checked per config", default=3, type=int)
+    args = parser.parse_args()
+
+    n_differences = check_vectorized_step(args.training_env_configs, range(1, args.n_seeds + 1))
+    print("{} episodes differ".format(n_differences))
+    sys.exit(1 if n_differences else 0)
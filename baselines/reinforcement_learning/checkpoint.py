@@ -0,0 +1,275 @@
+import os
+import pickle
+import queue
+import random
+import re
+import sys
+import threading
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import torch
+
+base_dir = Path(__file__).resolve().parent.parent
+sys.path.append(str(base_dir))
+
+from reinforcement_learning.model import DuelingQNetwork, FusedDuelingQNetwork
+
+# Version of the checkpoint dict written by save_checkpoint
+CHECKPOINT_VERSION = 1
+
+# Parameters a checkpoint is saved with, which are needed to rebuild the network and its observations
+METADATA_KEYS = (
+    "state_size",
+    "action_size",
+    "hidden_size",
+    "observation_tree_depth",
+    "observation_radius",
+    "observation_max_path_depth",
+)
+
+
+def save_checkpoint(network, filename, **metadata):
+    """
+    Saves the weights of a DuelingQNetwork along with the parameters it was trained with. Only tensors and plain
+    values are pickled, so the checkpoint loads without unpickling any class of this repository.
+    :param network: DuelingQNetwork or FusedDuelingQNetwork to save
+    :param metadata: values for METADATA_KEYS, state_size, action_size and hidden_size default to the network ones
+    """
+    _atomic_save({
+        "version": CHECKPOINT_VERSION,
+        "metadata": network_metadata(network, **metadata),
+        "state_dict": _snapshot(network.state_dict()),
+    }, filename)
+
+
+def network_metadata(network, **metadata):
+    """
+    :return: dict with a value for each of METADATA_KEYS, the sizes default to the ones of the network
+    """
+    state_dict = network.state_dict()
+    metadata = dict(
+        state_size=state_dict["fc1_val.weight"].shape[1],
+        action_size=state_dict["fc4_adv.weight"].shape[0],
+        hidden_size=state_dict["fc1_val.weight"].shape[0],
+        **metadata
+    )
+    return _snapshot({key: metadata.get(key) for key in METADATA_KEYS})
+
+
+def _snapshot(value):
+    """
+    :return: copy of a state dict on the CPU, which isn't affected by later updates of the original tensors.
+             NumPy scalars become Python scalars, which the weights only unpickler accepts.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {key: _snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_snapshot(item) for item in value)
+    return value
+
+
+def _atomic_save(checkpoint, filename):
+    """
+    Writes to a temporary file renamed once complete and synced, so filename is either the previous or the new
+    checkpoint
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename + ".tmp", "wb") as f:
+        torch.save(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + ".tmp", filename)
+
+
+def load_checkpoint(filename):
+    """
+    Loads a checkpoint saved by save_checkpoint, or an older checkpoint holding a whole pickled DuelingQNetwork,
+    whose metadata is then limited to the sizes of the network.
+    :return: state dict of the network and dict of metadata
+    """
+    try:
+        checkpoint = torch.load(filename, map_location="cpu")
+    except pickle.UnpicklingError:
+        # Older checkpoints pickled the whole module, which recent torch versions refuse to load by default
+        checkpoint = torch.load(filename, map_location="cpu", weights_only=False)
+
+    if isinstance(checkpoint, dict) and "state_dict" in checkpoint:
+        return checkpoint["state_dict"], checkpoint["metadata"]
+
+    state_dict = checkpoint.state_dict() if hasattr(checkpoint, "state_dict") else checkpoint
+    metadata = dict.fromkeys(METADATA_KEYS)
+    metadata.update(
+        state_size=state_dict["fc1_val.weight"].shape[1],
+        action_size=state_dict["fc4_adv.weight"].shape[0],
+        hidden_size=state_dict["fc1_val.weight"].shape[0]
+    )
+    return state_dict, metadata
+
+
+def load_network(filename, device=torch.device("cpu"), fused=False):
+    """
+    :param fused: rebuild a FusedDuelingQNetwork instead of a DuelingQNetwork
+    :return: network rebuilt from a checkpoint, and the metadata of the checkpoint
+    """
+    state_dict, metadata = load_checkpoint(filename)
+    network = (FusedDuelingQNetwork if fused else DuelingQNetwork)(
+        metadata["state_size"], metadata["action_size"],
+        hidsize1=metadata["hidden_size"], hidsize2=metadata["hidden_size"]
+    )
+    network.load_state_dict(state_dict)
+    return network.to(device), metadata
+
+
+class CheckpointManager:
+    """
+    Writes the checkpoints of a training from a background thread, so the training loop only waits for an in
+    memory copy of the training state.
+
+    A checkpoint has the state dict and metadata of save_checkpoint, so it is evaluated like any other checkpoint,
+    plus everything needed to resume the training: the target network, the optimizer state, the random states of
+    this process and the training state given by the caller (epsilon, step counters...). Files are renamed once
+    written, and only the keep most recent checkpoints of the training are kept.
+    """
+
+    def __init__(self, directory, training_id, keep=5, **metadata):
+        """
+        :param training_id: id the checkpoint files are named after
+        :param keep: number of checkpoints kept, 0 to keep them all
+        :param metadata: observation parameters saved with the checkpoints, see save_checkpoint
+        """
+        self.directory = directory
+        self.training_id = training_id
+        self.keep = keep
+        self.metadata = metadata
+
+        # A single pending checkpoint: saving waits for the previous checkpoint if it isn't written yet
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_checkpoints, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def path(self, episode_idx):
+        return os.path.join(self.directory, "multi-{}-{}.pth".format(self.training_id, episode_idx))
+
+    def checkpoints(self):
+        """
+        :return: paths of the checkpoints of the training, oldest first
+        """
+        pattern = re.compile(re.escape("multi-{}-".format(self.training_id)) + r"(\d+)\.pth$")
+        names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        matches = [match for match in map(pattern.match, names) if match is not None]
+        return [os.path.join(self.directory, match.string) for match in sorted(matches, key=lambda match: int(match.group(1)))]
+
+    def save(self, episode_idx, policy, **training_state):
+        """
+        Copies the state of the policy and queues it to be written in the background
+        :param policy: DDDQNPolicy being trained
+        :param training_state: plain values restored when resuming, eg epsilon and smoothed scores
+        """
+        self._raise_error()
+
+        numpy_random_state = np.random.get_state()
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "metadata": network_metadata(policy.qnetwork_local, **self.metadata),
+            "state_dict": _snapshot(policy.qnetwork_local.state_dict()),
+            "target_state_dict": _snapshot(policy.qnetwork_target.state_dict()),
+            "optimizer_state_dict": _snapshot(policy.optimizer.state_dict()),
+            "training_state": _snapshot(dict(training_state, episode_idx=episode_idx, t_step=policy.t_step,
+                                             policy_updates=policy.n_updates,
+                                             priority_beta=getattr(policy.memory, "beta", None))),
+            # The NumPy state array is saved as a list, as the weights only unpickler refuses NumPy arrays
+            "random_states": {
+                "python": random.getstate(),
+                "numpy": (numpy_random_state[0], numpy_random_state[1].tolist()) + tuple(numpy_random_state[2:]),
+                "torch": torch.get_rng_state(),
+            },
+        }
+        self._queue.put((self.path(episode_idx), checkpoint))
+
+    def restore(self, policy):
+        """
+        Restores the policy and the random states from the newest checkpoint of the training
+        :return: training state saved with the checkpoint, None if the training has no checkpoint
+        """
+        checkpoints = self.checkpoints()
+        if not checkpoints:
+            return None
+
+        # Loaded on the CPU: torch.set_rng_state only takes a CPU tensor, and the networks and optimizer copy their
+        # states onto the device of their parameters
+        checkpoint = torch.load(checkpoints[-1], map_location="cpu")
+        if "training_state" not in checkpoint:
+            raise ValueError("{} can't be resumed from, it only holds the network weights".format(checkpoints[-1]))
+
+        policy.qnetwork_local.load_state_dict(checkpoint["state_dict"])
+        policy.qnetwork_target.load_state_dict(checkpoint["target_state_dict"])
+        policy.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+
+        training_state = checkpoint["training_state"]
+        policy.t_step = training_state["t_step"]
+        policy.n_updates = training_state.get("policy_updates", 0)
+        if training_state["priority_beta"] is not None and hasattr(policy.memory, "beta"):
+            policy.memory.beta = training_state["priority_beta"]
+
+        random_states = checkpoint["random_states"]
+        random.setstate(random_states["python"])
+        name, keys, *numpy_random_state = random_states["numpy"]
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), *numpy_random_state))
+        torch.set_rng_state(random_states["torch"])
+
+        return training_state
+
+    def close(self):
+        """
+        Waits for the pending checkpoint to be written
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self._error
+
+    def _write_checkpoints(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            filename, checkpoint = item
+            try:
+                _atomic_save(checkpoint, filename)
+                if self.keep > 0:
+                    for old_checkpoint in self.checkpoints()[:-self.keep]:
+                        os.remove(old_checkpoint)
+            except Exception as e:
+                self._error = e
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Converts a checkpoint to the state dict format, eg an older pickled DuelingQNetwork")
+    parser.add_argument("-f", "--file", help="checkpoint to convert", required=True, type=str)
+    parser.add_argument("-o", "--output", help="converted checkpoint, defaults to overwriting the input one", default=None, type=str)
+    parser.add_argument("--observation_tree_depth", help="tree depth the checkpoint was trained with", default=None, type=int)
+    parser.add_argument("--observation_radius", help="observation radius the checkpoint was trained with", default=None, type=int)
+    parser.add_argument("--observation_max_path_depth", help="max path depth the checkpoint was trained with", default=None, type=int)
+    args = parser.parse_args()
+
+    network, metadata = load_network(args.file)
+    for key in ("observation_tree_depth", "observation_radius", "observation_max_path_depth"):
+        if getattr(args, key) is not None:
+            metadata[key] = getattr(args, key)
+
+    output = args.output if args.output is not None else args.file
+    save_checkpoint(network, output, **{key: value for key, value in metadata.items() if key not in ("state_size", "action_size", "hidden_size")})
+    print("Checkpoint saved to {} with metadata {}".format(output, metadata))
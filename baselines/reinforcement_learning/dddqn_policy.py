@@ -1,16 +1,20 @@
 import copy
+import json
 import os
 import pickle
 import random
-from collections import namedtuple, deque, Iterable
+import threading
+from collections import namedtuple
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
 
-from reinforcement_learning.model import DuelingQNetwork
-from reinforcement_learning.policy import Policy
+from reinforcement_learning.minibatch_prefetcher import MinibatchPrefetcher
+from reinforcement_learning.model import DuelingQNetwork, FusedDuelingQNetwork, quantize_dynamic_int8
+from reinforcement_learning.policy import Policy, epsilon_greedy_split
+from utils.timer import Timer
 
 
 class DDDQNPolicy(Policy):
@@ -29,10 +33,18 @@ class DDDQNPolicy(Policy):
             self.buffer_size = parameters.buffer_size
             self.batch_size = parameters.batch_size
             self.update_every = parameters.update_every
+            # Gradient steps of each update, on minibatches sampled ahead by a background thread if prefetch_batches > 0
+            self.gradient_steps = getattr(parameters, "gradient_steps", 1)
+            self.prefetch_batches = getattr(parameters, "prefetch_batches", 0)
             self.learning_rate = parameters.learning_rate
             self.tau = parameters.tau
+            # Copy the local network into the target network every hard_update_interval updates instead of soft updates
+            self.hard_update_interval = getattr(parameters, "hard_update_interval", 0)
             self.gamma = parameters.gamma
             self.buffer_min_size = parameters.buffer_min_size
+            self.prioritized_replay = getattr(parameters, "prioritized_replay", False)
+            # Forward passes of the updates in CPU bfloat16 autocast, the loss and the weights stay in float32
+            self.bf16_learn = getattr(parameters, "bf16_learn", False)
 
         # Device
         if parameters.use_gpu and torch.cuda.is_available():
@@ -42,15 +54,32 @@ class DDDQNPolicy(Policy):
             self.device = torch.device("cpu")
             # print("🐢 Using CPU")
 
-        # Q-Network
-        self.qnetwork_local = DuelingQNetwork(state_size, action_size, hidsize1=self.hidsize, hidsize2=self.hidsize).to(self.device)
+        if not evaluation_mode and self.bf16_learn and self.device.type != "cpu":
+            raise ValueError("bf16_learn is only supported on CPU, train with use_gpu disabled to use it")
+
+        # Q-Network, the fused network computes the same Q-values with fewer ops
+        network_class = FusedDuelingQNetwork if getattr(parameters, "fused_network", False) else DuelingQNetwork
+        self.qnetwork_local = network_class(state_size, action_size, hidsize1=self.hidsize, hidsize2=self.hidsize).to(self.device)
 
         if not evaluation_mode:
             self.qnetwork_target = copy.deepcopy(self.qnetwork_local)
+            # The target network is updated with a single op on the parameters of both networks
+            self._local_parameters = flatten_parameters(self.qnetwork_local)
+            self._target_parameters = flatten_parameters(self.qnetwork_target)
             self.optimizer = optim.Adam(self.qnetwork_local.parameters(), lr=self.learning_rate)
-            self.memory = ReplayBuffer(action_size, self.buffer_size, self.batch_size, self.device)
+            if self.prioritized_replay:
+                self.memory = PrioritizedReplayBuffer(action_size, self.buffer_size, self.batch_size, self.device, state_size,
+                                                      alpha=parameters.priority_alpha, beta=parameters.priority_beta,
+                                                      beta_increment=parameters.priority_beta_increment)
+            else:
+                self.memory = ReplayBuffer(action_size, self.buffer_size, self.batch_size, self.device, state_size)
+            self.prefetcher = MinibatchPrefetcher(self.memory, self.device, self.prefetch_batches) if self.prefetch_batches > 0 else None
+
+            # Time spent getting the minibatches, waiting for them with a prefetcher, and computing the updates
+            self.learn_timers = {"sample": Timer(), "update": Timer()}
 
             self.t_step = 0
+            self.n_updates = 0
             self.loss = 0.0
 
     def act(self, state, eps=0.):
@@ -68,39 +97,118 @@ class DDDQNPolicy(Policy):
         else:
             return random.choice(np.arange(self.action_size))
 
+    def act_batch(self, states, eps=0., mask=None):
+        """
+        Selects an action for every agent with a single forward pass.
+        :param states: array of shape (n_agents, state_size)
+        :param eps: probability of picking a random action
+        :param mask: optional boolean array of shape (n_agents,), agents with a False entry get DO_NOTHING (0)
+        :return: array of shape (n_agents,) with one action per agent
+        """
+        actions = np.zeros(len(states), dtype=np.int64)
+        greedy, explore = epsilon_greedy_split(len(states), eps, mask)
+
+        if len(greedy) > 0:
+            state = torch.from_numpy(np.asarray(states[greedy], dtype=np.float32)).to(self.device)
+            # The network has no dropout/batch norm layers, so there is no need to toggle eval()/train()
+            with torch.no_grad():
+                action_values = self.qnetwork_local(state)
+            actions[greedy] = action_values.argmax(1).cpu().numpy()
+
+        actions[explore] = np.random.randint(self.action_size, size=len(explore))
+        return actions
+
+    def quantize(self):
+        """
+        Replaces the local network by its int8 dynamic quantized version, which only runs on CPU, for evaluation
+        """
+        assert self.evaluation_mode, "Only a policy initialized for evaluation can be quantized."
+        self.device = torch.device("cpu")
+        self.qnetwork_local = quantize_dynamic_int8(self.qnetwork_local)
+
     def step(self, state, action, reward, next_state, done):
         assert not self.evaluation_mode, "Policy has been initialized for evaluation only."
 
         # Save experience in replay memory
-        self.memory.add(state, action, reward, next_state, done)
+        with self.memory.lock:
+            self.memory.add(state, action, reward, next_state, done)
 
         # Learn every UPDATE_EVERY time steps.
         self.t_step = (self.t_step + 1) % self.update_every
         if self.t_step == 0:
-            # If enough samples are available in memory, get random subset and learn
-            if len(self.memory) > self.buffer_min_size and len(self.memory) > self.batch_size:
-                self._learn()
+            self.learn()
 
-    def _learn(self):
-        experiences = self.memory.sample()
-        states, actions, rewards, next_states, dones = experiences
+    def step_batch(self, states, actions, rewards, next_states, dones):
+        """
+        Same as calling step() once per experience, but all the experiences go into the replay memory at once.
+        """
+        assert not self.evaluation_mode, "Policy has been initialized for evaluation only."
 
-        # Get expected Q values from local model
-        q_expected = self.qnetwork_local(states).gather(1, actions)
+        # Save experiences in replay memory
+        self.add_experiences(states, actions, rewards, next_states, dones)
 
-        if self.double_dqn:
-            # Double DQN
-            q_best_action = self.qnetwork_local(next_states).max(1)[1]
-            q_targets_next = self.qnetwork_target(next_states).gather(1, q_best_action.unsqueeze(-1))
+        # Learn every UPDATE_EVERY time steps, counting each experience as a time step.
+        n_updates, self.t_step = divmod(self.t_step + len(states), self.update_every)
+        for _ in range(n_updates):
+            self.learn()
+
+    def add_experiences(self, states, actions, rewards, next_states, dones):
+        """
+        Adds experiences to the replay memory without learning from them
+        """
+        with self.memory.lock:
+            self.memory.add_batch(states, actions, rewards, next_states, dones)
+
+    def learn(self):
+        """
+        Runs gradient_steps updates on random minibatches if enough samples are available in memory
+        :return: True if the networks were updated
+        """
+        assert not self.evaluation_mode, "Policy has been initialized for evaluation only."
+
+        if len(self.memory) > self.buffer_min_size and len(self.memory) > self.batch_size:
+            for _ in range(self.gradient_steps):
+                self.learn_timers["sample"].start()
+                experiences = self._sample()
+                self.learn_timers["sample"].end()
+
+                self.learn_timers["update"].start()
+                self._learn(experiences)
+                self.learn_timers["update"].end()
+            return True
+        return False
+
+    def _sample(self):
+        if self.prefetcher is not None:
+            return self.prefetcher.get()
+        with self.memory.lock:
+            return self.memory.sample()
+
+    def _learn(self, experiences=None):
+        if experiences is None:
+            experiences = self._sample()
+        states, actions, rewards, next_states, dones = experiences[:5]
+
+        if self.bf16_learn:
+            # torch.autocast only exists since PyTorch 1.10, the float32 updates don't use it
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                q_expected, q_targets_next = self._q_values(states, actions, next_states)
         else:
-            # DQN
-            q_targets_next = self.qnetwork_target(next_states).detach().max(1)[0].unsqueeze(-1)
+            q_expected, q_targets_next = self._q_values(states, actions, next_states)
 
         # Compute Q targets for current states
         q_targets = rewards + (self.gamma * q_targets_next * (1 - dones))
 
         # Compute loss
-        self.loss = F.mse_loss(q_expected, q_targets)
+        if self.prioritized_replay:
+            # Importance-sampling weighted loss, the new priorities are the absolute TD errors
+            weights, indices = experiences[5:]
+            td_errors = q_targets - q_expected
+            self.loss = (weights * td_errors.pow(2)).mean()
+            with self.memory.lock:
+                self.memory.update_priorities(indices, td_errors.detach().abs().cpu().numpy()[:, 0])
+        else:
+            self.loss = F.mse_loss(q_expected, q_targets)
 
         # Minimize the loss
         self.optimizer.zero_grad()
@@ -108,13 +216,38 @@ class DDDQNPolicy(Policy):
         self.optimizer.step()
 
         # Update target network
-        self._soft_update(self.qnetwork_local, self.qnetwork_target, self.tau)
+        self.n_updates += 1
+        if self.hard_update_interval > 0:
+            if self.n_updates % self.hard_update_interval == 0:
+                self._hard_update()
+        else:
+            self._soft_update(self.tau)
 
-    def _soft_update(self, local_model, target_model, tau):
-        # Soft update model parameters.
+    def _q_values(self, states, actions, next_states):
+        """
+        :return: float32 Q-values of the actions taken, and of the next states
+        """
+        # Get expected Q values from local model
+        q_expected = self.qnetwork_local(states).gather(1, actions).float()
+
+        if self.double_dqn:
+            # Double DQN
+            q_best_action = self.qnetwork_local(next_states).max(1)[1]
+            q_targets_next = self.qnetwork_target(next_states).gather(1, q_best_action.unsqueeze(-1)).float()
+        else:
+            # DQN
+            q_targets_next = self.qnetwork_target(next_states).detach().max(1)[0].unsqueeze(-1).float()
+        return q_expected, q_targets_next
+
+    def _soft_update(self, tau):
+        # Soft update model parameters, in place on the flat parameters of both networks.
         # θ_target = τ*θ_local + (1 - τ)*θ_target
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(tau * local_param.data + (1.0 - tau) * target_param.data)
+        with torch.no_grad():
+            self._target_parameters.lerp_(self._local_parameters, tau)
+
+    def _hard_update(self):
+        with torch.no_grad():
+            self._target_parameters.copy_(self._local_parameters)
 
     def save(self, filename):
         torch.save(self.qnetwork_local.state_dict(), filename + ".local")
@@ -126,14 +259,40 @@ class DDDQNPolicy(Policy):
         if os.path.exists(filename + ".target"):
             self.qnetwork_target.load_state_dict(torch.load(filename + ".target"))
 
-    def save_replay_buffer(self, filename):
-        memory = self.memory.memory
-        with open(filename, 'wb') as f:
-            pickle.dump(list(memory)[-500000:], f)
+    def save_replay_buffer(self, dirname):
+        """
+        Saves the replay buffer to a directory, only the experiences added since the last save are written.
+        """
+        self.memory.save(dirname)
 
     def load_replay_buffer(self, filename):
+        """
+        Loads a replay buffer saved with save_replay_buffer (directory) or an older pickle file.
+        """
+        if os.path.isdir(filename):
+            with self.memory.lock:
+                self.memory.load(filename)
+            return
+
         with open(filename, 'rb') as f:
-            self.memory.memory = pickle.load(f)
+            experiences = pickle.load(f)
+
+        # Older checkpoints pickled the deque content as a list of Experience tuples
+        if isinstance(experiences, list):
+            experiences = [np.array([getattr(e, field) for e in experiences]) for field in Experience._fields]
+            experiences[0] = experiences[0].squeeze(1)
+            experiences[3] = experiences[3].squeeze(1)
+
+        with self.memory.lock:
+            self.memory.clear()
+            self.memory.add_batch(*experiences)
+
+    def close(self):
+        """
+        Stops the minibatch sampling thread, if any
+        """
+        if not self.evaluation_mode and self.prefetcher is not None:
+            self.prefetcher.close()
 
     def test(self):
         self.act(np.array([[0] * self.state_size]))
@@ -143,10 +302,27 @@ class DDDQNPolicy(Policy):
 Experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
 
 
+def flatten_parameters(module):
+    """
+    Moves the parameters of a module into a single contiguous buffer, the parameters becoming views of it.
+    The parameters must not be replaced afterwards, eg by moving the module to another device.
+    :return: the flat buffer
+    """
+    parameters = list(module.parameters())
+    flat = torch.cat([parameter.detach().reshape(-1) for parameter in parameters])
+    offset = 0
+    for parameter in parameters:
+        parameter.data = flat[offset:offset + parameter.numel()].view_as(parameter)
+        offset += parameter.numel()
+    return flat
+
+
 class ReplayBuffer:
-    """Fixed-size buffer to store experience tuples."""
+    """Fixed-size ring buffer storing experiences in preallocated NumPy arrays."""
+
+    FIELDS = ("states", "actions", "rewards", "next_states", "dones")
 
-    def __init__(self, action_size, buffer_size, batch_size, device):
+    def __init__(self, action_size, buffer_size, batch_size, device, state_size=None):
         """Initialize a ReplayBuffer object.
 
         Params
@@ -154,39 +330,356 @@ class ReplayBuffer:
             action_size (int): dimension of each action
             buffer_size (int): maximum size of buffer
             batch_size (int): size of each training batch
+            state_size (int): dimension of each state, inferred from the first experience if None
         """
         self.action_size = action_size
-        self.memory = deque(maxlen=buffer_size)
+        self.buffer_size = buffer_size
         self.batch_size = batch_size
         self.device = device
+        self.state_size = None
+
+        # Held by the callers while a MinibatchPrefetcher samples from the buffer in another thread
+        self.lock = threading.Lock()
+
+        # Index of the next slot to write, number of valid experiences and number of experiences ever added
+        self.cursor = 0
+        self.size = 0
+        self.total = 0
+
+        # Directory the buffer was last saved to (or loaded from), and the total at that time
+        self._saved_dirname = None
+        self._saved_total = 0
+
+        if state_size is not None:
+            self._allocate(state_size)
+
+    def _allocate(self, state_size):
+        self._set_storage(
+            np.zeros((self.buffer_size, state_size), dtype=np.float32),
+            np.zeros((self.buffer_size, 1), dtype=np.int64),
+            np.zeros((self.buffer_size, 1), dtype=np.float32),
+            np.zeros((self.buffer_size, state_size), dtype=np.float32),
+            np.zeros((self.buffer_size, 1), dtype=np.float32)
+        )
+
+    def _set_storage(self, states, actions, rewards, next_states, dones):
+        self.state_size = states.shape[1]
+
+        self.states = states
+        self.actions = actions
+        self.rewards = rewards
+        self.next_states = next_states
+        self.dones = dones
+
+        # Minibatches are gathered into these arrays, the returned tensors share their memory
+        self._batch = [np.zeros((self.batch_size,) + array.shape[1:], dtype=array.dtype)
+                       for array in (self.states, self.actions, self.rewards, self.next_states, self.dones)]
+        self._batch_tensors = [torch.from_numpy(array) for array in self._batch]
 
     def add(self, state, action, reward, next_state, done):
         """Add a new experience to memory."""
-        e = Experience(np.expand_dims(state, 0), action, reward, np.expand_dims(next_state, 0), done)
-        self.memory.append(e)
+        self.add_batch(np.expand_dims(state, 0), [action], [reward], np.expand_dims(next_state, 0), [done])
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """Add several experiences to memory with a single write per array, return the slots written."""
+        states = np.asarray(states)
+        n = len(states)
+        if n == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        if self.state_size is None:
+            self._allocate(states.shape[1])
+
+        # Only the most recent experiences survive if more than buffer_size are added at once
+        start = max(0, n - self.buffer_size)
+        indices = (self.cursor + np.arange(start, n)) % self.buffer_size
+
+        self.states[indices] = states[start:]
+        self.actions[indices, 0] = np.asarray(actions)[start:]
+        self.rewards[indices, 0] = np.asarray(rewards)[start:]
+        self.next_states[indices] = np.asarray(next_states)[start:]
+        self.dones[indices, 0] = np.asarray(dones)[start:]
+
+        self.cursor = (self.cursor + n) % self.buffer_size
+        self.size = min(self.size + n, self.buffer_size)
+        self.total += n
+
+        return indices
 
     def sample(self):
-        """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
-
-        states = torch.from_numpy(self.__v_stack_impr([e.state for e in experiences if e is not None])) \
-            .float().to(self.device)
-        actions = torch.from_numpy(self.__v_stack_impr([e.action for e in experiences if e is not None])) \
-            .long().to(self.device)
-        rewards = torch.from_numpy(self.__v_stack_impr([e.reward for e in experiences if e is not None])) \
-            .float().to(self.device)
-        next_states = torch.from_numpy(self.__v_stack_impr([e.next_state for e in experiences if e is not None])) \
-            .float().to(self.device)
-        dones = torch.from_numpy(self.__v_stack_impr([e.done for e in experiences if e is not None]).astype(np.uint8)) \
-            .float().to(self.device)
+        """Randomly sample a batch of experiences from memory.
 
+        The returned tensors are reused by the next call on CPU, consume them before sampling again.
+        """
+        self.sample_into(self._batch)
+        states, actions, rewards, next_states, dones = [tensor.to(self.device) for tensor in self._batch_tensors]
         return states, actions, rewards, next_states, dones
 
+    def sample_into(self, batch):
+        """Randomly sample a batch of experiences into preallocated arrays.
+
+        Params
+        ======
+            batch (list): arrays of batch_size rows, one per field of FIELDS
+        Returns the indices of the sampled experiences.
+        """
+        indices = np.random.randint(0, self.size, size=self.batch_size)
+        self._gather(indices, batch)
+        return indices
+
+    def _gather(self, indices, batch):
+        arrays = (self.states, self.actions, self.rewards, self.next_states, self.dones)
+        for array, out in zip(arrays, batch):
+            np.take(array, indices, axis=0, out=out)
+
+    def get_experiences(self, max_experiences=None):
+        """Return copies of the stored experiences as (states, actions, rewards, next_states, dones), oldest first."""
+        n = self.size if max_experiences is None else min(self.size, max_experiences)
+        indices = (self.cursor - n + np.arange(n)) % self.buffer_size
+        return (self.states[indices], self.actions[indices, 0], self.rewards[indices, 0],
+                self.next_states[indices], self.dones[indices, 0])
+
+    def clear(self):
+        self.cursor = 0
+        self.size = 0
+        self._saved_dirname = None
+
+    def save(self, dirname):
+        """
+        Save the experiences as flat .npy arrays of buffer_size rows plus a small JSON header.
+
+        Saving again to the same directory only writes the slots filled since the previous save.
+        The header is replaced last and atomically, so an interrupted save leaves a loadable buffer.
+        """
+        os.makedirs(dirname, exist_ok=True)
+
+        incremental = dirname == self._saved_dirname and \
+            all(os.path.exists(os.path.join(dirname, name + ".npy")) for name in self.FIELDS)
+        n_new = self.total - self._saved_total if incremental else self.size
+
+        if not incremental:
+            for name in self.FIELDS:
+                array = getattr(self, name)
+                np.lib.format.open_memmap(os.path.join(dirname, name + ".npy"), mode='w+', dtype=array.dtype, shape=array.shape)
+
+        if n_new > 0:
+            # Slots written since the last save, at most two contiguous ranges because of the ring
+            start = (self.cursor - min(n_new, self.buffer_size)) % self.buffer_size
+            end = start + min(n_new, self.buffer_size)
+            ranges = [(start, min(end, self.buffer_size)), (0, max(0, end - self.buffer_size))]
+
+            for name in self.FIELDS:
+                array = getattr(self, name)
+                on_disk = np.load(os.path.join(dirname, name + ".npy"), mmap_mode='r+')
+                for range_start, range_end in ranges:
+                    on_disk[range_start:range_end] = array[range_start:range_end]
+                on_disk.flush()
+                del on_disk
+
+        header = {
+            "buffer_size": self.buffer_size,
+            "state_size": self.state_size,
+            "cursor": self.cursor,
+            "size": self.size,
+            "total": self.total
+        }
+        with open(os.path.join(dirname, "header.json.tmp"), 'w') as f:
+            json.dump(header, f)
+        os.replace(os.path.join(dirname, "header.json.tmp"), os.path.join(dirname, "header.json"))
+
+        self._saved_dirname = dirname
+        self._saved_total = self.total
+
+    def load(self, dirname):
+        """
+        Load experiences saved with save(). The arrays are memory-mapped copy-on-write, so loading is immediate
+        and the files are only read as experiences get sampled. Buffers saved with a different buffer_size
+        are copied instead.
+        """
+        with open(os.path.join(dirname, "header.json")) as f:
+            header = json.load(f)
+
+        arrays = [np.load(os.path.join(dirname, name + ".npy"), mmap_mode='c') for name in self.FIELDS]
+
+        if header["buffer_size"] == self.buffer_size:
+            self._set_storage(*arrays)
+            self.cursor = header["cursor"]
+            self.size = header["size"]
+            self.total = header["total"]
+            self._saved_dirname = dirname
+            self._saved_total = self.total
+        else:
+            states, actions, rewards, next_states, dones = arrays
+            n = header["size"]
+            indices = (header["cursor"] - n + np.arange(n)) % header["buffer_size"]
+            self.clear()
+            self.add_batch(states[indices], actions[indices, 0], rewards[indices, 0], next_states[indices], dones[indices, 0])
+
     def __len__(self):
         """Return the current size of internal memory."""
-        return len(self.memory)
+        return self.size
+
+
+class SegmentTree:
+    """
+    Array-based binary tree over a power-of-two number of leaves, each inner node holding the reduction of its children.
+    Updates are vectorized: all the modified leaves are written at once, then their ancestors are recomputed one level
+    at a time, so updating a batch costs O(batch * log(capacity)) with only log(capacity) NumPy calls.
+    """
+
+    def __init__(self, capacity, operation, neutral_element):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+
+        self.operation = operation
+        self.neutral_element = neutral_element
+        self.tree = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+    def update(self, indices, values):
+        nodes = np.asarray(indices) + self.capacity
+        self.tree[nodes] = values
+
+        nodes = np.unique(nodes // 2)
+        while nodes[0] > 0:
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+            nodes = np.unique(nodes // 2)
+
+    def reset(self):
+        self.tree.fill(self.neutral_element)
+
+    def root(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity):
+        super(SumTree, self).__init__(capacity, np.add, 0.0)
 
-    def __v_stack_impr(self, states):
-        sub_dim = len(states[0][0]) if isinstance(states[0], Iterable) else 1
-        np_states = np.reshape(np.array(states), (len(states), sub_dim))
-        return np_states
+    def find_prefix_sum_indices(self, prefix_sums):
+        """
+        For each prefix sum, find the highest index i such that sum(tree[:i]) <= prefix sum.
+        All the prefix sums walk down the tree together, one level per iteration.
+        """
+        nodes = np.ones(len(prefix_sums), dtype=np.int64)
+        prefix_sums = np.array(prefix_sums, dtype=np.float64)
+
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = prefix_sums > left_sums
+            prefix_sums -= left_sums * go_right
+            nodes = left + go_right
+
+        return nodes - self.capacity
+
+
+class MinTree(SegmentTree):
+    def __init__(self, capacity):
+        super(MinTree, self).__init__(capacity, np.minimum, np.inf)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Proportional prioritized experience replay (https://arxiv.org/abs/1511.05952).
+    Priorities live in a sum-tree for sampling and a min-tree for the importance-sampling weight normalization.
+    """
+
+    def __init__(self, action_size, buffer_size, batch_size, device, state_size=None, alpha=0.6, beta=0.4,
+                 beta_increment=1e-5, epsilon=1e-6):
+        """Initialize a PrioritizedReplayBuffer object.
+
+        Params
+        ======
+            alpha (float): how much prioritization is used (0 is uniform sampling)
+            beta (float): initial importance-sampling correction, annealed towards 1
+            beta_increment (float): increase of beta after each sampled batch
+            epsilon (float): added to the TD errors so no experience gets a zero priority
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+
+        self.sum_tree = SumTree(buffer_size)
+        self.min_tree = MinTree(buffer_size)
+        self.max_priority = 1.0
+
+        super(PrioritizedReplayBuffer, self).__init__(action_size, buffer_size, batch_size, device, state_size)
+
+    def _set_storage(self, states, actions, rewards, next_states, dones):
+        super(PrioritizedReplayBuffer, self)._set_storage(states, actions, rewards, next_states, dones)
+
+        self._batch_weights = np.zeros((self.batch_size, 1), dtype=np.float32)
+        self._batch_weights_tensor = torch.from_numpy(self._batch_weights)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        """New experiences get the highest priority seen so far, so they are sampled at least once."""
+        indices = super(PrioritizedReplayBuffer, self).add_batch(states, actions, rewards, next_states, dones)
+
+        if len(indices) > 0:
+            priority = self.max_priority ** self.alpha
+            self.sum_tree.update(indices, priority)
+            self.min_tree.update(indices, priority)
+
+        return indices
+
+    def sample(self):
+        """Sample a batch proportionally to the priorities, one draw in each of batch_size equal segments.
+
+        Returns the experiences followed by their importance-sampling weights and their indices.
+        """
+        indices = self.sample_into(self._batch + [self._batch_weights])
+        states, actions, rewards, next_states, dones = [tensor.to(self.device) for tensor in self._batch_tensors]
+        return states, actions, rewards, next_states, dones, self._batch_weights_tensor.to(self.device), indices
+
+    def sample_into(self, batch):
+        """Same as sample, into preallocated arrays: one per field of FIELDS then the importance-sampling weights.
+
+        Returns the indices of the sampled experiences.
+        """
+        total = self.sum_tree.root()
+        segment = total / self.batch_size
+        prefix_sums = (np.arange(self.batch_size) + np.random.random_sample(self.batch_size)) * segment
+
+        # Rounding errors can push a draw past the last stored experience
+        indices = np.minimum(self.sum_tree.find_prefix_sum_indices(prefix_sums), self.size - 1)
+
+        # Importance-sampling weights, normalized by the largest possible weight
+        probabilities = self.sum_tree[indices] / total
+        min_probability = self.min_tree.root() / total
+        weights = batch[5]
+        np.divide(probabilities, min_probability, out=weights[:, 0])
+        np.power(weights, -self.beta, out=weights)
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        self._gather(indices, batch)
+        return indices
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.max_priority = max(self.max_priority, np.max(priorities))
+
+        priorities = priorities ** self.alpha
+        self.sum_tree.update(indices, priorities)
+        self.min_tree.update(indices, priorities)
+
+    def clear(self):
+        super(PrioritizedReplayBuffer, self).clear()
+        self.sum_tree.reset()
+        self.min_tree.reset()
+        self.max_priority = 1.0
+
+    def load(self, dirname):
+        """Priorities are not saved, restored experiences all start with the same priority."""
+        super(PrioritizedReplayBuffer, self).load(dirname)
+
+        self.sum_tree.reset()
+        self.min_tree.reset()
+        if self.size > 0:
+            priority = self.max_priority ** self.alpha
+            self.sum_tree.update(np.arange(self.size), priority)
+            self.min_tree.update(np.arange(self.size), priority)
@@ -1,4 +1,4 @@
-import math
+import json
 import multiprocessing
 import os
 import sys
@@ -9,35 +9,102 @@ from pprint import pprint
 from flatland.envs import line_generators
 
 import numpy as np
-import torch
 from flatland.envs.malfunction_generators import malfunction_from_params, MalfunctionParameters
 from flatland.envs.observations import TreeObsForRailEnv
 from flatland.envs.predictions import ShortestPathPredictorForRailEnv
-from flatland.envs.rail_env import RailEnv
 from flatland.envs.rail_generators import sparse_rail_generator
 from flatland.envs.line_generators import sparse_line_generator
 from flatland.utils.rendertools import RenderTool
-import time
 base_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(base_dir))
 
-from utils.deadlock_check import check_if_all_blocked
-from utils.timer import Timer
-from utils.observation_utils import normalize_observation
-from reinforcement_learning.dddqn_policy import DDDQNPolicy
-
-
-def eval_policy(env_params, checkpoint, n_eval_episodes, max_steps, action_size, state_size, seed, render, allow_skipping, allow_caching):
-    # Evaluation is faster on CPU (except if you use a really huge policy)
-    parameters = {
-        'use_gpu': False
-    }
-
-    policy = DDDQNPolicy(state_size, action_size, Namespace(**parameters), evaluation_mode=True)
-    policy.qnetwork_local = torch.load(checkpoint)
-
-    env_params = Namespace(**env_params)
-
+from utils.action_cache import ActionCache
+from utils.deadlock_check import DeadlockDetector
+from utils.env_cache import EnvCache
+from utils.fast_rail_env import FastRailEnv
+from utils.timer import TimerRegistry
+from utils.observation_utils import normalize_observations, SubsetTreeObsForRailEnv
+
+
+# Evaluation env configs. Observation parameters need to match the ones used during training!
+
+# small_v0
+SMALL_V0_PARAMS = {
+    # sample configuration
+    "n_agents": 5,
+    "x_dim": 30,
+    "y_dim": 30,
+    "n_cities": 4,
+    "max_rails_between_cities": 2,
+
+    # observations
+    "observation_tree_depth": 2,
+    "observation_radius": 10,
+    "observation_max_path_depth": 20
+}
+
+# Test_init
+TEST_INIT_PARAMS = {
+    # sample configuration
+    "n_agents": 3,
+    "x_dim": 25,
+    "y_dim": 25,
+    "n_cities": 3,
+    "max_rails_between_cities": 3,
+
+    # observations
+    "observation_tree_depth": 2,
+    "observation_radius": 10,
+    "observation_max_path_depth": 20
+}
+
+# Test_0
+TEST0_PARAMS = {
+    # sample configuration
+    "n_agents": 7,
+    "x_dim": 30,
+    "y_dim": 30,
+    "n_cities": 6,
+    "max_rails_between_cities": 5,
+
+    # observations
+    "observation_tree_depth": 2,
+    "observation_radius": 10,
+    "observation_max_path_depth": 20
+}
+
+# Test_1
+TEST1_PARAMS = {
+    # environment
+    "n_agents": 10,
+    "x_dim": 30,
+    "y_dim": 30,
+    "n_cities": 8,
+    "max_rails_between_cities": 4,
+
+    # observations
+    "observation_tree_depth": 2,
+    "observation_radius": 10,
+    "observation_max_path_depth": 10
+}
+
+# Test_5
+TEST5_PARAMS = {
+    # environment
+    "n_agents": 80,
+    "x_dim": 35,
+    "y_dim": 35,
+    "n_cities": 5,
+    "max_rails_between_cities": 2,
+
+    # observations
+    "observation_tree_depth": 2,
+    "observation_radius": 10,
+    "observation_max_path_depth": 20
+}
+
+
+def create_env(env_params, env_cache=None, vectorized_step=False, partial_observations=False):
     # Environment parameters
     n_agents = env_params.n_agents
     x_dim = env_params.x_dim
@@ -63,15 +130,14 @@ def eval_policy(env_params, checkpoint, n_eval_episodes, max_steps, action_size,
 
     # Observation parameters
     observation_tree_depth = env_params.observation_tree_depth
-    observation_radius = env_params.observation_radius
     observation_max_path_depth = env_params.observation_max_path_depth
 
     # Observation builder
     predictor = ShortestPathPredictorForRailEnv(observation_max_path_depth)
-    tree_observation = TreeObsForRailEnv(max_depth=observation_tree_depth, predictor=predictor)
+    tree_observation = SubsetTreeObsForRailEnv(max_depth=observation_tree_depth, predictor=predictor)
 
     # Setup the environment
-    env = RailEnv(
+    return FastRailEnv(
         width=x_dim, height=y_dim,
         rail_generator=sparse_rail_generator(
             max_num_cities=n_cities,
@@ -81,240 +147,224 @@ def eval_policy(env_params, checkpoint, n_eval_episodes, max_steps, action_size,
         line_generator=sparse_line_generator(speed_profiles),
         number_of_agents=n_agents,
         malfunction_generator_and_process_data=malfunction_from_params(malfunction_parameters),
-        obs_builder_object=tree_observation
+        obs_builder_object=tree_observation,
+        env_cache=env_cache,
+        vectorized_step=vectorized_step,
+        partial_observations=partial_observations
     )
 
-    if render:
-        env_renderer = RenderTool(env, gl="PGL")
 
+def load_policy(checkpoint, state_size, action_size, numpy_inference=False, fused_network=False, int8_inference=False):
+    """
+    :param numpy_inference: run the policy with NumPy, from weights exported by numpy_inference.py, without importing torch
+    :param fused_network: run the torch policy with a FusedDuelingQNetwork
+    :param int8_inference: run the torch policy with int8 dynamic quantized weights
+    """
+    if numpy_inference:
+        from reinforcement_learning.numpy_inference import NumpyPolicy
+        return NumpyPolicy.from_file(checkpoint)
+
+    from reinforcement_learning.checkpoint import load_network
+    from reinforcement_learning.dddqn_policy import DDDQNPolicy
+
+    # Evaluation is faster on CPU (except if you use a really huge policy)
+    parameters = {
+        'use_gpu': False
+    }
+
+    policy = DDDQNPolicy(state_size, action_size, Namespace(**parameters), evaluation_mode=True)
+    policy.qnetwork_local, metadata = load_network(checkpoint, fused=fused_network)
+    if metadata["state_size"] != state_size:
+        raise ValueError("Checkpoint {} expects observations of size {}, got {}: check the observation parameters".format(checkpoint, metadata["state_size"], state_size))
+    if int8_inference:
+        policy.quantize()
+    # The weights are shared with the worker processes
+    policy.qnetwork_local.share_memory()
+    return policy
+
+
+def eval_episode(env, policy, env_params, max_steps, seed, allow_skipping, action_cache=None, env_renderer=None):
+    """
+    Runs one evaluation episode
+    :param seed: seed the episode is generated with
+    :param action_cache: optional ActionCache the actions are looked up in before running the inference
+    :return: dict with the results and timings of the episode, its "timers" TimerRegistry has the laps and counters
+    """
+    observation_tree_depth = env_params.observation_tree_depth
+    observation_radius = env_params.observation_radius
+
+    timers = TimerRegistry()
+    reset_timer, inference_timer, preproc_timer, agent_timer, step_timer = (
+        timers[name] for name in ("reset", "inference", "preproc", "agent", "step")
+    )
+
+    reset_timer.start()
+    obs, info = env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=seed)
+    reset_timer.end()
+
+    # Deadlocked agents can't move whatever their action, so they are left out of the inference
+    deadlock_detector = DeadlockDetector(env)
+
+    agent_obs = np.zeros((env.get_num_agents(), policy.state_size))
+    needs_inference = np.zeros(env.get_num_agents(), dtype=bool)
     action_dict = dict()
-    scores = []
-    completions = []
-    nb_steps = []
-    inference_times = []
-    preproc_times = []
-    agent_times = []
-    step_times = []
-
-    for episode_idx in range(n_eval_episodes):
-        time.sleep(2)
-        seed += 1
-
-        inference_timer = Timer()
-        preproc_timer = Timer()
-        agent_timer = Timer()
-        step_timer = Timer()
+    score = 0.0
+
+    if env_renderer is not None:
+        env_renderer.set_new_rail()
+
+    final_step = 0
+    skipped = 0
+
+    nb_hit = 0
+
+    for step in range(max_steps - 1):
+        deadlocked = deadlock_detector.update()
+        if allow_skipping and deadlock_detector.all_deadlocked():
+            # FIXME why -1? bug where all agents are "done" after max_steps!
+            skipped = max_steps - step - 1
+            final_step = max_steps - 2
+            n_unfinished_agents = sum(not done[idx] for idx in env.get_agent_handles())
+            score -= skipped * n_unfinished_agents
+            break
+
+        agent_timer.start()
+        acting_agents = np.array([
+            agent for agent in env.get_agent_handles()
+            if obs[agent] and info['action_required'][agent] and agent not in deadlocked
+        ], dtype=np.int64)
+
+        preproc_timer.start()
+        normalize_observations(obs, acting_agents, observation_tree_depth, observation_radius=observation_radius, out=agent_obs)
+        preproc_timer.end()
+
+        needs_inference[:] = False
+        needs_inference[acting_agents] = True
+        if action_cache is not None:
+            keys, cached_actions = action_cache.lookup(agent_obs[acting_agents])
+            hit = cached_actions >= 0
+            action_dict.update(zip(acting_agents[hit].tolist(), cached_actions[hit].tolist()))
+            needs_inference[acting_agents[hit]] = False
+            nb_hit += int(np.count_nonzero(hit))
+
+        inference_timer.start()
+        actions = policy.act_batch(agent_obs, eps=0.0, mask=needs_inference)
+        inference_timer.end()
+        timers.count("inferences", np.count_nonzero(needs_inference))
+        timers.count("agent_steps", len(acting_agents))
+
+        for agent in np.flatnonzero(needs_inference):
+            action_dict.update({int(agent): int(actions[agent])})
+
+        if action_cache is not None:
+            action_cache.store([key for key, is_hit in zip(keys, hit) if not is_hit], actions[acting_agents[~hit]])
+        agent_timer.end()
 
         step_timer.start()
-        obs, info = env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=seed)
+        obs, all_rewards, done, info = env.step(action_dict)
         step_timer.end()
-
-        agent_obs = [None] * env.get_num_agents()
-        score = 0.0
-
-        if render:
-            env_renderer.set_new_rail()
-
-        final_step = 0
-        skipped = 0
-
-        nb_hit = 0
-        agent_last_obs = {}
-        agent_last_action = {}
-
-        for step in range(max_steps - 1):
-            if allow_skipping and check_if_all_blocked(env):
-                # FIXME why -1? bug where all agents are "done" after max_steps!
-                skipped = max_steps - step - 1
-                final_step = max_steps - 2
-                n_unfinished_agents = sum(not done[idx] for idx in env.get_agent_handles())
-                score -= skipped * n_unfinished_agents
-                break
-
-            agent_timer.start()
-            for agent in env.get_agent_handles():
-                if obs[agent] and info['action_required'][agent]:
-                    if agent in agent_last_obs and np.all(agent_last_obs[agent] == obs[agent]):
-                        nb_hit += 1
-                        action = agent_last_action[agent]
-
-                    else:
-                        preproc_timer.start()
-                        norm_obs = normalize_observation(obs[agent], tree_depth=observation_tree_depth, observation_radius=observation_radius)
-                        preproc_timer.end()
-
-                        inference_timer.start()
-                        action = policy.act(norm_obs, eps=0.0)
-                        inference_timer.end()
-
-                    action_dict.update({agent: action})
-
-                    if allow_caching:
-                        agent_last_obs[agent] = obs[agent]
-                        agent_last_action[agent] = action
-            agent_timer.end()
-
-            step_timer.start()
-            obs, all_rewards, done, info = env.step(action_dict)
-            step_timer.end()
-
-            if render:
-                env_renderer.render_env(
-                    show=True,
-                    frames=False,
-                    show_observations=False,
-                    show_predictions=False
-                )
-
-                if step % 100 == 0:
-                    print("{}/{}".format(step, max_steps - 1))
-
-            for agent in env.get_agent_handles():
-                score += all_rewards[agent]
-
-            final_step = step
-
-            if done['__all__']:
-                break
-
-        normalized_score = score / (max_steps * env.get_num_agents())
-        print(f'noralized score = {normalized_score}, score = {score}, max number of steps = {max_steps}, number of agents = {env.get_num_agents()}')
-        scores.append(normalized_score)
-
-        tasks_finished = sum(done[idx] for idx in env.get_agent_handles())
-        completion = tasks_finished / max(1, env.get_num_agents())
-        completions.append(completion)
-
-        nb_steps.append(final_step)
-
-        inference_times.append(inference_timer.get())
-        preproc_times.append(preproc_timer.get())
-        agent_times.append(agent_timer.get())
-        step_times.append(step_timer.get())
-
-        skipped_text = ""
-        if skipped > 0:
-            skipped_text = "\t⚡ Skipped {}".format(skipped)
-
-        hit_text = ""
-        if nb_hit > 0:
-            hit_text = "\t⚡ Hit {} ({:.1f}%)".format(nb_hit, (100 * nb_hit) / (n_agents * final_step))
-
-        print(
-            "☑️  Score: {:.3f} \tDone: {:.1f}% \tNb steps: {:.3f} "
-            "\t🍭 Seed: {}"
-            "\t🚉 Env: {:.3f}s  "
-            "\t🤖 Agent: {:.3f}s (per step: {:.3f}s) \t[preproc: {:.3f}s \tinfer: {:.3f}s]"
-            "{}{}".format(
-                normalized_score,
-                completion * 100.0,
-                final_step,
-                seed,
-                step_timer.get(),
-                agent_timer.get(),
-                agent_timer.get() / final_step,
-                preproc_timer.get(),
-                inference_timer.get(),
-                skipped_text,
-                hit_text
+        timers.count("env_steps")
+
+        if env_renderer is not None:
+            env_renderer.render_env(
+                show=True,
+                frames=False,
+                show_observations=False,
+                show_predictions=False
             )
-        )
 
-    return scores, completions, nb_steps, agent_times, step_times
+            if step % 100 == 0:
+                print("{}/{}".format(step, max_steps - 1))
 
+        score += np.sum(env.step_rewards)
 
-def evaluate_agents(file, n_evaluation_episodes, use_gpu, render, allow_skipping, allow_caching):
-    nb_threads = 1
-    eval_per_thread = n_evaluation_episodes
+        final_step = step
 
-    if not render:
-        nb_threads = multiprocessing.cpu_count()
-        eval_per_thread = max(1, math.ceil(n_evaluation_episodes / nb_threads))
-
-    total_nb_eval = eval_per_thread * nb_threads
-    print("Will evaluate policy {} over {} episodes on {} threads.".format(file, total_nb_eval, nb_threads))
-
-    if total_nb_eval != n_evaluation_episodes:
-        print("(Rounding up from {} to fill all cores)".format(n_evaluation_episodes))
-
-    # Observation parameters need to match the ones used during training!
-
-    # small_v0
-    small_v0_params = {
-        # sample configuration
-        "n_agents": 5,
-        "x_dim": 30,
-        "y_dim": 30,
-        "n_cities": 4,
-        "max_rails_between_cities": 2,
-
-        # observations
-        "observation_tree_depth": 2,
-        "observation_radius": 10,
-        "observation_max_path_depth": 20
-    }
+        if done['__all__']:
+            break
 
-     # Test_init
-    test_init = {
-        # sample configuration
-        "n_agents": 3,
-        "x_dim": 25,
-        "y_dim": 25,
-        "n_cities": 3,
-        "max_rails_between_cities": 3,
-
-        # observations
-        "observation_tree_depth": 2,
-        "observation_radius": 10,
-        "observation_max_path_depth": 20
-    }
+    normalized_score = score / (max_steps * env.get_num_agents())
 
-    # Test_0
-    test0_params = {
-        # sample configuration
-        "n_agents": 7,
-        "x_dim": 30,
-        "y_dim": 30,
-        "n_cities": 6,
-        "max_rails_between_cities": 5,
-        
-        # observations
-        "observation_tree_depth": 2,
-        "observation_radius": 10,
-        "observation_max_path_depth": 20
-    }
+    tasks_finished = sum(done[idx] for idx in env.get_agent_handles())
+    completion = tasks_finished / max(1, env.get_num_agents())
 
-    # Test_1
-    test1_params = {
-        # environment
-        "n_agents": 10,
-        "x_dim": 30,
-        "y_dim": 30,
-        "n_cities": 8,
-        "max_rails_between_cities": 4,
-
-        # observations
-        "observation_tree_depth": 2,
-        "observation_radius": 10,
-        "observation_max_path_depth": 10
+    return {
+        "seed": seed,
+        "score": float(normalized_score),
+        "raw_score": float(score),
+        "completion": float(completion),
+        "nb_steps": final_step,
+        "skipped": skipped,
+        "nb_hit": nb_hit,
+        "nb_deadlocked": len(deadlock_detector.deadlocked),
+        "agent_time": agent_timer.get(),
+        "preproc_time": preproc_timer.get(),
+        "inference_time": inference_timer.get(),
+        "step_time": reset_timer.get() + step_timer.get(),
+        "timers": timers,
     }
 
-    # Test_5
-    test5_params = {
-        # environment
-        "n_agents": 80,
-        "x_dim": 35,
-        "y_dim": 35,
-        "n_cities": 5,
-        "max_rails_between_cities": 2,
-
-        # observations
-        "observation_tree_depth": 2,
-        "observation_radius": 10,
-        "observation_max_path_depth": 20
-    }
 
-    params = test_init
+def print_episode_result(result, n_agents):
+    skipped_text = ""
+    if result["skipped"] > 0:
+        skipped_text = "\t⚡ Skipped {}".format(result["skipped"])
+
+    hit_text = ""
+    if result["nb_hit"] > 0:
+        hit_text = "\t⚡ Hit {} ({:.1f}%)".format(result["nb_hit"], (100 * result["nb_hit"]) / (n_agents * max(1, result["nb_steps"])))
+
+    deadlock_text = ""
+    if result["nb_deadlocked"] > 0:
+        deadlock_text = "\t🔒 Deadlocked {}".format(result["nb_deadlocked"])
+
+    print(
+        "☑️  Score: {:.3f} \tDone: {:.1f}% \tNb steps: {:.3f} "
+        "\t🍭 Seed: {}"
+        "\t🚉 Env: {:.3f}s  "
+        "\t🤖 Agent: {:.3f}s (per step: {:.3f}s) \t[preproc: {:.3f}s \tinfer: {:.3f}s]"
+        "{}{}{}".format(
+            result["score"],
+            result["completion"] * 100.0,
+            result["nb_steps"],
+            result["seed"],
+            result["step_time"],
+            result["agent_time"],
+            result["agent_time"] / max(1, result["nb_steps"]),
+            result["preproc_time"],
+            result["inference_time"],
+            skipped_text,
+            hit_text,
+            deadlock_text
+        )
+    )
+
+
+# State of an evaluation worker process
+_worker = {}
+
+
+def _init_worker(env_params, env_cache, vectorized_step, partial_observations, policy, max_steps, allow_skipping, allow_caching):
+    # torch is only imported by the torch policy
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(1)
+    _worker.update(env=create_env(env_params, env_cache, vectorized_step, partial_observations), policy=policy, env_params=env_params, max_steps=max_steps,
+                   allow_skipping=allow_skipping, action_cache=ActionCache() if allow_caching else None)
+
+
+def _eval_seed(seed):
+    return eval_episode(_worker["env"], _worker["policy"], _worker["env_params"], _worker["max_steps"], seed,
+                        _worker["allow_skipping"], _worker["action_cache"])
+
+
+def evaluate_agents(file, n_evaluation_episodes, use_gpu, render, allow_skipping, allow_caching, num_workers=None, results_file=None, env_cache=None, vectorized_step=False, partial_observations=False, numpy_inference=False, fused_network=False, int8_inference=False):
+    nb_workers = 1
+    if not render:
+        nb_workers = max(1, min(num_workers or multiprocessing.cpu_count(), n_evaluation_episodes))
+
+    print("Will evaluate policy {} over {} episodes on {} processes.".format(file, n_evaluation_episodes, nb_workers))
+
+    params = TEST_INIT_PARAMS
     env_params = Namespace(**params)
 
     print("Environment parameters:")
@@ -329,28 +379,53 @@ def evaluate_agents(file, n_evaluation_episodes, use_gpu, render, allow_skipping
     n_nodes = sum([np.power(4, i) for i in range(tree_depth + 1)])
     state_size = num_features_per_node * n_nodes
 
+    # The policy is loaded once, before the worker processes are started
+    policy = load_policy(file, state_size, action_size, numpy_inference, fused_network, int8_inference)
+
+    seeds = range(1, n_evaluation_episodes + 1)
+
+    # The envs are generated differently than in multi_agent_training, so they get their own cache
+    env_cache = EnvCache(env_cache, dict(params, generator="evaluate_agent")) if env_cache else None
+    if env_cache is not None:
+        print("Envs are cached in {}".format(env_cache.directory))
     results = []
+    # Laps and counters of all the episodes, the rates are over the wall time of the evaluation
+    timers = TimerRegistry()
+
+    if results_file:
+        print("Results are written to {}".format(results_file))
+        results_output = open(results_file, "a")
+
+    def report(result):
+        episode_timers = result.pop("timers")
+        timers.merge(episode_timers)
+        results.append(result)
+        print_episode_result(result, env_params.n_agents)
+        if results_file:
+            results_output.write(json.dumps(dict(result, checkpoint=file, timers=episode_timers.stats())) + "\n")
+            results_output.flush()
+
     if render:
-        results.append(eval_policy(params, file, eval_per_thread, max_steps, action_size, state_size, 0, render, allow_skipping, allow_caching))
+        env = create_env(env_params, env_cache, vectorized_step, partial_observations)
+        env_renderer = RenderTool(env, gl="PGL")
+        action_cache = ActionCache() if allow_caching else None
+        for seed in seeds:
+            report(eval_episode(env, policy, env_params, max_steps, seed, allow_skipping, action_cache, env_renderer=env_renderer))
 
     else:
-        with Pool() as p:
-            results = p.starmap(eval_policy,
-                                [(params, file, 1, max_steps, action_size, state_size, seed * nb_threads, render, allow_skipping, allow_caching)
-                                 for seed in
-                                 range(total_nb_eval)])
-
-    scores = []
-    completions = []
-    nb_steps = []
-    times = []
-    step_times = []
-    for s, c, n, t, st in results:
-        scores.append(s)
-        completions.append(c)
-        nb_steps.append(n)
-        times.append(t)
-        step_times.append(st)
+        # Episodes are handed out one at a time as workers become free, since their lengths vary widely
+        with Pool(nb_workers, initializer=_init_worker, initargs=(env_params, env_cache, vectorized_step, partial_observations, policy, max_steps, allow_skipping, allow_caching)) as p:
+            for result in p.imap_unordered(_eval_seed, seeds, chunksize=1):
+                report(result)
+
+    if results_file:
+        results_output.close()
+
+    scores = [result["score"] for result in results]
+    completions = [result["completion"] for result in results]
+    nb_steps = [result["nb_steps"] for result in results]
+    times = [result["agent_time"] for result in results]
+    step_times = [result["step_time"] for result in results]
 
     print("-" * 200)
 
@@ -367,6 +442,7 @@ def evaluate_agents(file, n_evaluation_episodes, use_gpu, render, allow_skipping
         np.sum(step_times),
         np.sum(times) + np.sum(step_times)
     ))
+    print("⏱️  " + timers.summary().replace("\n", "\n⏱️  "))
 
 
 if __name__ == "__main__":
@@ -380,9 +456,21 @@ if __name__ == "__main__":
     parser.add_argument("--use_gpu", dest="use_gpu", help="use GPU if available", action='store_true')
     parser.add_argument("--render", help="render a single episode", action='store_true')
     parser.add_argument("--allow_skipping", help="skips to the end of the episode if all agents are deadlocked", action='store_true')
-    parser.add_argument("--allow_caching", help="caches the last observation-action pair", action='store_true')
+    parser.add_argument("--allow_caching", help="caches the actions of the observations seen, shared by all agents and episodes", action='store_true')
+    parser.add_argument("--num_workers", help="number of evaluation processes, defaults to the number of cores", default=None, type=int)
+    parser.add_argument("--results_file", help="file the episode results are appended to as JSON lines, defaults to the checkpoint name with a .eval.jsonl extension", default=None, type=str)
+    parser.add_argument("--env_cache", help="directory caching the generated envs", default=None, type=str)
+    parser.add_argument("--vectorized_step", help="steps the agents on NumPy arrays instead of RailEnv.step", action='store_true')
+    parser.add_argument("--partial_observations", help="only computes the observations of the agents which require an action", action='store_true')
+    parser.add_argument("--numpy_inference", help="runs the policy with NumPy instead of torch, the checkpoint must then be a .npz file exported by numpy_inference.py", action='store_true')
+    parser.add_argument("--fused_network", help="runs the torch policy with the value and advantage streams fused", action='store_true')
+    parser.add_argument("--int8_inference", help="runs the torch policy with int8 dynamic quantized weights", action='store_true')
     args = parser.parse_args()
 
     os.environ["OMP_NUM_THREADS"] = str(1)
+    results_file = args.results_file if args.results_file is not None else os.path.splitext(args.file)[0] + ".eval.jsonl"
     evaluate_agents(file=args.file, n_evaluation_episodes=args.n_evaluation_episodes, use_gpu=args.use_gpu, render=args.render,
-                    allow_skipping=args.allow_skipping, allow_caching=args.allow_caching)
+                    allow_skipping=args.allow_skipping, allow_caching=args.allow_caching,
+                    num_workers=args.num_workers, results_file=results_file, env_cache=args.env_cache,
+                    vectorized_step=args.vectorized_step, partial_observations=args.partial_observations,
+                    numpy_inference=args.numpy_inference, fused_network=args.fused_network, int8_inference=args.int8_inference)
@@ -0,0 +1,120 @@
+import queue
+import threading
+
+import torch
+
+
+class MinibatchPrefetcher:
+    """
+    Samples minibatches from a replay buffer in a background thread, so the learner finds them ready instead of
+    sampling, gathering and converting them itself.
+
+    The minibatches are gathered into slots of preallocated tensors, pinned when the learner runs on GPU so they are
+    copied asynchronously. Like ReplayBuffer.sample, the tensors returned by get are reused once get is called again.
+
+    The buffer is shared with the thread: callers adding experiences or updating priorities must hold memory.lock.
+    Prioritized minibatches are sampled with priorities up to n_batches updates old, and the sampling thread draws
+    from the NumPy global random state, so the minibatches aren't reproducible from the seed anymore.
+    """
+
+    def __init__(self, memory, device, n_batches=2):
+        """
+        :param memory: ReplayBuffer or PrioritizedReplayBuffer to sample from
+        :param device: device the minibatches are used on
+        :param n_batches: number of minibatches kept ready
+        """
+        self.memory = memory
+        self.device = device
+        self.n_batches = n_batches
+        pin_memory = device.type == "cuda"
+
+        # One more slot than ready minibatches: the slot of the minibatch being learned from
+        self._slots = [self._allocate_slot(pin_memory) for _ in range(n_batches + 1)]
+        self._copy_events = [None] * len(self._slots)
+        self._free = queue.Queue()
+        for index in range(len(self._slots)):
+            self._free.put(index)
+        self._ready = queue.Queue()
+        self._in_use = None
+
+        self._error = None
+        self._closed = False
+        # Started on the first minibatch, once the buffer has enough experiences to sample from
+        self._thread = None
+
+    def _allocate_slot(self, pin_memory):
+        fields = [self.memory.states, self.memory.actions, self.memory.rewards, self.memory.next_states, self.memory.dones]
+        shapes = [(self.memory.batch_size,) + array.shape[1:] for array in fields]
+        dtypes = [torch.from_numpy(array[:0]).dtype for array in fields]
+        if hasattr(self.memory, "beta"):
+            # Importance sampling weights of a prioritized replay buffer
+            shapes.append((self.memory.batch_size, 1))
+            dtypes.append(torch.float32)
+        tensors = [torch.zeros(shape, dtype=dtype, pin_memory=pin_memory) for shape, dtype in zip(shapes, dtypes)]
+        # The minibatches are gathered by NumPy into views of the tensors
+        return {"tensors": tensors, "arrays": [tensor.numpy() for tensor in tensors], "indices": None}
+
+    def get(self):
+        """
+        Waits for the next ready minibatch, and frees the slot of the previous one
+        :return: same experiences as memory.sample()
+        """
+        self._raise_error()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sample_minibatches, name="minibatch-sampler", daemon=True)
+            self._thread.start()
+
+        if self._in_use is not None:
+            self._free.put(self._in_use)
+            self._in_use = None
+
+        while True:
+            try:
+                index = self._ready.get(timeout=1.0)
+                break
+            except queue.Empty:
+                self._raise_error()
+        self._in_use = index
+
+        slot = self._slots[index]
+        tensors = slot["tensors"]
+        if self.device.type == "cuda":
+            tensors = [tensor.to(self.device, non_blocking=True) for tensor in tensors]
+            # The sampling thread waits for the copies before refilling the pinned tensors
+            self._copy_events[index] = torch.cuda.Event()
+            self._copy_events[index].record()
+
+        if len(tensors) > 5:
+            return tuple(tensors) + (slot["indices"],)
+        return tuple(tensors)
+
+    def close(self):
+        """
+        Stops the sampling thread
+        """
+        self._closed = True
+        self._free.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Sampling a minibatch failed") from self._error
+
+    def _sample_minibatches(self):
+        try:
+            while True:
+                index = self._free.get()
+                if index is None or self._closed:
+                    return
+
+                if self._copy_events[index] is not None:
+                    self._copy_events[index].synchronize()
+                    self._copy_events[index] = None
+
+                slot = self._slots[index]
+                with self.memory.lock:
+                    slot["indices"] = self.memory.sample_into(slot["arrays"])
+                self._ready.put(index)
+        except Exception as e:
+            self._error = e
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -29,3 +30,115 @@ class DuelingQNetwork(nn.Module):
         adv = self.fc4_adv(adv)
 
         return val + adv - adv.mean()
+
+
+def quantize_dynamic_int8(network):
+    """
+    :param network: DuelingQNetwork or FusedDuelingQNetwork
+    :return: DuelingQNetwork with the same weights quantized to int8, its activations are quantized on the fly.
+             Quantized networks only run on CPU.
+    """
+    state_dict = {name: tensor.cpu() for name, tensor in network.state_dict().items()}
+    hidsize1, state_size = state_dict["fc1_val.weight"].shape
+    hidsize2 = state_dict["fc2_val.weight"].shape[0]
+    action_size = state_dict["fc4_adv.weight"].shape[0]
+
+    # The fused layers aren't nn.Linear modules, so the separate layers are quantized instead
+    float_network = DuelingQNetwork(state_size, action_size, hidsize1, hidsize2)
+    float_network.load_state_dict(state_dict)
+    return torch.quantization.quantize_dynamic(float_network.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+class FusedDuelingQNetwork(nn.Module):
+    """
+    DuelingQNetwork with the value and advantage streams fused, for the same Q-values with fewer and larger ops:
+    the first layers of both streams are a single matmul, the second layers a single batched matmul, and the value
+    and advantage heads a single matmul with a block diagonal weight matrix.
+
+    The state dict has the layout of DuelingQNetwork, so both networks load each other's checkpoints.
+    """
+
+    # Layers of DuelingQNetwork, in the order they are applied in each stream
+    VALUE_LAYERS = ("fc1_val", "fc2_val", "fc4_val")
+    ADVANTAGE_LAYERS = ("fc1_adv", "fc2_adv", "fc4_adv")
+
+    def __init__(self, state_size, action_size, hidsize1=128, hidsize2=128):
+        super(FusedDuelingQNetwork, self).__init__()
+        self.hidsize1 = hidsize1
+        self.hidsize2 = hidsize2
+
+        # Both first layers, value stream first
+        self.fc1 = nn.Linear(state_size, 2 * hidsize1)
+
+        # Second layers of both streams, applied with a batched matmul
+        self.fc2_weight = nn.Parameter(torch.empty(2, hidsize1, hidsize2))
+        self.fc2_bias = nn.Parameter(torch.empty(2, 1, hidsize2))
+
+        # Value head in the first output, advantage head in the others. The mask keeps the weights across streams
+        # at zero, their gradients are masked too.
+        self.fc4 = nn.Linear(2 * hidsize2, 1 + action_size)
+        mask = torch.zeros(1 + action_size, 2 * hidsize2)
+        mask[:1, :hidsize2] = 1
+        mask[1:, hidsize2:] = 1
+        self.register_buffer("fc4_mask", mask, persistent=False)
+
+        self._register_state_dict_hook(FusedDuelingQNetwork._unfuse_state_dict)
+        self._register_load_state_dict_pre_hook(self._fuse_state_dict)
+
+        # Same initialization as the separate layers of DuelingQNetwork
+        self.load_state_dict(DuelingQNetwork(state_size, action_size, hidsize1, hidsize2).state_dict())
+
+    def forward(self, x):
+        batch_size = x.shape[0]
+
+        hidden = F.relu(self.fc1(x))
+
+        # (batch_size, 2 * hidsize1) -> (2, batch_size, hidsize1)
+        hidden = hidden.view(batch_size, 2, self.hidsize1).transpose(0, 1)
+        hidden = F.relu(torch.baddbmm(self.fc2_bias, hidden, self.fc2_weight))
+
+        # (2, batch_size, hidsize2) -> (batch_size, 2 * hidsize2)
+        hidden = hidden.transpose(0, 1).reshape(batch_size, 2 * self.hidsize2)
+        heads = F.linear(hidden, self.fc4.weight * self.fc4_mask, self.fc4.bias)
+
+        val, adv = heads[:, :1], heads[:, 1:]
+        return val + adv - adv.mean()
+
+    @staticmethod
+    def _unfuse_state_dict(module, state_dict, prefix, local_metadata):
+        hidsize1, hidsize2 = module.hidsize1, module.hidsize2
+        fc1_weight = state_dict.pop(prefix + "fc1.weight")
+        fc1_bias = state_dict.pop(prefix + "fc1.bias")
+        fc2_weight = state_dict.pop(prefix + "fc2_weight")
+        fc2_bias = state_dict.pop(prefix + "fc2_bias")
+        fc4_weight = state_dict.pop(prefix + "fc4.weight")
+        fc4_bias = state_dict.pop(prefix + "fc4.bias")
+
+        for stream, layers in enumerate((module.VALUE_LAYERS, module.ADVANTAGE_LAYERS)):
+            fc1, fc2, fc4 = (prefix + layer for layer in layers)
+            state_dict[fc1 + ".weight"] = fc1_weight[stream * hidsize1:(stream + 1) * hidsize1]
+            state_dict[fc1 + ".bias"] = fc1_bias[stream * hidsize1:(stream + 1) * hidsize1]
+            state_dict[fc2 + ".weight"] = fc2_weight[stream].t()
+            state_dict[fc2 + ".bias"] = fc2_bias[stream, 0]
+
+        state_dict[prefix + "fc4_val.weight"] = fc4_weight[:1, :hidsize2]
+        state_dict[prefix + "fc4_val.bias"] = fc4_bias[:1]
+        state_dict[prefix + "fc4_adv.weight"] = fc4_weight[1:, hidsize2:]
+        state_dict[prefix + "fc4_adv.bias"] = fc4_bias[1:]
+        return state_dict
+
+    def _fuse_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        if prefix + "fc1_val.weight" not in state_dict:
+            return
+
+        val = [(state_dict.pop(prefix + layer + ".weight"), state_dict.pop(prefix + layer + ".bias")) for layer in self.VALUE_LAYERS]
+        adv = [(state_dict.pop(prefix + layer + ".weight"), state_dict.pop(prefix + layer + ".bias")) for layer in self.ADVANTAGE_LAYERS]
+        (fc1_val_weight, fc1_val_bias), (fc2_val_weight, fc2_val_bias), (fc4_val_weight, fc4_val_bias) = val
+        (fc1_adv_weight, fc1_adv_bias), (fc2_adv_weight, fc2_adv_bias), (fc4_adv_weight, fc4_adv_bias) = adv
+
+        state_dict[prefix + "fc1.weight"] = torch.cat([fc1_val_weight, fc1_adv_weight])
+        state_dict[prefix + "fc1.bias"] = torch.cat([fc1_val_bias, fc1_adv_bias])
+        state_dict[prefix + "fc2_weight"] = torch.stack([fc2_val_weight.t(), fc2_adv_weight.t()])
+        state_dict[prefix + "fc2_bias"] = torch.stack([fc2_val_bias, fc2_adv_bias]).unsqueeze(1)
+        state_dict[prefix + "fc4.weight"] = torch.block_diag(fc4_val_weight, fc4_adv_weight)
+        state_dict[prefix + "fc4.bias"] = torch.cat([fc4_val_bias, fc4_adv_bias])
@@ -1,4 +1,7 @@
 from datetime import datetime
+from functools import partial
+from queue import Empty
+import multiprocessing
 import os
 import random
 import sys
@@ -7,7 +10,6 @@ from pathlib import Path
 from pprint import pprint
 
 import psutil
-from flatland.utils.rendertools import RenderTool
 from torch.utils.tensorboard import SummaryWriter
 import numpy as np
 import torch
@@ -15,7 +17,6 @@ import torch
 from flatland.envs.rail_env import RailEnv, RailEnvActions
 from flatland.envs.rail_generators import sparse_rail_generator
 from flatland.envs.line_generators import sparse_line_generator
-from flatland.envs.observations import TreeObsForRailEnv
 
 from flatland.envs.malfunction_generators import malfunction_from_params, MalfunctionParameters
 from flatland.envs.predictions import ShortestPathPredictorForRailEnv
@@ -23,9 +24,15 @@ from flatland.envs.predictions import ShortestPathPredictorForRailEnv
 base_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(base_dir))
 
-from utils.timer import Timer
-from utils.observation_utils import normalize_observation
+from utils.env_cache import EnvCache
+from utils.fast_rail_env import FastRailEnv
+from utils.timer import Timer, TimerRegistry
+from utils.vec_rail_env import VecRailEnv
+from utils.observation_utils import normalize_observations, SubsetTreeObsForRailEnv
+from reinforcement_learning.background_evaluation import BackgroundEvaluator, evaluate_episode
+from reinforcement_learning.checkpoint import CheckpointManager
 from reinforcement_learning.dddqn_policy import DDDQNPolicy
+from reinforcement_learning.model import DuelingQNetwork, FusedDuelingQNetwork
 
 """
 This file shows how to train multiple agents using a reinforcement learning approach.
@@ -36,7 +43,70 @@ Submission documentation: https://flatland.aicrowd.com/getting-started/first-sub
 """
 
 
-def create_rail_env(env_params, tree_observation):
+# Time measured by each role of the asynchronous training
+ACTOR_TIMERS = ("reset", "inference", "step", "preproc", "send")
+LEARNER_TIMERS = ("receive", "store", "learn", "broadcast", "checkpoint")
+
+# First seed of the cached training episodes, far from the seeds of the evaluation episodes
+TRAINING_SEED_OFFSET = 1000000
+
+# Training env configs, selected by their index with -t and -e
+TRAINING_ENV_PARAMS = [
+    {
+        # Test_-1
+        "n_agents": 3,
+        "x_dim": 25,
+        "y_dim": 25,
+        "n_cities": 3,
+        "max_rails_between_cities": 3,
+        "max_rails_in_city": 3,
+        "malfunction_rate": 1 / 100,
+        "seed": 0
+    },
+    {
+        # Test_0
+        "n_agents": 4,
+        "x_dim": 30,
+        "y_dim": 30,
+        "n_cities": 4,
+        "max_rails_between_cities": 3,
+        "max_rails_in_city": 4,
+        "malfunction_rate": 1 / 100,
+        "seed": 0
+    },
+    {
+        # Test_1
+        "n_agents": 7,
+        "x_dim": 30,
+        "y_dim": 30,
+        "n_cities": 6,
+        "max_rails_between_cities": 5,
+        "max_rails_in_city": 6,
+        "malfunction_rate": 1 / 100,
+        "seed": 0
+    },
+    {
+        # Test_2
+        "n_agents": 20,
+        "x_dim": 30,
+        "y_dim": 30,
+        "n_cities": 3,
+        "max_rails_between_cities": 2,
+        "max_rails_in_city": 3,
+        "malfunction_rate": 1 / 200,
+        "seed": 0
+    },
+]
+
+# Observation parameters of the trained policies
+OBSERVATION_PARAMS = {
+    "observation_tree_depth": 2,
+    "observation_radius": 10,
+    "observation_max_path_depth": 30
+}
+
+
+def create_rail_env(env_params, tree_observation, env_cache=None, vectorized_step=False, partial_observations=False):
     n_agents = env_params.n_agents
     x_dim = env_params.x_dim
     y_dim = env_params.y_dim
@@ -52,7 +122,7 @@ def create_rail_env(env_params, tree_observation):
         max_duration=50
     )
 
-    return RailEnv(
+    return FastRailEnv(
         width=x_dim, height=y_dim,
         rail_generator=sparse_rail_generator(
             max_num_cities=n_cities,
@@ -64,10 +134,102 @@ def create_rail_env(env_params, tree_observation):
         number_of_agents=n_agents,
         malfunction_generator_and_process_data=malfunction_from_params(malfunction_parameters),
         obs_builder_object=tree_observation,
-        random_seed=seed
+        random_seed=seed,
+        env_cache=env_cache,
+        vectorized_step=vectorized_step,
+        partial_observations=partial_observations
+    )
+
+
+def create_env(env_params, obs_params, env_cache=None, vectorized_step=False, partial_observations=False):
+    """
+    Creates a rail env with its own tree observation builder
+    """
+    predictor = ShortestPathPredictorForRailEnv(obs_params.observation_max_path_depth)
+    tree_observation = SubsetTreeObsForRailEnv(max_depth=obs_params.observation_tree_depth, predictor=predictor)
+    return create_rail_env(env_params, tree_observation, env_cache, vectorized_step, partial_observations)
+
+
+def create_env_cache(train_params, env_params, seeds=()):
+    """
+    Creates the on-disk cache of the envs generated from the env params, or None if caching is disabled
+    """
+    if not train_params.env_cache:
+        return None
+
+    # The seed of the env params isn't used to generate the cached envs, the cache keys them by their own seed
+    config = {key: value for key, value in vars(env_params).items() if key != "seed"}
+    return EnvCache(train_params.env_cache, config, seeds)
+
+
+def create_training_env(train_params, env_params, obs_params, index=0):
+    """
+    Creates the env run by the index-th training worker, with its own seed and its own share of the cached episodes
+    """
+    seed = env_params.seed + index
+    random.seed(seed)
+    np.random.seed(seed)
+
+    num_workers = train_params.num_actors if train_params.num_actors > 0 else train_params.num_envs
+    first_seed = env_params.seed + TRAINING_SEED_OFFSET
+    seeds = range(first_seed, first_seed + train_params.env_cache_size)[index::num_workers]
+    env_cache = create_env_cache(train_params, env_params, seeds)
+
+    return create_env(Namespace(**dict(vars(env_params), seed=seed)), obs_params, env_cache, train_params.vectorized_step, train_params.partial_observations)
+
+
+def evaluation_seeds(env_params, n_episodes):
+    """
+    :return: seeds of the evaluation episodes. They start after the env seed, as RailEnv.reset ignores a seed of 0.
+    """
+    return list(range(env_params.seed + 1, env_params.seed + n_episodes + 1))
+
+
+def create_inference_policy(state_size, action_size, train_params):
+    """
+    Creates a CPU policy which only acts, with the same network as the trained policy
+    """
+    policy = DDDQNPolicy(state_size, action_size, Namespace(**dict(vars(train_params), use_gpu=False)), evaluation_mode=True)
+    network_class = FusedDuelingQNetwork if train_params.fused_network else DuelingQNetwork
+    policy.qnetwork_local = network_class(state_size, action_size, hidsize1=train_params.hidden_size, hidsize2=train_params.hidden_size)
+    return policy
+
+
+def create_evaluator(train_params, eval_env_params, obs_params, state_size, action_size):
+    """
+    Creates the pool running the evaluations in the background, or None to evaluate synchronously
+    """
+    if train_params.evaluation_processes <= 0 or train_params.n_evaluation_episodes <= 0:
+        return None
+
+    return BackgroundEvaluator(
+        partial(create_env, eval_env_params, obs_params, create_env_cache(train_params, eval_env_params), train_params.vectorized_step, train_params.partial_observations),
+        partial(create_inference_policy, state_size, action_size, train_params),
+        evaluation_seeds(eval_env_params, train_params.n_evaluation_episodes),
+        obs_params.observation_tree_depth,
+        observation_radius=obs_params.observation_radius,
+        processes=train_params.evaluation_processes
     )
 
 
+def write_evaluation(writer, episode_idx, scores, completions, nb_steps_eval):
+    writer.add_scalar("evaluation/scores_min", np.min(scores), episode_idx)
+    writer.add_scalar("evaluation/scores_max", np.max(scores), episode_idx)
+    writer.add_scalar("evaluation/scores_mean", np.mean(scores), episode_idx)
+    writer.add_scalar("evaluation/scores_std", np.std(scores), episode_idx)
+    writer.add_histogram("evaluation/scores", np.array(scores), episode_idx)
+    writer.add_scalar("evaluation/completions_min", np.min(completions), episode_idx)
+    writer.add_scalar("evaluation/completions_max", np.max(completions), episode_idx)
+    writer.add_scalar("evaluation/completions_mean", np.mean(completions), episode_idx)
+    writer.add_scalar("evaluation/completions_std", np.std(completions), episode_idx)
+    writer.add_histogram("evaluation/completions", np.array(completions), episode_idx)
+    writer.add_scalar("evaluation/nb_steps_min", np.min(nb_steps_eval), episode_idx)
+    writer.add_scalar("evaluation/nb_steps_max", np.max(nb_steps_eval), episode_idx)
+    writer.add_scalar("evaluation/nb_steps_mean", np.mean(nb_steps_eval), episode_idx)
+    writer.add_scalar("evaluation/nb_steps_std", np.std(nb_steps_eval), episode_idx)
+    writer.add_histogram("evaluation/nb_steps", np.array(nb_steps_eval), episode_idx)
+
+
 def train_agent(train_params, train_env_params, eval_env_params, obs_params):
     # Environment parameters
     n_agents = train_env_params.n_agents
@@ -78,14 +240,13 @@ def train_agent(train_params, train_env_params, eval_env_params, obs_params):
     max_rails_in_city = train_env_params.max_rails_in_city
     seed = train_env_params.seed
 
-    # Unique ID for this training
+    # Unique ID for this training, a resumed training keeps its ID
     now = datetime.now()
-    training_id = now.strftime('%y%m%d%H%M%S')
+    training_id = train_params.resume or now.strftime('%y%m%d%H%M%S')
 
     # Observation parameters
     observation_tree_depth = obs_params.observation_tree_depth
     observation_radius = obs_params.observation_radius
-    observation_max_path_depth = obs_params.observation_max_path_depth
 
     # Training parameters
     eps_start = train_params.eps_start
@@ -94,6 +255,7 @@ def train_agent(train_params, train_env_params, eval_env_params, obs_params):
     n_episodes = train_params.n_episodes
     checkpoint_interval = train_params.checkpoint_interval
     n_eval_episodes = train_params.n_evaluation_episodes
+    num_envs = train_params.num_envs
     restore_replay_buffer = train_params.restore_replay_buffer
     save_replay_buffer = train_params.save_replay_buffer
 
@@ -101,40 +263,31 @@ def train_agent(train_params, train_env_params, eval_env_params, obs_params):
     random.seed(seed)
     np.random.seed(seed)
 
-    # Observation builder
-    predictor = ShortestPathPredictorForRailEnv(observation_max_path_depth)
-    tree_observation = TreeObsForRailEnv(max_depth=observation_tree_depth, predictor=predictor)
-
-    # Setup the environments
-    train_env = create_rail_env(train_env_params, tree_observation)
-    train_env.reset(regenerate_schedule=True, regenerate_rail=True)
-    eval_env = create_rail_env(eval_env_params, tree_observation)
+    # Setup the evaluation environment
+    eval_env = create_env(eval_env_params, obs_params, create_env_cache(train_params, eval_env_params), train_params.vectorized_step, train_params.partial_observations)
     eval_env.reset(regenerate_schedule=True, regenerate_rail=True)
 
-    # Setup renderer
-    if train_params.render:
-        env_renderer = RenderTool(train_env, gl="PGL")
-
     # Calculate the state size given the depth of the tree observation and the number of features
-    n_features_per_node = train_env.obs_builder.observation_dim
+    n_features_per_node = eval_env.obs_builder.observation_dim
     n_nodes = sum([np.power(4, i) for i in range(observation_tree_depth + 1)])
     state_size = n_features_per_node * n_nodes
 
     # The action space of flatland is 5 discrete actions
     action_size = 5
 
-    # Max number of steps per episode
-    # This is the official formula used during evaluations
-    # See details in flatland.envs.line_generators.sparse_line_generator
-    # max_steps = int(4 * 2 * (env.height + env.width + (n_agents / n_cities)))
-    max_steps = train_env._max_episode_steps
+    # Setup the training environments, each one is stepped in its own process.
+    # They are started before the policy is created so the workers don't inherit its state.
+    train_env = VecRailEnv(
+        partial(create_training_env, train_params, train_env_params, obs_params),
+        num_envs, n_agents, state_size,
+        observation_tree_depth, observation_radius=observation_radius, reward_shaping=True
+    )
+    evaluator = create_evaluator(train_params, eval_env_params, obs_params, state_size, action_size)
 
-    action_count = [0] * action_size
-    action_dict = dict()
-    agent_obs = [None] * n_agents
-    agent_prev_obs = [None] * n_agents
-    agent_prev_action = [2] * n_agents
-    update_values = [False] * n_agents
+    action_count = np.zeros(action_size, dtype=int)
+    agent_obs = np.zeros((num_envs, n_agents, state_size), dtype=np.float32)
+    agent_prev_obs = np.zeros((num_envs, n_agents, state_size), dtype=np.float32)
+    agent_prev_action = np.full((num_envs, n_agents), 2)
 
     # Smoothed values used as target for hyperparameter tuning
     smoothed_normalized_score = -1.0
@@ -155,7 +308,23 @@ def train_agent(train_params, train_env_params, eval_env_params, obs_params):
             print(e)
             exit(1)
 
-    print("\n💾 Replay buffer status: {}/{} experiences".format(len(policy.memory.memory), train_params.buffer_size))
+    print("\n💾 Replay buffer status: {}/{} experiences".format(len(policy.memory), train_params.buffer_size))
+
+    # Checkpoints are written in the background, resuming restores the newest one
+    checkpoint_manager = CheckpointManager('./baselines/checkpoints', training_id, keep=train_params.keep_checkpoints, **vars(obs_params))
+    start_episode_idx = 0
+    if train_params.resume:
+        training_state = checkpoint_manager.restore(policy)
+        if training_state is None:
+            print("\n🛑 No checkpoint found to resume training '{}'.".format(training_id))
+            exit(1)
+        start_episode_idx = training_state["episode_idx"] + num_envs
+        eps_start = training_state["eps"]
+        smoothed_normalized_score = training_state["smoothed_normalized_score"]
+        smoothed_completion = training_state["smoothed_completion"]
+        smoothed_eval_normalized_score = training_state["smoothed_eval_normalized_score"]
+        smoothed_eval_completion = training_state["smoothed_eval_completion"]
+        print("\n🔁 Resuming training '{}' from episode {}".format(training_id, training_state["episode_idx"]))
 
     hdd = psutil.disk_usage('/')
     if save_replay_buffer and (hdd.free / (2 ** 30)) < 500.0:
@@ -169,122 +338,167 @@ def train_agent(train_params, train_env_params, eval_env_params, obs_params):
 
     training_timer = Timer()
     training_timer.start()
+    learn_totals = {name: 0.0 for name in policy.learn_timers}
+
+    # Timers and counters of each iteration, also appended to a JSON lines file next to the TensorBoard logs
+    timers = TimerRegistry()
+    timers_file = os.path.join(writer.get_logdir(), "timers.jsonl")
+
+    def log_evaluation(eval_episode_idx, scores, completions, nb_steps_eval):
+        nonlocal smoothed_eval_normalized_score, smoothed_eval_completion
+
+        print("\t✅ Eval (episode {}): score {:.3f} done {:.1f}%".format(eval_episode_idx, np.mean(scores), np.mean(completions) * 100.0))
+        write_evaluation(writer, eval_episode_idx, scores, completions, nb_steps_eval)
 
-    print("\n🚉 Training {} trains on {}x{} grid for {} episodes, evaluating on {} episodes every {} episodes. Training id '{}'.\n".format(
-        train_env.get_num_agents(),
+        smoothing = 0.9
+        smoothed_eval_normalized_score = smoothed_eval_normalized_score * smoothing + np.mean(scores) * (1.0 - smoothing)
+        smoothed_eval_completion = smoothed_eval_completion * smoothing + np.mean(completions) * (1.0 - smoothing)
+        writer.add_scalar("evaluation/smoothed_score", smoothed_eval_normalized_score, eval_episode_idx)
+        writer.add_scalar("evaluation/smoothed_completion", smoothed_eval_completion, eval_episode_idx)
+
+    print("\n🚉 Training {} trains on {}x{} grid for {} episodes in {} envs, evaluating on {} episodes every {} episodes. Training id '{}'.\n".format(
+        n_agents,
         x_dim, y_dim,
         n_episodes,
+        num_envs,
         n_eval_episodes,
         checkpoint_interval,
         training_id
     ))
 
-    for episode_idx in range(n_episodes + 1):
-        step_timer = Timer()
-        reset_timer = Timer()
-        learn_timer = Timer()
-        preproc_timer = Timer()
-        inference_timer = Timer()
+    # Each iteration runs one episode in each training env
+    for episode_idx in range(start_episode_idx, n_episodes + 1, num_envs):
+        timers.reset()
+        reset_timer, step_async_timer, step_timer, learn_timer, preproc_timer, inference_timer, checkpoint_timer = (
+            timers[name] for name in ("reset", "step_async", "step", "learn", "preproc", "inference", "checkpoint")
+        )
+        n_updates = policy.n_updates
+
+        # True if one of the episodes of this iteration is at a checkpoint interval
+        is_checkpoint = (-episode_idx) % checkpoint_interval < num_envs
+        render = train_params.render and is_checkpoint
 
-        # Reset environment
+        # Reset environments
         reset_timer.start()
-        obs, info = train_env.reset(regenerate_rail=True, regenerate_schedule=True)
+        max_steps = train_env.reset()
         reset_timer.end()
 
-        if train_params.render:
-            env_renderer.set_new_rail()
-
-        score = 0
-        nb_steps = 0
+        score = np.zeros(num_envs)
+        nb_steps = np.zeros(num_envs, dtype=int)
         actions_taken = []
 
         # Build initial agent-specific observations
-        for agent in train_env.get_agent_handles():
-            if obs[agent]:
-                agent_obs[agent] = normalize_observation(obs[agent], observation_tree_depth, observation_radius=observation_radius)
-                agent_prev_obs[agent] = agent_obs[agent].copy()
+        preproc_timer.start()
+        agent_obs[:] = train_env.observations
+        agent_prev_obs[:] = agent_obs
+        preproc_timer.end()
 
-        # Run episode
-        for step in range(max_steps - 1):
+        # Envs which are still running, an env runs for at most its max number of steps - 1
+        running = np.ones(num_envs, dtype=bool)
+        pending_experiences = None
+
+        # Run episodes
+        for step in range(np.max(max_steps) - 1):
             inference_timer.start()
-            for agent in train_env.get_agent_handles():
-                if info['action_required'][agent]:
-                    update_values[agent] = True
-                    action = policy.act(agent_obs[agent], eps=eps_start)
-
-                    action_count[action] += 1
-                    actions_taken.append(action)
-                else:
-                    # An action is not required if the train hasn't joined the railway network,
-                    # if it already reached its target, or if is currently malfunctioning.
-                    update_values[agent] = False
-                    action = 0
-                action_dict.update({agent: action})
+            # An action is not required if the train hasn't joined the railway network,
+            # if it already reached its target, or if is currently malfunctioning.
+            update_values = train_env.action_required & running[:, np.newaxis]
+
+            actions = policy.act_batch(agent_obs.reshape(-1, state_size), eps=eps_start, mask=update_values.ravel())
+            actions = actions.reshape(num_envs, n_agents)
+            action_count += np.bincount(actions[update_values], minlength=action_size)
+            actions_taken.extend(actions[update_values].tolist())
             inference_timer.end()
+            timers.count("inferences")
+            timers.count("agent_steps", np.count_nonzero(update_values))
+            timers.count("env_steps", np.count_nonzero(running))
 
-            # Environment step
-            step_timer.start()
-            next_obs, all_rewards, done, info = train_env.step(action_dict, reward_shaping=True)
-            # next_obs, all_rewards, done, info = train_env.step(action_dict)
+            # Environment step, the experiences of the previous step are learned while the envs are stepping
+            step_async_timer.start()
+            train_env.step_async(actions, running)
+            step_async_timer.end()
+
+            if pending_experiences is not None:
+                learn_timer.start()
+                policy.step_batch(*pending_experiences)
+                learn_timer.end()
 
+            step_timer.start()
+            train_env.step_wait()
             step_timer.end()
 
             # Render an episode at some interval
-            if train_params.render and episode_idx % checkpoint_interval == 0:
-                env_renderer.render_env(
-                    show=True,
-                    frames=False,
-                    show_observations=False,
-                    show_predictions=False
-                )
+            if render:
+                train_env.render()
 
             # Update replay buffer and train agent
-            for agent in train_env.get_agent_handles():
-                if update_values[agent] or done['__all__']:
-                    # Only learn from timesteps where somethings happened
-                    learn_timer.start()
-                    policy.step(agent_prev_obs[agent], agent_prev_action[agent], all_rewards[agent], agent_obs[agent], done[agent])
-                    learn_timer.end()
-
-                    agent_prev_obs[agent] = agent_obs[agent].copy()
-                    agent_prev_action[agent] = action_dict[agent]
+            # Only learn from timesteps where somethings happened
+            rewards = train_env.rewards
+            dones = train_env.dones
+            learning = (update_values | train_env.dones_all[:, np.newaxis]) & running[:, np.newaxis]
 
-                # Preprocess the new observations
-                if next_obs[agent]:
-                    preproc_timer.start()
-                    agent_obs[agent] = normalize_observation(next_obs[agent], observation_tree_depth, observation_radius=observation_radius)
-                    preproc_timer.end()
+            pending_experiences = (agent_prev_obs[learning], agent_prev_action[learning], rewards[learning], agent_obs[learning], dones[learning])
 
-                score += all_rewards[agent]
+            agent_prev_obs[learning] = agent_obs[learning]
+            agent_prev_action[learning] = actions[learning]
+            score[running] += np.sum(rewards[running], axis=1)
+            nb_steps[running] = step
 
-            nb_steps = step
+            # Copy the new observations, normalized by the workers
+            preproc_timer.start()
+            agent_obs[running] = train_env.observations[running]
+            preproc_timer.end()
 
-            if done['__all__']:
+            running &= ~train_env.dones_all & (step + 2 < max_steps)
+            if not np.any(running):
                 break
 
-        # Epsilon decay
-        eps_start = max(eps_end, eps_decay * eps_start)
+        if pending_experiences is not None:
+            learn_timer.start()
+            policy.step_batch(*pending_experiences)
+            learn_timer.end()
+        timers.count("learn_steps", policy.n_updates - n_updates)
+
+        env_timers = train_env.get_timers()
+
+        # Epsilon decay, once per episode
+        for _ in range(num_envs):
+            eps_start = max(eps_end, eps_decay * eps_start)
 
         # Collect information about training
-        tasks_finished = sum(done[idx] for idx in train_env.get_agent_handles())
-        completion = tasks_finished / max(1, train_env.get_num_agents())
-        normalized_score = score / (max_steps * train_env.get_num_agents())
+        tasks_finished = np.sum(train_env.dones, axis=1)
+        completions = tasks_finished / max(1, n_agents)
+        normalized_scores = score / (max_steps * n_agents)
+        completion = np.mean(completions)
+        normalized_score = np.mean(normalized_scores)
         action_probs = action_count / np.sum(action_count)
-        action_count = [1] * action_size
+        action_count = np.ones(action_size, dtype=int)
 
         smoothing = 0.99
-        smoothed_normalized_score = smoothed_normalized_score * smoothing + normalized_score * (1.0 - smoothing)
-        smoothed_completion = smoothed_completion * smoothing + completion * (1.0 - smoothing)
+        for env_normalized_score, env_completion in zip(normalized_scores, completions):
+            smoothed_normalized_score = smoothed_normalized_score * smoothing + env_normalized_score * (1.0 - smoothing)
+            smoothed_completion = smoothed_completion * smoothing + env_completion * (1.0 - smoothing)
 
         # Print logs
-        if episode_idx % checkpoint_interval == 0:
-            torch.save(policy.qnetwork_local, './baselines/checkpoints/multi-' + training_id + '-' + str(episode_idx) + '.pth')
+        if is_checkpoint:
+            # Time the training loop is stalled by the checkpoint
+            checkpoint_timer.start()
+            checkpoint_manager.save(
+                episode_idx, policy,
+                eps=eps_start,
+                smoothed_normalized_score=smoothed_normalized_score,
+                smoothed_completion=smoothed_completion,
+                smoothed_eval_normalized_score=smoothed_eval_normalized_score,
+                smoothed_eval_completion=smoothed_eval_completion
+            )
 
             if save_replay_buffer:
-                policy.save_replay_buffer('./baselines/checkpoints/multi-' + training_id + '-' + str(episode_idx) + '.pkl')
+                # Experiences are appended to the same directory at every checkpoint
+                policy.save_replay_buffer('./baselines/replay_buffers/multi-' + training_id)
+            checkpoint_timer.end()
 
-            if train_params.render:
-                env_renderer.close_window()
+            if render:
+                train_env.render(close=True)
 
         print(
             '\r🚂 Episode {}'
@@ -304,37 +518,23 @@ def train_agent(train_params, train_env_params, eval_env_params, obs_params):
             ), end=" ")
 
         # Evaluate policy and log results at some interval
-        if episode_idx % checkpoint_interval == 0 and n_eval_episodes > 0:
-            scores, completions, nb_steps_eval = eval_policy(eval_env, policy, train_params, obs_params)
-
-            writer.add_scalar("evaluation/scores_min", np.min(scores), episode_idx)
-            writer.add_scalar("evaluation/scores_max", np.max(scores), episode_idx)
-            writer.add_scalar("evaluation/scores_mean", np.mean(scores), episode_idx)
-            writer.add_scalar("evaluation/scores_std", np.std(scores), episode_idx)
-            writer.add_histogram("evaluation/scores", np.array(scores), episode_idx)
-            writer.add_scalar("evaluation/completions_min", np.min(completions), episode_idx)
-            writer.add_scalar("evaluation/completions_max", np.max(completions), episode_idx)
-            writer.add_scalar("evaluation/completions_mean", np.mean(completions), episode_idx)
-            writer.add_scalar("evaluation/completions_std", np.std(completions), episode_idx)
-            writer.add_histogram("evaluation/completions", np.array(completions), episode_idx)
-            writer.add_scalar("evaluation/nb_steps_min", np.min(nb_steps_eval), episode_idx)
-            writer.add_scalar("evaluation/nb_steps_max", np.max(nb_steps_eval), episode_idx)
-            writer.add_scalar("evaluation/nb_steps_mean", np.mean(nb_steps_eval), episode_idx)
-            writer.add_scalar("evaluation/nb_steps_std", np.std(nb_steps_eval), episode_idx)
-            writer.add_histogram("evaluation/nb_steps", np.array(nb_steps_eval), episode_idx)
-
-            smoothing = 0.9
-            smoothed_eval_normalized_score = smoothed_eval_normalized_score * smoothing + np.mean(scores) * (1.0 - smoothing)
-            smoothed_eval_completion = smoothed_eval_completion * smoothing + np.mean(completions) * (1.0 - smoothing)
-            writer.add_scalar("evaluation/smoothed_score", smoothed_eval_normalized_score, episode_idx)
-            writer.add_scalar("evaluation/smoothed_completion", smoothed_eval_completion, episode_idx)
+        if is_checkpoint and n_eval_episodes > 0:
+            if evaluator is not None:
+                evaluator.submit(episode_idx, policy.qnetwork_local)
+            else:
+                log_evaluation(episode_idx, *eval_policy(eval_env, policy, train_params, eval_env_params, obs_params))
+
+        # Evaluations finished in the background are reported for the episode they were started at
+        if evaluator is not None:
+            for evaluation in evaluator.collect():
+                log_evaluation(*evaluation)
 
         # Save logs to tensorboard
         writer.add_scalar("training/score", normalized_score, episode_idx)
         writer.add_scalar("training/smoothed_score", smoothed_normalized_score, episode_idx)
         writer.add_scalar("training/completion", np.mean(completion), episode_idx)
         writer.add_scalar("training/smoothed_completion", np.mean(smoothed_completion), episode_idx)
-        writer.add_scalar("training/nb_steps", nb_steps, episode_idx)
+        writer.add_scalar("training/nb_steps", np.mean(nb_steps), episode_idx)
         writer.add_histogram("actions/distribution", np.array(actions_taken), episode_idx)
         writer.add_scalar("actions/nothing", action_probs[RailEnvActions.DO_NOTHING], episode_idx)
         writer.add_scalar("actions/left", action_probs[RailEnvActions.MOVE_LEFT], episode_idx)
@@ -344,77 +544,497 @@ def train_agent(train_params, train_env_params, eval_env_params, obs_params):
         writer.add_scalar("training/epsilon", eps_start, episode_idx)
         writer.add_scalar("training/buffer_size", len(policy.memory), episode_idx)
         writer.add_scalar("training/loss", policy.loss, episode_idx)
-        writer.add_scalar("timer/reset", reset_timer.get(), episode_idx)
-        writer.add_scalar("timer/step", step_timer.get(), episode_idx)
-        writer.add_scalar("timer/learn", learn_timer.get(), episode_idx)
-        writer.add_scalar("timer/preproc", preproc_timer.get(), episode_idx)
+        timers.write_tensorboard(writer, episode_idx)
+        timers.write_jsonl(timers_file, episode_idx=episode_idx)
+        # Time the learning spent getting its minibatches versus computing the updates
+        for name, timer in policy.learn_timers.items():
+            learn_totals[name] += timer.get()
+            writer.add_scalar("timer/learn_" + name, timer.get(), episode_idx)
+            timer.reset()
+        writer.add_scalar("timer/env_reset", np.mean(env_timers["reset"]), episode_idx)
+        writer.add_scalar("timer/env_step", np.mean(env_timers["step"]), episode_idx)
+        writer.add_scalar("timer/env_preproc", np.mean(env_timers["preproc"]), episode_idx)
         writer.add_scalar("timer/total", training_timer.get_current(), episode_idx)
 
+    train_env.close()
+    checkpoint_manager.close()
+    policy.close()
+
+    if evaluator is not None:
+        for evaluation in evaluator.collect(wait=True):
+            log_evaluation(*evaluation)
+        evaluator.close()
+
+    print("\n\n⏱️  Learning: {}".format(format_learn_times(learn_totals)))
+
+
+class SharedWeights:
+    """
+    Copy of the network weights in shared memory, published by the learner and pulled by the actors.
+    """
+
+    def __init__(self, model):
+        n_params = sum(param.numel() for param in model.parameters())
+        self._weights = multiprocessing.RawArray('f', n_params)
+        self._version = multiprocessing.RawValue('l', 0)
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def version(self):
+        return self._version.value
+
+    def publish(self, model):
+        weights = torch.nn.utils.parameters_to_vector(model.parameters()).detach().cpu().numpy()
+        with self._lock:
+            np.frombuffer(self._weights, dtype=np.float32)[:] = weights
+            self._version.value += 1
+
+    def pull(self, model, version):
+        """
+        Copies the published weights into the model if they are more recent than its version
+        :return: the version of the model weights
+        """
+        if self.version == version:
+            return version
+
+        with self._lock:
+            weights = torch.from_numpy(np.frombuffer(self._weights, dtype=np.float32).copy())
+            version = self._version.value
+        torch.nn.utils.vector_to_parameters(weights, model.parameters())
+        return version
+
+
+def run_actor(index, train_params, train_env_params, obs_params, state_size, action_size, weights, episode_counter, experience_queue):
+    """
+    Runs training episodes with a CPU copy of the learner network, refreshed whenever the learner publishes new
+    weights, and sends the experiences and the statistics of each episode to the learner.
+    """
+    torch.set_num_threads(1)
 
-def format_action_prob(action_probs):
-    action_probs = np.round(action_probs, 3)
-    actions = ["↻", "←", "↑", "→", "◼"]
+    n_agents = train_env_params.n_agents
+    observation_tree_depth = obs_params.observation_tree_depth
+    observation_radius = obs_params.observation_radius
 
-    buffer = ""
-    for action, action_prob in zip(actions, action_probs):
-        buffer += action + " " + "{:.3f}".format(action_prob) + " "
+    env = create_training_env(train_params, train_env_params, obs_params, index)
 
-    return buffer
+    policy = create_inference_policy(state_size, action_size, train_params)
+    version = weights.pull(policy.qnetwork_local, 0)
 
+    agent_obs = np.zeros((n_agents, state_size), dtype=np.float32)
+    agent_prev_obs = np.zeros((n_agents, state_size), dtype=np.float32)
+    agent_prev_action = np.full(n_agents, 2)
+    update_values = np.zeros(n_agents, dtype=bool)
 
-def eval_policy(env:RailEnv, policy, train_params, obs_params):
-    n_eval_episodes = train_params.n_evaluation_episodes
-    max_steps = env._max_episode_steps
-    tree_depth = obs_params.observation_tree_depth
-    observation_radius = obs_params.observation_radius
+    while True:
+        with episode_counter.get_lock():
+            episode_idx = episode_counter.value
+            episode_counter.value += 1
+        if episode_idx > train_params.n_episodes:
+            break
 
-    action_dict = dict()
-    scores = []
-    completions = []
-    nb_steps = []
+        # Same epsilon as decaying it after every episode
+        eps = max(train_params.eps_end, train_params.eps_start * train_params.eps_decay ** episode_idx)
 
-    for episode_idx in range(n_eval_episodes):
-        agent_obs = [None] * env.get_num_agents()
-        score = 0.0
+        timers = {name: Timer() for name in ACTOR_TIMERS}
 
+        timers["reset"].start()
         obs, info = env.reset(regenerate_rail=True, regenerate_schedule=True)
+        max_steps = env._max_episode_steps
+        timers["reset"].end()
 
-        final_step = 0
+        score = 0
+        nb_steps = 0
+        action_count = np.zeros(action_size, dtype=int)
+
+        timers["preproc"].start()
+        observed = [agent for agent in env.get_agent_handles() if obs[agent]]
+        normalize_observations(obs, observed, observation_tree_depth, observation_radius=observation_radius, out=agent_obs)
+        agent_prev_obs[observed] = agent_obs[observed]
+        timers["preproc"].end()
 
         for step in range(max_steps - 1):
+            timers["inference"].start()
+            version = weights.pull(policy.qnetwork_local, version)
             for agent in env.get_agent_handles():
-                if obs[agent]:
-                    agent_obs[agent] = normalize_observation(obs[agent], tree_depth=tree_depth, observation_radius=observation_radius)
+                update_values[agent] = info['action_required'][agent]
 
-                action = 0
-                if info['action_required'][agent]:
-                    action = policy.act(agent_obs[agent], eps=0.0)
-                action_dict.update({agent: action})
+            actions = policy.act_batch(agent_obs, eps=eps, mask=update_values)
+            action_count += np.bincount(actions[update_values], minlength=action_size)
+            timers["inference"].end()
 
-            # obs, all_rewards, done, info = env.step(action_dict)
-            obs, all_rewards, done, info = env.step(action_dict, reward_shaping=False)
+            timers["step"].start()
+            next_obs, _, done, info = env.step(dict(enumerate(actions.tolist())), reward_shaping=True)
+            timers["step"].end()
 
+            # Only learn from timesteps where somethings happened
+            rewards = env.step_rewards
+            learning = update_values | done['__all__']
 
-            for agent in env.get_agent_handles():
-                score += all_rewards[agent]
-                # if step%1 == 0:
-                #     print(f"Agent: {agent} has the score: {score}")
+            timers["send"].start()
+            if np.any(learning):
+                experience_queue.put(("experiences", (
+                    agent_prev_obs[learning], agent_prev_action[learning], rewards[learning], agent_obs[learning], env.agent_dones[learning]
+                )))
+            timers["send"].end()
+
+            agent_prev_obs[learning] = agent_obs[learning]
+            agent_prev_action[learning] = actions[learning]
+            score += np.sum(rewards)
+
+            timers["preproc"].start()
+            observed = [agent for agent in env.get_agent_handles() if next_obs[agent]]
+            normalize_observations(next_obs, observed, observation_tree_depth, observation_radius=observation_radius, out=agent_obs)
+            timers["preproc"].end()
 
-            final_step = step
+            nb_steps = step
 
             if done['__all__']:
                 break
 
-        normalized_score = score / (max_steps * env.get_num_agents())
-        scores.append(normalized_score)
+        experience_queue.put(("episode", {
+            "episode_idx": episode_idx,
+            "actor": index,
+            "normalized_score": score / (max_steps * n_agents),
+            "completion": np.sum(env.agent_dones) / max(1, n_agents),
+            "nb_steps": nb_steps,
+            "eps": eps,
+            "action_count": action_count,
+            "weights_version": version,
+            "timers": {name: timer.get() for name, timer in timers.items()},
+        }))
+
+    experience_queue.put(("done", index))
+
+
+def _receive_messages(experience_queue, block, max_messages=100):
+    """
+    Gets the messages waiting in the queue, waiting for one if block is True
+    """
+    messages = []
+    try:
+        if block:
+            messages.append(experience_queue.get(timeout=1.0))
+        while len(messages) < max_messages:
+            messages.append(experience_queue.get_nowait())
+    except Empty:
+        pass
+    return messages
+
+
+def train_agent_async(train_params, train_env_params, eval_env_params, obs_params):
+    """
+    Trains with several actor processes running episodes while this process, the learner, trains continuously
+    on the experiences they send. The weights are published to the actors every broadcast_interval updates.
+    """
+    n_agents = train_env_params.n_agents
+    x_dim = train_env_params.x_dim
+    y_dim = train_env_params.y_dim
+    seed = train_env_params.seed
 
-        tasks_finished = sum(done[idx] for idx in env.get_agent_handles())
-        completion = tasks_finished / max(1, env.get_num_agents())
-        completions.append(completion)
+    # Unique ID for this training, a resumed training keeps its ID
+    now = datetime.now()
+    training_id = train_params.resume or now.strftime('%y%m%d%H%M%S')
 
-        nb_steps.append(final_step)
+    observation_tree_depth = obs_params.observation_tree_depth
+    n_episodes = train_params.n_episodes
+    checkpoint_interval = train_params.checkpoint_interval
+    n_eval_episodes = train_params.n_evaluation_episodes
+    num_actors = train_params.num_actors
+    broadcast_interval = train_params.broadcast_interval
+
+    random.seed(seed)
+    np.random.seed(seed)
+
+    eval_env = create_env(eval_env_params, obs_params, create_env_cache(train_params, eval_env_params), train_params.vectorized_step, train_params.partial_observations)
+    eval_env.reset(regenerate_schedule=True, regenerate_rail=True)
+
+    n_features_per_node = eval_env.obs_builder.observation_dim
+    n_nodes = sum([np.power(4, i) for i in range(observation_tree_depth + 1)])
+    state_size = n_features_per_node * n_nodes
+    action_size = 5
+
+    evaluator = create_evaluator(train_params, eval_env_params, obs_params, state_size, action_size)
+    policy = DDDQNPolicy(state_size, action_size, train_params)
+
+    if train_params.restore_replay_buffer:
+        try:
+            policy.load_replay_buffer(train_params.restore_replay_buffer)
+            policy.test()
+        except RuntimeError as e:
+            print("\n🛑 Could't load replay buffer, were the experiences generated using the same tree depth?")
+            print(e)
+            exit(1)
+
+    print("\n💾 Replay buffer status: {}/{} experiences".format(len(policy.memory), train_params.buffer_size))
+
+    # Checkpoints are written in the background, resuming restores the newest one
+    checkpoint_manager = CheckpointManager('./baselines/checkpoints', training_id, keep=train_params.keep_checkpoints, **vars(obs_params))
+    training_state = None
+    if train_params.resume:
+        training_state = checkpoint_manager.restore(policy)
+        if training_state is None:
+            print("\n🛑 No checkpoint found to resume training '{}'.".format(training_id))
+            exit(1)
+        print("\n🔁 Resuming training '{}' from episode {}".format(training_id, training_state["episode_idx"]))
+
+    writer = SummaryWriter()
+    writer.add_hparams(vars(train_params), {})
+    writer.add_hparams(vars(train_env_params), {})
+    writer.add_hparams(vars(obs_params), {})
+
+    print("\n🚉 Training {} trains on {}x{} grid for {} episodes with {} actors, evaluating on {} episodes every {} episodes. Training id '{}'.\n".format(
+        n_agents,
+        x_dim, y_dim,
+        n_episodes,
+        num_actors,
+        n_eval_episodes,
+        checkpoint_interval,
+        training_id
+    ))
+
+    # Start the actors with the initial weights
+    weights = SharedWeights(policy.qnetwork_local)
+    weights.publish(policy.qnetwork_local)
+    episode_counter = multiprocessing.Value('l', 0 if training_state is None else training_state["episode_idx"] + 1)
+    experience_queue = multiprocessing.Queue(maxsize=1000)
+    actors = [
+        multiprocessing.Process(
+            target=run_actor,
+            args=(index, train_params, train_env_params, obs_params, state_size, action_size, weights, episode_counter, experience_queue),
+            daemon=True
+        )
+        for index in range(num_actors)
+    ]
+    for actor in actors:
+        actor.start()
+
+    training_timer = Timer()
+    training_timer.start()
+
+    # Timers and counters of the learner since the previous episode, also appended to a JSON lines file next to the
+    # TensorBoard logs
+    learner_timers = TimerRegistry()
+    timers_file = os.path.join(writer.get_logdir(), "timers.jsonl")
+    actor_totals = {name: 0.0 for name in ACTOR_TIMERS}
+    learner_totals = {name: 0.0 for name in LEARNER_TIMERS}
+    learn_totals = {name: 0.0 for name in policy.learn_timers}
+
+    smoothed_normalized_score = -1.0
+    smoothed_eval_normalized_score = -1.0
+    smoothed_completion = 0.0
+    smoothed_eval_completion = 0.0
+    if training_state is not None:
+        smoothed_normalized_score = training_state["smoothed_normalized_score"]
+        smoothed_completion = training_state["smoothed_completion"]
+        smoothed_eval_normalized_score = training_state["smoothed_eval_normalized_score"]
+        smoothed_eval_completion = training_state["smoothed_eval_completion"]
+
+    n_updates = 0 if training_state is None else training_state["n_updates"]
+    n_experiences = 0
+    n_env_steps = 0
+
+    def log_evaluation(eval_episode_idx, scores, completions, nb_steps_eval):
+        nonlocal smoothed_eval_normalized_score, smoothed_eval_completion
+
+        print("\t✅ Eval (episode {}): score {:.3f} done {:.1f}%".format(eval_episode_idx, np.mean(scores), np.mean(completions) * 100.0))
+        write_evaluation(writer, eval_episode_idx, scores, completions, nb_steps_eval)
+
+        smoothing = 0.9
+        smoothed_eval_normalized_score = smoothed_eval_normalized_score * smoothing + np.mean(scores) * (1.0 - smoothing)
+        smoothed_eval_completion = smoothed_eval_completion * smoothing + np.mean(completions) * (1.0 - smoothing)
+        writer.add_scalar("evaluation/smoothed_score", smoothed_eval_normalized_score, eval_episode_idx)
+        writer.add_scalar("evaluation/smoothed_completion", smoothed_eval_completion, eval_episode_idx)
+
+    def log_episode(stats):
+        nonlocal smoothed_normalized_score, smoothed_completion
+
+        episode_idx = stats["episode_idx"]
+        normalized_score = stats["normalized_score"]
+        completion = stats["completion"]
+        action_probs = (stats["action_count"] + 1) / np.sum(stats["action_count"] + 1)
+
+        smoothing = 0.99
+        smoothed_normalized_score = smoothed_normalized_score * smoothing + normalized_score * (1.0 - smoothing)
+        smoothed_completion = smoothed_completion * smoothing + completion * (1.0 - smoothing)
 
-    print("\t✅ Eval: score {:.3f} done {:.1f}%".format(np.mean(scores), np.mean(completions) * 100.0))
+        if episode_idx % checkpoint_interval == 0:
+            learner_timers["checkpoint"].start()
+            checkpoint_manager.save(
+                episode_idx, policy,
+                eps=stats["eps"],
+                n_updates=n_updates,
+                smoothed_normalized_score=smoothed_normalized_score,
+                smoothed_completion=smoothed_completion,
+                smoothed_eval_normalized_score=smoothed_eval_normalized_score,
+                smoothed_eval_completion=smoothed_eval_completion
+            )
+
+            if train_params.save_replay_buffer:
+                policy.save_replay_buffer('./baselines/replay_buffers/multi-' + training_id)
+            learner_timers["checkpoint"].end()
+
+        print(
+            '\r🚂 Episode {}'
+            '\t 🏆 Score: {:.3f}'
+            ' Avg: {:.3f}'
+            '\t 💯 Done: {:.2f}%'
+            ' Avg: {:.2f}%'
+            '\t 🎲 Epsilon: {:.3f} '
+            '\t 🔀 Action Probs: {}'
+            '\t 🔄 Updates: {}'.format(
+                episode_idx,
+                normalized_score,
+                smoothed_normalized_score,
+                100 * completion,
+                100 * smoothed_completion,
+                stats["eps"],
+                format_action_prob(action_probs),
+                n_updates
+            ), end=" ")
+
+        if episode_idx % checkpoint_interval == 0 and n_eval_episodes > 0:
+            if evaluator is not None:
+                evaluator.submit(episode_idx, policy.qnetwork_local)
+            else:
+                log_evaluation(episode_idx, *eval_policy(eval_env, policy, train_params, eval_env_params, obs_params))
+
+        writer.add_scalar("training/score", normalized_score, episode_idx)
+        writer.add_scalar("training/smoothed_score", smoothed_normalized_score, episode_idx)
+        writer.add_scalar("training/completion", completion, episode_idx)
+        writer.add_scalar("training/smoothed_completion", smoothed_completion, episode_idx)
+        writer.add_scalar("training/nb_steps", stats["nb_steps"], episode_idx)
+        writer.add_scalar("training/epsilon", stats["eps"], episode_idx)
+        writer.add_scalar("training/buffer_size", len(policy.memory), episode_idx)
+        writer.add_scalar("training/loss", policy.loss, episode_idx)
+        writer.add_scalar("training/updates", n_updates, episode_idx)
+        writer.add_scalar("training/weights_lag", weights.version - stats["weights_version"], episode_idx)
+        writer.add_scalar("actions/nothing", action_probs[RailEnvActions.DO_NOTHING], episode_idx)
+        writer.add_scalar("actions/left", action_probs[RailEnvActions.MOVE_LEFT], episode_idx)
+        writer.add_scalar("actions/forward", action_probs[RailEnvActions.MOVE_FORWARD], episode_idx)
+        writer.add_scalar("actions/right", action_probs[RailEnvActions.MOVE_RIGHT], episode_idx)
+        writer.add_scalar("actions/stop", action_probs[RailEnvActions.STOP_MOVING], episode_idx)
+
+        # Time spent by each role, the learner times are the ones since the previous episode
+        for name, time_spent in stats["timers"].items():
+            actor_totals[name] += time_spent
+            writer.add_scalar("timer/actor_" + name, time_spent, episode_idx)
+        for name, timer in learner_timers.timers.items():
+            learner_totals[name] += timer.get()
+        for name, timer in policy.learn_timers.items():
+            learn_totals[name] += timer.get()
+            writer.add_scalar("timer/learn_" + name, timer.get(), episode_idx)
+            timer.reset()
+        writer.add_scalar("timer/total", training_timer.get_current(), episode_idx)
+
+        # Learner timers and throughput since the previous episode
+        learner_timers.write_tensorboard(writer, episode_idx, prefix="timer/learner_")
+        learner_timers.write_jsonl(timers_file, episode_idx=episode_idx)
+        learner_timers.reset()
+
+    running_actors = num_actors
+    learned = False
+    updates_since_broadcast = 0
+    while running_actors > 0:
+        # Only wait for experiences when there is nothing to learn from
+        learner_timers["receive"].start()
+        messages = _receive_messages(experience_queue, block=not learned)
+        learner_timers["receive"].end()
+
+        if not messages and not any(actor.is_alive() for actor in actors):
+            print("\n🛑 All the actors stopped unexpectedly.")
+            break
+
+        for kind, data in messages:
+            if kind == "experiences":
+                learner_timers["store"].start()
+                policy.add_experiences(*data)
+                learner_timers["store"].end()
+                n_experiences += len(data[0])
+                learner_timers.count("agent_steps", len(data[0]))
+            elif kind == "episode":
+                n_env_steps += data["nb_steps"] + 1
+                learner_timers.count("env_steps", data["nb_steps"] + 1)
+                learner_timers.count("inferences", data["nb_steps"] + 1)
+                log_episode(data)
+            elif kind == "done":
+                running_actors -= 1
+
+        if evaluator is not None:
+            for evaluation in evaluator.collect():
+                log_evaluation(*evaluation)
+
+        learner_timers["learn"].start()
+        learned = policy.learn()
+        learner_timers["learn"].end()
+
+        if learned:
+            n_updates += policy.gradient_steps
+            learner_timers.count("learn_steps", policy.gradient_steps)
+            updates_since_broadcast += policy.gradient_steps
+            if updates_since_broadcast >= broadcast_interval:
+                learner_timers["broadcast"].start()
+                weights.publish(policy.qnetwork_local)
+                learner_timers["broadcast"].end()
+                updates_since_broadcast = 0
+
+    for actor in actors:
+        actor.join()
+    checkpoint_manager.close()
+    policy.close()
+
+    if evaluator is not None:
+        for evaluation in evaluator.collect(wait=True):
+            log_evaluation(*evaluation)
+        evaluator.close()
+
+    total_time = training_timer.get_current()
+    for name, timer in learner_timers.timers.items():
+        learner_totals[name] += timer.get()
+    for name, timer in policy.learn_timers.items():
+        learn_totals[name] += timer.get()
+
+    print("\n\n⏱️  Actors ({}): {}".format(num_actors, "\t".join("{}: {:.1f}s".format(name, t) for name, t in actor_totals.items())))
+    print("⏱️  Learner: {}".format("\t".join("{}: {:.1f}s".format(name, t) for name, t in learner_totals.items())))
+    print("⏱️  Learning: {}".format(format_learn_times(learn_totals)))
+    print("⚡ {:.1f} env steps/s \t{:.1f} experiences/s \t{:.1f} updates/s in {:.1f}s".format(
+        n_env_steps / total_time, n_experiences / total_time, n_updates / total_time, total_time))
+
+
+def format_learn_times(learn_totals):
+    """
+    :param learn_totals: total time spent getting the minibatches ("sample") and computing the updates ("update")
+    :return: the times, and the share of the learning time spent waiting for minibatches
+    """
+    learn_time = max(sum(learn_totals.values()), 1e-9)
+    return "sample: {:.1f}s\tupdate: {:.1f}s\t({:.1f}% waiting for minibatches)".format(
+        learn_totals["sample"], learn_totals["update"], 100 * learn_totals["sample"] / learn_time)
+
+
+def format_action_prob(action_probs):
+    action_probs = np.round(action_probs, 3)
+    actions = ["↻", "←", "↑", "→", "◼"]
+
+    buffer = ""
+    for action, action_prob in zip(actions, action_probs):
+        buffer += action + " " + "{:.3f}".format(action_prob) + " "
+
+    return buffer
+
+
+def eval_policy(env:RailEnv, policy, train_params, env_params, obs_params):
+    n_eval_episodes = train_params.n_evaluation_episodes
+    tree_depth = obs_params.observation_tree_depth
+    observation_radius = obs_params.observation_radius
+
+    scores = []
+    completions = []
+    nb_steps = []
+
+    for seed in evaluation_seeds(env_params, n_eval_episodes):
+        normalized_score, completion, final_step = evaluate_episode(env, policy, tree_depth, observation_radius, random_seed=seed)
+        scores.append(normalized_score)
+        completions.append(completion)
+        nb_steps.append(final_step)
 
     return scores, completions, nb_steps
 
@@ -425,77 +1045,46 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--training_env_config", help="training config id (eg 0 for Test_0)", default=0, type=int)
     parser.add_argument("-e", "--evaluation_env_config", help="evaluation config id (eg 0 for Test_0)", default=0, type=int)
     parser.add_argument("--n_evaluation_episodes", help="number of evaluation episodes", default=25, type=int)
+    parser.add_argument("--evaluation_processes", help="number of processes evaluating in the background, 0 to evaluate synchronously", default=2, type=int)
     parser.add_argument("--checkpoint_interval", help="checkpoint interval", default=50, type=int)
     parser.add_argument("--eps_start", help="max exploration", default=1.0, type=float)  # max exploration
     parser.add_argument("--eps_end", help="min exploration", default=0.01, type=float)  # min exploration
     parser.add_argument("--eps_decay", help="exploration decay", default=0.99, type=float)  # the decay of the exploration
     parser.add_argument("--buffer_size", help="replay buffer size", default=int(1e5), type=int)
     parser.add_argument("--buffer_min_size", help="min buffer size to start training", default=0, type=int)
-    parser.add_argument("--restore_replay_buffer", help="replay buffer to restore", default="", type=str)
+    parser.add_argument("--restore_replay_buffer", help="replay buffer directory (or legacy .pkl file) to restore", default="", type=str)
     parser.add_argument("--save_replay_buffer", help="save replay buffer at each evaluation interval", default=False, type=bool)
+    parser.add_argument("--keep_checkpoints", help="number of most recent checkpoints kept, 0 to keep them all", default=5, type=int)
+    parser.add_argument("--resume", help="id of the training to resume from its newest checkpoint, empty to start a new training", default="", type=str)
+    parser.add_argument("--prioritized_replay", help="use prioritized experience replay", default=False, type=bool)
+    parser.add_argument("--priority_alpha", help="prioritization exponent (0 is uniform sampling)", default=0.6, type=float)
+    parser.add_argument("--priority_beta", help="initial importance sampling exponent", default=0.4, type=float)
+    parser.add_argument("--priority_beta_increment", help="importance sampling exponent increment per minibatch", default=1e-5, type=float)
     parser.add_argument("--batch_size", help="minibatch size", default=128, type=int)
     parser.add_argument("--gamma", help="discount factor", default=0.99, type=float)  # multiplier over the targets 
     parser.add_argument("--tau", help="soft update of target parameters", default=1e-3, type=float)  # we don't know X
+    parser.add_argument("--hard_update_interval", help="copy the network into the target network every N updates instead of soft updates, 0 for soft updates", default=0, type=int)
     parser.add_argument("--learning_rate", help="learning rate", default=0.5e-4, type=float)
     parser.add_argument("--hidden_size", help="hidden size (2 fc layers)", default=128, type=int)
+    parser.add_argument("--bf16_learn", help="run the forward passes of the network updates in bfloat16 autocast, CPU training only", default=False, type=bool)
+    parser.add_argument("--fused_network", help="fuse the value and advantage streams of the network, with the same Q-values and checkpoints", default=False, type=bool)
     parser.add_argument("--update_every", help="how often to update the network", default=8, type=int)
+    parser.add_argument("--gradient_steps", help="number of gradient steps each time the network is updated", default=1, type=int)
+    parser.add_argument("--prefetch_batches", help="number of minibatches sampled ahead by a background thread, 0 to sample them synchronously", default=0, type=int)
     parser.add_argument("--use_gpu", help="use GPU if available", default=True, type=bool)
     parser.add_argument("--num_threads", help="number of threads PyTorch can use", default=2, type=int)
     parser.add_argument("--render", help="render 1 episode in 100", default=False, type=bool)
+    parser.add_argument("--num_envs", help="number of training envs, each one is stepped in its own process", default=1, type=int)
+    parser.add_argument("--num_actors", help="number of actor processes feeding an asynchronous learner, 0 to train synchronously", default=0, type=int)
+    parser.add_argument("--broadcast_interval", help="number of learner updates between two weight broadcasts to the actors", default=50, type=int)
+    parser.add_argument("--env_cache", help="directory caching the generated envs, empty to generate every env", default="", type=str)
+    parser.add_argument("--env_cache_size", help="number of cached training envs, cycled through by the training workers", default=1000, type=int)
+    parser.add_argument("--vectorized_step", help="step the agents on NumPy arrays instead of RailEnv.step, with the same results", default=False, type=bool)
+    parser.add_argument("--partial_observations", help="only compute the observations of the agents which require an action", default=False, type=bool)
     training_params = parser.parse_args()
 
-    env_params = [
-        {
-        # Test_-1
-            "n_agents": 3,
-            "x_dim": 25,
-            "y_dim": 25,
-            "n_cities": 3,
-            "max_rails_between_cities": 3,
-            "max_rails_in_city": 3,
-            "malfunction_rate": 1 / 100,
-            "seed": 0
-        },
-        {
-            # Test_0
-            "n_agents": 4,
-            "x_dim": 30,
-            "y_dim": 30,
-            "n_cities": 4,
-            "max_rails_between_cities": 3,
-            "max_rails_in_city": 4,
-            "malfunction_rate": 1 / 100,
-            "seed": 0
-        },
-        {
-            # Test_1
-            "n_agents": 7,
-            "x_dim": 30,
-            "y_dim": 30,
-            "n_cities": 6,
-            "max_rails_between_cities": 5,
-            "max_rails_in_city": 6,
-            "malfunction_rate": 1 / 100,
-            "seed": 0
-        },
-        {
-            # Test_2
-            "n_agents": 20,
-            "x_dim": 30,
-            "y_dim": 30,
-            "n_cities": 3,
-            "max_rails_between_cities": 2,
-            "max_rails_in_city": 3,
-            "malfunction_rate": 1 / 200,
-            "seed": 0
-        },
-    ]
-
-    obs_params = {
-        "observation_tree_depth": 2,
-        "observation_radius": 10,
-        "observation_max_path_depth": 30
-    }
+    env_params = TRAINING_ENV_PARAMS
+    obs_params = OBSERVATION_PARAMS
 
     def check_env_config(id):
         if id >= len(env_params) or id < 0:
@@ -519,5 +1108,8 @@ if __name__ == "__main__":
     pprint(obs_params)
 
     os.environ["OMP_NUM_THREADS"] = str(training_params.num_threads)
-    train_agent(training_params, Namespace(**training_env_params), Namespace(**evaluation_env_params), Namespace(**obs_params))
+    if training_params.num_actors > 0:
+        train_agent_async(training_params, Namespace(**training_env_params), Namespace(**evaluation_env_params), Namespace(**obs_params))
+    else:
+        train_agent(training_params, Namespace(**training_env_params), Namespace(**evaluation_env_params), Namespace(**obs_params))
 
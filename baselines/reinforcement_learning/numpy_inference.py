@@ -0,0 +1,163 @@
+import json
+import os
+import random
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+base_dir = Path(__file__).resolve().parent.parent
+sys.path.append(str(base_dir))
+
+from reinforcement_learning.policy import Policy, epsilon_greedy_split
+
+# Layers of DuelingQNetwork, in the order they are applied in each stream
+VALUE_LAYERS = ("fc1_val", "fc2_val", "fc4_val")
+ADVANTAGE_LAYERS = ("fc1_adv", "fc2_adv", "fc4_adv")
+
+
+def export_weights(network, filename, metadata=None):
+    """
+    Saves the weights of a DuelingQNetwork to a .npz file, which NumpyDuelingQNetwork loads without torch
+    :param network: DuelingQNetwork or its state dict
+    :param metadata: optional dict of checkpoint metadata, see reinforcement_learning/checkpoint.py
+    """
+    state_dict = network.state_dict() if hasattr(network, "state_dict") else network
+    arrays = {name: tensor.detach().cpu().numpy().astype(np.float32) for name, tensor in state_dict.items()}
+    if metadata is not None:
+        arrays["metadata"] = np.array(json.dumps(metadata))
+    np.savez(filename, **arrays)
+
+
+def load_metadata(filename):
+    """
+    :return: dict of the metadata saved by export_weights, empty if there is none
+    """
+    with np.load(filename) as data:
+        return json.loads(data["metadata"].item()) if "metadata" in data.files else {}
+
+
+class NumpyDuelingQNetwork:
+    """
+    DuelingQNetwork forward pass in NumPy, which gives the same Q-values without importing torch.
+
+    The two streams are fused: the first layers of both streams are a single matmul, the second layers a single
+    batched matmul, and the value and advantage heads a single matmul with a block diagonal weight matrix.
+    """
+
+    def __init__(self, weights):
+        """
+        :param weights: dict of float32 arrays named like the DuelingQNetwork state dict, eg loaded from export_weights
+        """
+        (w1_val, w2_val, w4_val), (b1_val, b2_val, b4_val) = self._stream(weights, VALUE_LAYERS)
+        (w1_adv, w2_adv, w4_adv), (b1_adv, b2_adv, b4_adv) = self._stream(weights, ADVANTAGE_LAYERS)
+
+        self.state_size = w1_val.shape[0]
+        self.action_size = w4_adv.shape[1]
+        self.hidden_size1 = w1_val.shape[1]
+        self.hidden_size2 = w2_val.shape[1]
+
+        # (state_size, 2 * hidsize1): both first layers at once
+        self.w1 = np.ascontiguousarray(np.concatenate([w1_val, w1_adv], axis=1))
+        self.b1 = np.concatenate([b1_val, b1_adv])
+
+        # (2, hidsize1, hidsize2): one matrix per stream for a batched matmul
+        self.w2 = np.stack([w2_val, w2_adv])
+        self.b2 = np.stack([b2_val, b2_adv])[:, np.newaxis, :]
+
+        # (2 * hidsize2, 1 + action_size): value in the first column, advantages in the others
+        self.w4 = np.zeros((2 * self.hidden_size2, 1 + self.action_size), dtype=np.float32)
+        self.w4[:self.hidden_size2, :1] = w4_val
+        self.w4[self.hidden_size2:, 1:] = w4_adv
+        self.b4 = np.concatenate([b4_val, b4_adv])
+
+    @staticmethod
+    def _stream(weights, layers):
+        # nn.Linear stores (out_features, in_features) weights, the matmuls use their transpose
+        return (
+            [np.asarray(weights[layer + ".weight"], dtype=np.float32).T for layer in layers],
+            [np.asarray(weights[layer + ".bias"], dtype=np.float32) for layer in layers]
+        )
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls({name: data[name] for name in data.files})
+
+    def __call__(self, states: np.ndarray) -> np.ndarray:
+        """
+        :param states: array of shape (batch_size, state_size)
+        :return: Q-values, array of shape (batch_size, action_size)
+        """
+        states = np.asarray(states, dtype=np.float32)
+        batch_size = len(states)
+
+        hidden1 = states @ self.w1
+        hidden1 += self.b1
+        np.maximum(hidden1, 0, out=hidden1)
+
+        # (batch_size, 2 * hidsize1) -> (2, batch_size, hidsize1)
+        hidden2 = np.matmul(hidden1.reshape(batch_size, 2, self.hidden_size1).transpose(1, 0, 2), self.w2)
+        hidden2 += self.b2
+        np.maximum(hidden2, 0, out=hidden2)
+
+        # (2, batch_size, hidsize2) -> (batch_size, 2 * hidsize2)
+        heads = hidden2.transpose(1, 0, 2).reshape(batch_size, 2 * self.hidden_size2) @ self.w4
+        heads += self.b4
+
+        value, advantage = heads[:, :1], heads[:, 1:]
+        # Like DuelingQNetwork, the mean advantage is taken over the whole batch
+        return value + advantage - advantage.mean()
+
+
+class NumpyPolicy(Policy):
+    """Greedy policy running a NumpyDuelingQNetwork, for evaluation only"""
+
+    def __init__(self, network: NumpyDuelingQNetwork, metadata=None):
+        self.qnetwork_local = network
+        self.state_size = network.state_size
+        self.action_size = network.action_size
+        self.metadata = {} if metadata is None else metadata
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        :param filename: .npz file written by export_weights
+        """
+        if os.path.splitext(filename)[1] != ".npz":
+            raise ValueError("NumPy inference needs weights exported with reinforcement_learning/numpy_inference.py, got {}".format(filename))
+        return cls(NumpyDuelingQNetwork.load(filename), load_metadata(filename))
+
+    def act(self, state, eps=0.):
+        if random.random() > eps:
+            return np.argmax(self.qnetwork_local(state[np.newaxis]))
+        else:
+            return random.choice(np.arange(self.action_size))
+
+    def act_batch(self, states, eps=0., mask=None):
+        """
+        Same as DDDQNPolicy.act_batch
+        """
+        actions = np.zeros(len(states), dtype=np.int64)
+        greedy, explore = epsilon_greedy_split(len(states), eps, mask)
+
+        if len(greedy) > 0:
+            actions[greedy] = self.qnetwork_local(states[greedy]).argmax(1)
+
+        actions[explore] = np.random.randint(self.action_size, size=len(explore))
+        return actions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Exports the weights of a DuelingQNetwork checkpoint for NumPy inference")
+    parser.add_argument("-f", "--file", help="checkpoint to export", required=True, type=str)
+    parser.add_argument("-o", "--output", help="exported .npz file, defaults to the checkpoint name with a .npz extension", default=None, type=str)
+    args = parser.parse_args()
+
+    from reinforcement_learning.checkpoint import load_checkpoint
+
+    output = args.output if args.output is not None else os.path.splitext(args.file)[0] + ".npz"
+    state_dict, metadata = load_checkpoint(args.file)
+    export_weights(state_dict, output, metadata)
+    print("Weights exported to {}".format(output))
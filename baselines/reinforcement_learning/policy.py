@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class Policy:
     def step(self, state, action, reward, next_state, done):
         raise NotImplementedError
@@ -5,8 +8,24 @@ class Policy:
     def act(self, state, eps=0.):
         raise NotImplementedError
 
+    def act_batch(self, states, eps=0., mask=None):
+        raise NotImplementedError
+
     def save(self, filename):
         raise NotImplementedError
 
     def load(self, filename):
         raise NotImplementedError
+
+
+def epsilon_greedy_split(n_agents, eps, mask=None):
+    """
+    Splits the agents that need an action into greedy and exploring ones.
+    :param n_agents: number of agents in the batch
+    :param eps: probability of picking a random action
+    :param mask: optional boolean array, only agents with a True entry need an action
+    :return: (greedy handles, exploring handles)
+    """
+    handles = np.arange(n_agents) if mask is None else np.flatnonzero(mask)
+    explore = np.random.random_sample(len(handles)) <= eps
+    return handles[~explore], handles[explore]
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+
+import numpy as np
+import torch
+
+base_dir = Path(__file__).resolve().parent.parent
+sys.path.append(str(base_dir))
+
+from reinforcement_learning.checkpoint import load_network
+from reinforcement_learning.dddqn_policy import DDDQNPolicy
+from reinforcement_learning.evaluate_agent import SMALL_V0_PARAMS, create_env
+from reinforcement_learning.model import quantize_dynamic_int8
+from utils.observation_utils import normalize_observations
+
+BATCH_SIZES = (1, 80, 128)
+
+
+def record_observations(network, env_params, n_episodes, max_observations):
+    """
+    Runs greedy episodes with the float32 network
+    :return: array with the normalized observations of the agents which had to act, in the order they were seen
+    """
+    env = create_env(env_params)
+    policy = DDDQNPolicy(network.fc1_val.in_features, network.fc4_adv.out_features, Namespace(use_gpu=False), evaluation_mode=True)
+    policy.qnetwork_local = network
+
+    observations = []
+    agent_obs = np.zeros((env_params.n_agents, policy.state_size), dtype=np.float32)
+    for seed in range(1, n_episodes + 1):
+        obs, info = env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=seed)
+        for step in range(env._max_episode_steps - 1):
+            acting_agents = [agent for agent in env.get_agent_handles() if obs[agent] and info['action_required'][agent]]
+            normalize_observations(obs, acting_agents, env_params.observation_tree_depth, observation_radius=env_params.observation_radius, out=agent_obs)
+            observations.append(agent_obs[acting_agents].copy())
+
+            mask = np.zeros(env_params.n_agents, dtype=bool)
+            mask[acting_agents] = True
+            actions = policy.act_batch(agent_obs, eps=0.0, mask=mask)
+            obs, _, done, info = env.step(dict(enumerate(actions.tolist())))
+            if done['__all__']:
+                break
+
+    return np.concatenate(observations)[:max_observations]
+
+
+def q_values(network, observations, batch_size, bf16=False):
+    """
+    :return: Q-values of the observations, computed batch_size at a time like act_batch does
+    """
+    with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=bf16):
+        return np.concatenate([
+            network(torch.from_numpy(observations[start:start + batch_size])).float().numpy()
+            for start in range(0, len(observations), batch_size)
+        ])
+
+
+def median_time(function, n_runs):
+    for _ in range(5):
+        function()
+    times = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def learn_time(network, observations, batch_size, bf16, n_runs):
+    """
+    :return: median time of a DDDQNPolicy._learn update on minibatches of the recorded observations
+    """
+    state_size = observations.shape[1]
+    hidden_size = network.fc1_val.out_features
+    policy = DDDQNPolicy(state_size, network.fc4_adv.out_features, Namespace(
+        hidden_size=hidden_size, buffer_size=len(observations), batch_size=batch_size, update_every=1,
+        learning_rate=0.5e-4, tau=1e-3, gamma=0.99, buffer_min_size=0, use_gpu=False, bf16_learn=bf16
+    ))
+    policy.qnetwork_local.load_state_dict(network.state_dict())
+    policy.qnetwork_target.load_state_dict(network.state_dict())
+    n = len(observations)
+    policy.memory.add_batch(observations, np.random.randint(5, size=n), np.random.normal(size=n), np.roll(observations, 1, axis=0), np.zeros(n))
+    return median_time(policy._learn, n_runs)
+
+
+def precision_report(checkpoint, env_params, observations_file, n_episodes, max_observations, n_runs):
+    network, metadata = load_network(checkpoint)
+    network.eval()
+
+    # Observations are built with the parameters the checkpoint was trained with, when it records them
+    for key in ("observation_tree_depth", "observation_radius", "observation_max_path_depth"):
+        if metadata.get(key) is not None:
+            setattr(env_params, key, metadata[key])
+
+    if observations_file and os.path.isfile(observations_file):
+        observations = np.load(observations_file)
+        print("Loaded {} observations from {}".format(len(observations), observations_file))
+    else:
+        observations = record_observations(network, env_params, n_episodes, max_observations)
+        print("Recorded {} observations over {} episodes".format(len(observations), n_episodes))
+        if observations_file:
+            np.save(observations_file, observations)
+
+    modes = {
+        "fp32": (network, False),
+        "int8": (quantize_dynamic_int8(network), False),
+        "bf16": (network, True),
+    }
+
+    print("\nAccuracy against fp32, greedy actions of the recorded observations:")
+    for batch_size in BATCH_SIZES:
+        reference = q_values(network, observations, batch_size)
+        for mode in ("int8", "bf16"):
+            mode_network, bf16 = modes[mode]
+            values = q_values(mode_network, observations, batch_size, bf16)
+            agreement = np.mean(values.argmax(1) == reference.argmax(1))
+            print("  {}\tbatch {:3d}\tsame action: {:.2f}%\tmax |dQ|: {:.4f}".format(mode, batch_size, 100 * agreement, np.abs(values - reference).max()))
+
+    print("\nInference latency and throughput:")
+    for batch_size in BATCH_SIZES:
+        states = torch.from_numpy(observations[:batch_size])
+        for mode, (mode_network, bf16) in modes.items():
+            def infer():
+                with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=bf16):
+                    mode_network(states)
+            latency = median_time(infer, n_runs)
+            print("  {}\tbatch {:3d}\t{:8.1f} us\t{:10.0f} obs/s".format(mode, batch_size, latency * 1e6, batch_size / latency))
+
+    print("\nUpdate (_learn) latency and throughput:")
+    for batch_size in BATCH_SIZES:
+        for mode, bf16 in (("fp32", False), ("bf16", True)):
+            latency = learn_time(network, observations, batch_size, bf16, n_runs)
+            print("  {}\tbatch {:3d}\t{:8.1f} us\t{:10.0f} experiences/s".format(mode, batch_size, latency * 1e6, batch_size / latency))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compares the int8 and bfloat16 modes of a checkpoint against float32")
+    parser.add_argument("-f", "--file", help="checkpoint to check", required=True, type=str)
+    parser.add_argument("--observations", help=".npy file of recorded observations, recorded and saved to it if it doesn't exist", default=None, type=str)
+    parser.add_argument("-n", "--n_episodes", help="number of episodes the observations are recorded on", default=10, type=int)
+    parser.add_argument("--max_observations", help="maximum number of recorded observations", default=10000, type=int)
+    parser.add_argument("--n_runs", help="number of timed runs per measure", default=200, type=int)
+    parser.add_argument("--num_threads", help="number of threads PyTorch can use, like on the evaluation server", default=1, type=int)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+
+    # Same environment as the small_v0 configuration of evaluate_agent.py
+    env_params = Namespace(**SMALL_V0_PARAMS)
+    precision_report(args.file, env_params, args.observations, args.n_episodes, args.max_observations, args.n_runs)
@@ -1,25 +1,27 @@
+import time
+
+# Startup time is measured from here to the first env_create
+startup_time_start = time.time()
+
 import os
 import sys
 from argparse import Namespace
 from pathlib import Path
 
 import numpy as np
-import time
 
-import torch
 from flatland.core.env_observation_builder import DummyObservationBuilder
-from flatland.envs.observations import GlobalObsForRailEnv, TreeObsForRailEnv
 from flatland.evaluators.client import FlatlandRemoteClient
 from flatland.envs.predictions import ShortestPathPredictorForRailEnv
 from flatland.evaluators.client import TimeoutException
 
-from utils.deadlock_check import check_if_all_blocked
-
 base_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(base_dir))
 
-from reinforcement_learning.dddqn_policy import DDDQNPolicy
-from utils.observation_utils import normalize_observation
+from utils.action_cache import ActionCache
+from utils.deadlock_check import DeadlockDetector
+from utils.observation_utils import normalize_observations, SubsetTreeObsForRailEnv
+from utils.timer import TimerRegistry
 
 ####################################################
 # EVALUATION PARAMETERS
@@ -30,41 +32,96 @@ VERBOSE = False
 # Checkpoint to use (remember to push it!)
 checkpoint = "checkpoints/sample-checkpoint.pth"
 
-# Use last action cache
+# Run the policy with NumPy instead of torch, which isn't imported at all then. The weights are loaded from
+# the checkpoint exported with: python reinforcement_learning/numpy_inference.py -f <checkpoint>
+USE_NUMPY_INFERENCE = False
+numpy_checkpoint = os.path.splitext(checkpoint)[0] + ".npz"
+
+# Run the torch policy with int8 dynamic quantized weights, check the greedy actions still match the float32 ones
+# with: python reinforcement_learning/precision_report.py -f <checkpoint>
+USE_INT8_INFERENCE = False
+
+# Cache the actions of the observations already seen, shared by all agents and episodes
 USE_ACTION_CACHE = True
+ACTION_CACHE_MAX_MEMORY = 256 * 1024 * 1024
+
+# Time allowed from the start of this script to the first env_create, in seconds
+STARTUP_TIME_TARGET = 5.0
 
-# Observation parameters (must match training parameters!)
+# JSON lines file the timers and rates of each episode are appended to, None to only print them
+TIMERS_FILE = None
+
+# Observation parameters, only used if the checkpoint doesn't record the ones it was trained with
 observation_tree_depth = 2  # The number of steps that tree observation is going to follow for each agent
 observation_radius = 10
 observation_max_path_depth = 30
 
 ####################################################
 
+# Creates the policy. No GPU on evaluation server.
+# The checkpoints only hold weights and metadata, torch is only imported to run the torch policy.
+if USE_NUMPY_INFERENCE:
+    from reinforcement_learning.numpy_inference import NumpyPolicy
+
+    policy = NumpyPolicy.from_file(numpy_checkpoint)
+    metadata = policy.metadata
+else:
+    from reinforcement_learning.checkpoint import load_network
+    from reinforcement_learning.dddqn_policy import DDDQNPolicy
+
+    if os.path.isfile(checkpoint):
+        network, metadata = load_network(checkpoint)
+        policy = DDDQNPolicy(metadata["state_size"], metadata["action_size"], Namespace(**{'use_gpu': False}), evaluation_mode=True)
+        policy.qnetwork_local = network
+        if USE_INT8_INFERENCE:
+            policy.quantize()
+    else:
+        print("[WARNING] Checkpoint not found, using untrained policy! (path: {})".format(checkpoint))
+        policy, metadata = None, {}
+
+# Observation parameters the checkpoint was trained with
+observation_tree_depth, observation_radius, observation_max_path_depth = (
+    default if metadata.get(key) is None else metadata[key] for key, default in (
+        ("observation_tree_depth", observation_tree_depth),
+        ("observation_radius", observation_radius),
+        ("observation_max_path_depth", observation_max_path_depth)
+    )
+)
+
 remote_client = FlatlandRemoteClient()
 
 # Observation builder
 predictor = ShortestPathPredictorForRailEnv(observation_max_path_depth)
-tree_observation = TreeObsForRailEnv(max_depth=observation_tree_depth, predictor=predictor)
-global_observation = GlobalObsForRailEnv()
+# Only the agents which require an action are observed, which TreeObsForRailEnv doesn't support
+tree_observation = SubsetTreeObsForRailEnv(max_depth=observation_tree_depth, predictor=predictor)
 
 # Calculates state and action sizes
 n_nodes = sum([np.power(4, i) for i in range(observation_tree_depth + 1)])
 state_size = tree_observation.observation_dim * n_nodes
 action_size = 5
 
-# Creates the policy. No GPU on evaluation server.
-policy = DDDQNPolicy(state_size, action_size, Namespace(**{'use_gpu': False}), evaluation_mode=True)
+if policy is None:
+    policy = DDDQNPolicy(state_size, action_size, Namespace(**{'use_gpu': False}), evaluation_mode=True)
+elif policy.state_size != state_size:
+    raise ValueError("Checkpoint expects observations of size {}, got {}".format(policy.state_size, state_size))
 
-if os.path.isfile(checkpoint):
-    policy.qnetwork_local = torch.load(checkpoint)
-else:
-    print("[WARNING] Checkpoint not found, using untrained policy! (path: {})".format(checkpoint))
+# Action cache: the same normalized observation always gets the same action from a deterministic policy,
+# so the inference only runs for observations which haven't been seen yet
+action_cache = ActionCache(max_memory=ACTION_CACHE_MAX_MEMORY) if USE_ACTION_CACHE else None
+
+startup_time = time.time() - startup_time_start
+print("[INFO] Startup time : {:.3f}s (target {:.1f}s)".format(startup_time, STARTUP_TIME_TARGET))
+if startup_time > STARTUP_TIME_TARGET:
+    print("[WARNING] Startup time is over the target!")
 
 #####################################################################
 # Main evaluation loop
 #####################################################################
 evaluation_number = 0
 
+# Laps and counters of all the episodes
+run_timers = TimerRegistry()
+
 while True:
     evaluation_number += 1
     print("[INFO] EPISODE_START : {}".format(evaluation_number))
@@ -78,6 +135,7 @@ while True:
         obs_builder_object=DummyObservationBuilder()
     )
     env_creation_time = time.time() - time_start
+    run_timers["env_create"].add_lap(env_creation_time)
 
     if not observation:
         # If the remote_client returns False on a `env_create` call,
@@ -95,7 +153,11 @@ while True:
 
     tree_observation.set_env(local_env)
     tree_observation.reset()
-    observation = tree_observation.get_many(list(range(nb_agents)))
+    observation = tree_observation.get_many([agent for agent in range(nb_agents) if info['action_required'][agent]])
+
+    # Deadlocked agents can't move whatever their action, so they get neither observation nor inference
+    deadlock_detector = DeadlockDetector(local_env)
+    deadlocked = deadlock_detector.deadlocked
 
     print("[INFO] Evaluation {}: {} agents in {}x{}".format(evaluation_number, nb_agents, local_env.width, local_env.height))
 
@@ -105,15 +167,15 @@ while True:
     steps = 0
 
     # Bookkeeping
-    time_taken_by_controller = []
-    time_taken_per_step = []
+    timers = TimerRegistry()
+    controller_timer, step_timer, observation_timer = timers["controller"], timers["step"], timers["observation"]
 
-    # Action cache: keep track of last observation to avoid running the same inferrence multiple times.
-    # This only makes sense for deterministic policies.
-    agent_last_obs = {}
-    agent_last_action = {}
     nb_hit = 0
 
+    # Normalized observations of the agents that need an inference, scored in a single batch
+    agent_obs = np.zeros((nb_agents, state_size))
+    needs_inference = np.zeros(nb_agents, dtype=bool)
+
     while True:
         try:
             #####################################################################
@@ -123,55 +185,64 @@ while True:
             obs_time, agent_time, step_time = 0.0, 0.0, 0.0
             no_ops_mode = False
 
-            if not check_if_all_blocked(env=local_env):
-                time_start = time.time()
+            if not deadlock_detector.all_deadlocked():
+                controller_timer.start()
                 action_dict = {}
-                for agent in range(nb_agents):
-                    if observation[agent] and info['action_required'][agent]:
-                        if agent in agent_last_obs and np.all(agent_last_obs[agent] == observation[agent]):
-                            # cache hit
-                            action = agent_last_action[agent]
-                            nb_hit += 1
-                        else:
-                            # otherwise, run normalization and inference
-                            norm_obs = normalize_observation(observation[agent], tree_depth=observation_tree_depth, observation_radius=observation_radius)
-                            action = policy.act(norm_obs, eps=0.0)
-
-                        action_dict[agent] = action
-
-                        if USE_ACTION_CACHE:
-                            agent_last_obs[agent] = observation[agent]
-                            agent_last_action[agent] = action
-                agent_time = time.time() - time_start
-                time_taken_by_controller.append(agent_time)
-
-                time_start = time.time()
+                acting_agents = np.array([
+                    agent for agent in range(nb_agents) if observation.get(agent) and info['action_required'][agent]
+                ], dtype=np.int64)
+                normalize_observations(observation, acting_agents, observation_tree_depth, observation_radius=observation_radius, out=agent_obs)
+
+                needs_inference[:] = False
+                needs_inference[acting_agents] = True
+                if action_cache is not None:
+                    keys, cached_actions = action_cache.lookup(agent_obs[acting_agents])
+                    hit = cached_actions >= 0
+                    action_dict.update(zip(acting_agents[hit].tolist(), cached_actions[hit].tolist()))
+                    needs_inference[acting_agents[hit]] = False
+                    nb_hit += int(np.count_nonzero(hit))
+
+                # Batched inference for the cache misses
+                actions = policy.act_batch(agent_obs, eps=0.0, mask=needs_inference)
+                for agent in np.flatnonzero(needs_inference):
+                    action_dict[int(agent)] = int(actions[agent])
+
+                if action_cache is not None:
+                    action_cache.store([key for key, is_hit in zip(keys, hit) if not is_hit], actions[acting_agents[~hit]])
+                agent_time = controller_timer.end()
+                timers.count("agent_steps", len(acting_agents))
+                timers.count("inferences", np.count_nonzero(needs_inference))
+
+                step_timer.start()
 
                 try:
                     _, all_rewards, done, info = remote_client.env_step(action_dict)
                 except:
                     print("[ERR] DONE BUT step()_1 CALLED")
 
-                step_time = time.time() - time_start
-                time_taken_per_step.append(step_time)
+                step_time = step_timer.end()
+                timers.count("env_steps")
 
-                time_start = time.time()
-                observation = tree_observation.get_many(list(range(nb_agents)))
-                obs_time = time.time() - time_start
+                observation_timer.start()
+                deadlocked = deadlock_detector.update()
+                observation = tree_observation.get_many([
+                    agent for agent in range(nb_agents) if info['action_required'][agent] and agent not in deadlocked
+                ])
+                obs_time = observation_timer.end()
 
             else:
                 # Fully deadlocked: perform no-ops
                 no_ops_mode = True
 
-                time_start = time.time()
+                step_timer.start()
 
                 try:
                     _, all_rewards, done, info = remote_client.env_step({})
                 except:
                     print("[ERR] DONE BUT step()_2 CALLED")                
                 
-                step_time = time.time() - time_start
-                time_taken_per_step.append(step_time)
+                step_time = step_timer.end()
+                timers.count("env_steps")
 
             nb_agents_done = sum(done[idx] for idx in local_env.get_agent_handles())
 
@@ -201,13 +272,18 @@ while True:
             print("[ERR] Timeout! Will skip this episode and go to the next.", err)
             break
 
-    np_time_taken_by_controller = np.array(time_taken_by_controller)
-    np_time_taken_per_step = np.array(time_taken_per_step)
-    print("Mean/Std of Time taken by Controller : ", np_time_taken_by_controller.mean(), np_time_taken_by_controller.std())
-    print("Mean/Std of Time per Step : ", np_time_taken_per_step.mean(), np_time_taken_per_step.std())
+    print("Mean/Std of Time taken by Controller : ", controller_timer.mean(), controller_timer.std())
+    print("Mean/Std of Time per Step : ", step_timer.mean(), step_timer.std())
+    print("[INFO] Timers :\n" + timers.summary())
+    if TIMERS_FILE is not None:
+        timers.write_jsonl(TIMERS_FILE, evaluation_number=evaluation_number, env_path=remote_client.current_env_path)
+    run_timers.merge(timers)
+    if action_cache is not None:
+        print("Action cache : ", action_cache.stats())
     print("=" * 100)
 
 print("Evaluation of all environments complete!")
+print("[INFO] Timers of all the episodes :\n" + run_timers.summary())
 ########################################################################
 # Submit your Results
 #
@@ -0,0 +1,95 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ActionCache:
+    """
+    Bounded LRU cache of the actions chosen by a deterministic policy, keyed by a hash of the normalized observations.
+
+    The cache is shared by all the agents and can be kept across episodes: agents in the same local situation get
+    the same normalized observation, so the action chosen for one of them is reused for the others. Only the 16
+    bytes digest of an observation is kept, never the observation itself.
+
+    The least recently used entries are evicted once the cache holds max_entries entries, or once its estimated
+    memory footprint exceeds max_memory bytes.
+    """
+
+    # Memory footprint of an entry: the digest bytes object and its slot in the ordered dict. Measured with
+    # tracemalloc as the memory allocated by key and store for 1e3 to 1e6 new entries, divided by their number,
+    # which ranges from 135 to 154 bytes depending on how full the dict is after its last resize: the highest is kept
+    ENTRY_SIZE = 154
+
+    def __init__(self, max_entries=1000000, max_memory=None):
+        """
+        :param max_entries: maximum number of cached actions
+        :param max_memory: maximum estimated memory footprint in bytes, unbounded if None
+        """
+        self.capacity = max_entries if max_memory is None else min(max_entries, max_memory // self.ENTRY_SIZE)
+        self._actions = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._actions)
+
+    @staticmethod
+    def key(observation: np.ndarray) -> bytes:
+        """
+        :param observation: normalized observation of an agent
+        :return: digest of the observation bytes
+        """
+        return hashlib.blake2b(np.ascontiguousarray(observation).tobytes(), digest_size=16).digest()
+
+    def lookup(self, observations: np.ndarray):
+        """
+        Looks up the actions of several agents at once
+        :param observations: normalized observations, one row per agent
+        :return: keys of the observations, to store the missing actions with, and array with the cached actions,
+                 -1 for the misses
+        """
+        keys = [self.key(observation) for observation in observations]
+        actions = np.full(len(keys), -1, dtype=np.int64)
+        for i, key in enumerate(keys):
+            action = self._actions.get(key)
+            if action is not None:
+                self._actions.move_to_end(key)
+                actions[i] = action
+        n_hits = int(np.count_nonzero(actions >= 0))
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        return keys, actions
+
+    def store(self, keys, actions):
+        """
+        :param keys: keys returned by lookup
+        :param actions: actions chosen for these keys
+        """
+        for key, action in zip(keys, actions):
+            self._actions[key] = int(action)
+            self._actions.move_to_end(key)
+
+        n_evicted = len(self._actions) - self.capacity
+        for _ in range(max(0, n_evicted)):
+            self._actions.popitem(last=False)
+        self.evictions += max(0, n_evicted)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(1, self.hits + self.misses)
+
+    def stats(self) -> dict:
+        """
+        :return: dict with the counters of the cache
+        """
+        return {
+            "entries": len(self._actions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+            "memory": len(self._actions) * self.ENTRY_SIZE,
+        }
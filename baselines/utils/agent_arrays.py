@@ -0,0 +1,422 @@
+import numpy as np
+from flatland.envs.agent_chains import MotionCheck
+from flatland.envs.rail_env_action import RailEnvActions
+from flatland.envs.step_utils.malfunction_handler import get_number_of_steps_to_break
+from flatland.envs.step_utils.states import TrainState
+
+# Row and column offsets of a move towards each direction (N, E, S, W)
+MOVEMENTS = np.array([(-1, 0), (0, 1), (1, 0), (0, -1)], dtype=np.int64)
+
+OFF_MAP_STATES = (TrainState.WAITING, TrainState.READY_TO_DEPART, TrainState.MALFUNCTION_OFF_MAP)
+ON_MAP_STATES = (TrainState.MOVING, TrainState.STOPPED, TrainState.MALFUNCTION)
+
+# Enum members indexed by value, to rebuild the agent objects
+TRAIN_STATES = list(TrainState)
+ACTIONS = list(RailEnvActions)
+
+# Value of a missing position, saved action or arrival time
+NONE = -1
+
+
+def _position(row):
+    return None if row[0] == NONE else tuple(row)
+
+
+class AgentArrays:
+    """
+    Structure of arrays holding the dynamic state of the agents of a RailEnv, with a step doing the same updates
+    as RailEnv.step on whole arrays.
+
+    RailEnv.step goes through the speed counter, action saver, malfunction handler and state machine of every
+    agent, twice per step. Here each of them is an array with one value per agent, the actions are preprocessed
+    with transition bit masks of the rail grid, the conflicts of MotionCheck are found on arrays of the edges of
+    its graph, and the state machine transitions are applied as masks.
+
+    The arrays are the state of the env while it is stepped: the agent objects are only updated from them, with
+    update_agents, so they stay available to the observation builders and any other reader. They don't get the
+    state transition signals of the step. The malfunctions are still drawn agent by agent, so the random stream,
+    and thus the whole episode, is the same as with RailEnv.step.
+    """
+
+    def __init__(self, env):
+        """
+        Loads the state of the agents of a freshly reset env
+        """
+        agents = env.agents
+        n_agents = len(agents)
+        self.handles = range(n_agents)
+        self.grid = env.rail.grid.astype(np.int64)
+        self.remove_agents_at_target = env.remove_agents_at_target
+
+        def positions(attribute):
+            values = [getattr(agent, attribute) for agent in agents]
+            return np.array([(NONE, NONE) if value is None else value for value in values], dtype=np.int64).reshape(-1, 2)
+
+        # Static properties of the agents
+        self.initial_positions = positions("initial_position")
+        self.initial_directions = np.array([agent.initial_direction for agent in agents], dtype=np.int64)
+        self.targets = positions("target")
+        self.earliest_departures = np.array([agent.earliest_departure for agent in agents], dtype=np.int64)
+        self.speeds = np.array([agent.speed_counter.speed for agent in agents], dtype=np.float64)
+        self.max_counts = np.array([agent.speed_counter.max_count for agent in agents], dtype=np.int64)
+
+        # Dynamic state, as of the last step
+        self.positions = positions("position")
+        self.directions = np.array([agent.direction for agent in agents], dtype=np.int64)
+        self.old_positions = positions("old_position")
+        self.old_directions = np.array([NONE if agent.old_direction is None else agent.old_direction for agent in agents], dtype=np.int64)
+        self.states = np.array([agent.state for agent in agents], dtype=np.int64)
+        self.previous_states = np.array([NONE if agent.state_machine.previous_state is None else agent.state_machine.previous_state for agent in agents], dtype=np.int64)
+        self.speed_counters = np.array([agent.speed_counter.counter for agent in agents], dtype=np.int64)
+        self.malfunction_counters = np.array([agent.malfunction_handler.malfunction_down_counter for agent in agents], dtype=np.int64)
+        self.num_malfunctions = np.array([agent.malfunction_handler.num_malfunctions for agent in agents], dtype=np.int64)
+        self.saved_actions = np.array([NONE if agent.action_saver.saved_action is None else agent.action_saver.saved_action for agent in agents], dtype=np.int64)
+        self.arrival_times = np.array([NONE if agent.arrival_time is None else agent.arrival_time for agent in agents], dtype=np.int64)
+
+        # Values the agent objects were last updated with
+        self._synced = self._state_columns()
+
+        # Moves checked for conflicts by the last step, to rebuild its MotionCheck
+        self.motion_positions = None
+        self.motion_new_positions = None
+
+    def _state_columns(self):
+        return np.column_stack([
+            self.positions, self.directions, self.old_positions, self.old_directions, self.states, self.previous_states,
+            self.speed_counters, self.malfunction_counters, self.num_malfunctions, self.saved_actions, self.arrival_times
+        ])
+
+    def update_agents(self, agents):
+        """
+        Updates the agent objects whose state changed since the last update
+        """
+        columns = self._state_columns()
+        changed = np.flatnonzero((columns != self._synced).any(axis=1))
+        self._synced = columns
+
+        for handle, values in zip(changed.tolist(), columns[changed].tolist()):
+            row, col, direction, old_row, old_col, old_direction, state, previous_state, \
+                speed_counter, malfunction_counter, num_malfunctions, saved_action, arrival_time = values
+            agent = agents[handle]
+            agent.position = _position((row, col))
+            agent.direction = direction
+            agent.old_position = _position((old_row, old_col))
+            agent.old_direction = None if old_direction == NONE else old_direction
+            agent.state_machine._state = TRAIN_STATES[state]
+            agent.state_machine.previous_state = None if previous_state == NONE else TRAIN_STATES[previous_state]
+            agent.speed_counter.counter = speed_counter
+            agent.malfunction_handler._malfunction_down_counter = malfunction_counter
+            agent.malfunction_handler.num_malfunctions = num_malfunctions
+            agent.action_saver.saved_action = None if saved_action == NONE else ACTIONS[saved_action]
+            agent.arrival_time = None if arrival_time == NONE else arrival_time
+
+    def action_required(self) -> np.ndarray:
+        """
+        :return: boolean array, same values as RailEnv.action_required for each agent
+        """
+        states = self.states
+        return (states == TrainState.READY_TO_DEPART) | (np.isin(states, ON_MAP_STATES) & (self.speed_counters == 0))
+
+    def get_info_dict(self):
+        """
+        Same dict as RailEnv.get_info_dict
+        """
+        states = self.states
+        return {
+            'action_required': dict(enumerate(self.action_required().tolist())),
+            'malfunction': dict(enumerate(self.malfunction_counters.tolist())),
+            'speed': dict(enumerate(self.speeds.tolist())),
+            'state': {handle: TRAIN_STATES[state] for handle, state in enumerate(states.tolist())}
+        }
+
+    def update_positions_map(self, agent_positions):
+        """
+        Same update as RailEnv._update_agent_positions_map: each agent which moved writes its handle at its new
+        position then clears its old position, in handle order, so the later writes to a cell win
+        """
+        moved = np.flatnonzero((self.old_positions != self.positions).any(axis=1))
+        cells = np.stack([self.positions[moved], self.old_positions[moved]], axis=1).reshape(-1, 2)
+        values = np.stack([moved, np.full(len(moved), -1)], axis=1).reshape(-1)
+
+        on_map = cells[:, 0] != NONE
+        cells, values = cells[on_map], values[on_map]
+
+        # Last write to each cell
+        _, last = np.unique((cells[:, 0] * self.grid.shape[1] + cells[:, 1])[::-1], return_index=True)
+        last = len(values) - 1 - last
+        agent_positions[cells[last, 0], cells[last, 1]] = values[last]
+
+    def _check_actions(self, actions, positions, directions):
+        """
+        Same as transition_utils.check_action for all the agents
+        :return: new directions, transition validity (1 or 0, NONE if unknown) and transition bits of each agent
+        """
+        cells = self.grid[positions[:, 0], positions[:, 1]]
+        transitions = (cells >> ((3 - directions) * 4)) & 0xF
+        bits = (transitions[:, None] >> (3 - np.arange(4))) & 1
+        num_transitions = bits.sum(axis=1)
+
+        new_directions = directions.copy()
+        valid = np.full(len(actions), NONE, dtype=np.int64)
+
+        turns = np.where(actions == RailEnvActions.MOVE_LEFT, -1, np.where(actions == RailEnvActions.MOVE_RIGHT, 1, 0))
+        new_directions += turns
+        valid[(turns != 0) & (num_transitions <= 1)] = 0
+        new_directions %= 4
+
+        # Only one way to go forward: take it
+        forward = (actions == RailEnvActions.MOVE_FORWARD) & (num_transitions == 1)
+        new_directions[forward] = bits[forward].argmax(axis=1)
+        valid[forward] = 1
+
+        return new_directions, valid, transitions
+
+    def _valid_actions(self, actions, positions, directions):
+        """
+        Same as transition_utils.check_valid_action for all the agents
+        """
+        new_directions, valid, transitions = self._check_actions(actions, positions, directions)
+        new_positions = positions + MOVEMENTS[new_directions]
+
+        height, width = self.grid.shape
+        new_cell_valid = (new_positions[:, 0] >= 0) & (new_positions[:, 0] < height) & \
+                         (new_positions[:, 1] >= 0) & (new_positions[:, 1] < width)
+        new_cell_valid[new_cell_valid] = self.grid[new_positions[new_cell_valid, 0], new_positions[new_cell_valid, 1]] > 0
+
+        unknown = valid == NONE
+        valid[unknown] = (transitions[unknown] >> (3 - new_directions[unknown])) & 1
+
+        return new_cell_valid & (valid == 1)
+
+    def _check_motion(self, positions, new_positions):
+        """
+        Same results as MotionCheck.check_motion after MotionCheck.find_conflicts, for all the agents.
+
+        MotionCheck builds a graph of the cells with an edge from the cell of each agent to the cell it moves to,
+        off map agents having their own dummy cell. Agents departing from the same station share a cell, so a
+        cell can have several edges. The agents of a cell are blocked if it leads to a stopped agent (a self
+        loop), to two cells swapping their agents, or to a cell losing a conflict: when several cells lead to the
+        same cell, only the one whose last agent has the lowest handle wins.
+        """
+        n_agents = len(positions)
+        height, width = self.grid.shape
+        handles = np.arange(n_agents)
+
+        # Cells are numbered with a margin, moves can end one cell outside of the grid
+        def cell_ids(cells):
+            dummy = (height + 2) * (width + 2) + handles
+            return np.where(cells[:, 0] != NONE, (cells[:, 0] + 1) * (width + 2) + cells[:, 1] + 1, dummy)
+
+        nodes, inverse = np.unique(np.concatenate([cell_ids(positions), cell_ids(new_positions)]), return_inverse=True)
+        n_nodes = len(nodes)
+        sources = inverse[:n_agents]
+        edges = np.unique(sources * n_nodes + inverse[n_agents:])
+        edge_sources, edge_targets = np.divmod(edges, n_nodes)
+
+        stops = edge_sources == edge_targets
+        swaps = ~stops & np.isin(edge_targets * n_nodes + edge_sources, edges)
+
+        # Handle of the last agent added to each cell
+        last_agents = np.full(n_nodes, NONE, dtype=np.int64)
+        last_agents[sources] = handles
+        order = np.lexsort((last_agents[edge_sources], edge_targets))
+        losers = order[1:][edge_targets[order[1:]] == edge_targets[order[:-1]]]
+
+        blocked = np.zeros(n_nodes, dtype=bool)
+        blocked[edge_sources[stops | swaps]] = True
+        blocked[edge_sources[losers]] = True
+
+        # Block the cells leading to blocked cells, one more move away at each iteration
+        while True:
+            newly_blocked = edge_sources[blocked[edge_targets] & ~blocked[edge_sources]]
+            if len(newly_blocked) == 0:
+                break
+            blocked[newly_blocked] = True
+
+        return ~blocked[sources]
+
+    def motion_check(self):
+        """
+        :return: MotionCheck of the last step, with its conflicts found, like RailEnv.motionCheck after a step.
+                 Empty before the first step.
+        """
+        motion_check = MotionCheck()
+        if self.motion_positions is not None:
+            for handle, (position, new_position) in enumerate(zip(self.motion_positions.tolist(), self.motion_new_positions.tolist())):
+                motion_check.addAgent(handle, _position(position), _position(new_position))
+            motion_check.find_conflicts()
+        return motion_check
+
+    def step(self, env, action_dict):
+        """
+        Same agent updates as RailEnv.step, without the rewards
+        :return: True if all the agents are done
+        """
+        n_agents = len(self.states)
+        states = self.states.copy()
+        positions = self.positions
+        directions = self.directions
+        saved_actions = self.saved_actions
+        malfunction_counters = self.malfunction_counters
+
+        self.old_positions[:] = positions
+        self.old_directions[:] = directions
+        on_map = positions[:, 0] != NONE
+
+        # Malfunctions are drawn agent by agent to consume the random numbers in the same order as RailEnv.step
+        broken_steps = np.fromiter(
+            (get_number_of_steps_to_break(env.malfunction_generator, env.np_random) for _ in self.handles),
+            dtype=np.int64, count=n_agents
+        )
+        new_malfunctions = (malfunction_counters == 0) & (broken_steps > 0)
+        malfunction_counters[new_malfunctions] = broken_steps[new_malfunctions]
+        self.num_malfunctions += new_malfunctions
+
+        actions = np.zeros(n_agents, dtype=np.int64)
+        for handle, action in action_dict.items():
+            if handle in self.handles and RailEnvActions.is_action_valid(action):
+                actions[handle] = action
+
+        # Preprocess the actions like RailEnv.preprocess_action
+        do_nothing = actions == RailEnvActions.DO_NOTHING
+        actions[do_nothing & (states == TrainState.MOVING)] = RailEnvActions.MOVE_FORWARD
+        use_saved = do_nothing & (states != TrainState.MOVING) & (saved_actions != NONE)
+        actions[use_saved] = saved_actions[use_saved]
+        actions[states == TrainState.WAITING] = RailEnvActions.DO_NOTHING
+
+        current_positions = np.where(on_map[:, None], positions, self.initial_positions)
+        current_directions = np.where(on_map, directions, self.initial_directions)
+
+        turning = (actions == RailEnvActions.MOVE_LEFT) | (actions == RailEnvActions.MOVE_RIGHT)
+        actions[turning & ~self._valid_actions(actions, current_positions, current_directions)] = RailEnvActions.MOVE_FORWARD
+        moving_actions = (actions >= RailEnvActions.MOVE_LEFT) & (actions <= RailEnvActions.MOVE_RIGHT)
+        actions[moving_actions & ~self._valid_actions(actions, current_positions, current_directions)] = RailEnvActions.STOP_MOVING
+        moving_actions &= actions != RailEnvActions.STOP_MOVING
+
+        save = moving_actions & (saved_actions == NONE) & (states != TrainState.DONE)
+        saved_actions[save] = actions[save]
+
+        at_cell_exit = self.speed_counters == self.max_counts
+        position_update_allowed = at_cell_exit & (malfunction_counters == 0) & (actions != RailEnvActions.STOP_MOVING)
+
+        # Moves of the agents regardless of the other agents
+        done = states == TrainState.DONE
+        is_saved = saved_actions != NONE
+        entering = ~done & ~on_map & is_saved
+        advancing = ~done & on_map & is_saved & position_update_allowed
+
+        new_positions = positions.copy()
+        new_directions = directions.copy()
+        new_positions[entering] = self.initial_positions[entering]
+        new_directions[entering] = self.initial_directions[entering]
+
+        advance_directions, _, _ = self._check_actions(saved_actions, current_positions, current_directions)
+        new_directions[advancing] = advance_directions[advancing]
+        new_positions[advancing] = positions[advancing] + MOVEMENTS[advance_directions[advancing]]
+        actions[advancing] = saved_actions[advancing]
+
+        # Transition signals
+        in_malfunction = malfunction_counters > 0
+        self.motion_positions = positions.copy()
+        self.motion_new_positions = new_positions.copy()
+        movement_allowed = self._check_motion(positions, new_positions) & ~in_malfunction
+        movement_allowed |= (states == TrainState.STOPPED) & ~at_cell_exit
+
+        stop_action_given = actions == RailEnvActions.STOP_MOVING
+        valid_movement_action_given = (actions >= RailEnvActions.MOVE_LEFT) & (actions <= RailEnvActions.MOVE_RIGHT) & movement_allowed
+        earliest_departure_reached = env._elapsed_steps >= self.earliest_departures
+        target_reached = on_map & (positions == self.targets).all(axis=1)
+        movement_conflict = ~movement_allowed & at_cell_exit
+
+        # TrainStateMachine transitions
+        moving_or_stopped = np.where(valid_movement_action_given, TrainState.MOVING, TrainState.STOPPED)
+        new_states = np.select(
+            [states == state for state in OFF_MAP_STATES + ON_MAP_STATES],
+            [
+                np.where(in_malfunction, TrainState.MALFUNCTION_OFF_MAP,
+                         np.where(earliest_departure_reached, TrainState.READY_TO_DEPART, TrainState.WAITING)),
+                np.where(in_malfunction, TrainState.MALFUNCTION_OFF_MAP,
+                         np.where(valid_movement_action_given, TrainState.MOVING, TrainState.READY_TO_DEPART)),
+                np.where(in_malfunction, TrainState.MALFUNCTION_OFF_MAP,
+                         np.where(~earliest_departure_reached, TrainState.WAITING,
+                                  np.where(valid_movement_action_given, TrainState.MOVING,
+                                           np.where(stop_action_given, TrainState.STOPPED, TrainState.READY_TO_DEPART)))),
+                np.where(in_malfunction, TrainState.MALFUNCTION,
+                         np.where(target_reached, TrainState.DONE,
+                                  np.where(stop_action_given | movement_conflict, TrainState.STOPPED, TrainState.MOVING))),
+                np.where(in_malfunction, TrainState.MALFUNCTION, moving_or_stopped),
+                np.where(in_malfunction, TrainState.MALFUNCTION, moving_or_stopped),
+            ],
+            default=TrainState.DONE
+        )
+        self.previous_states[:] = states
+        self.states[:] = new_states
+
+        # Position updates
+        movement_allowed &= new_states != TrainState.DONE
+        on_map_state = np.isin(new_states, ON_MAP_STATES)
+        placed = on_map_state & np.isin(states, OFF_MAP_STATES)
+        positions[placed] = self.initial_positions[placed]
+        directions[placed] = self.initial_directions[placed]
+
+        moved = on_map_state & ~placed & movement_allowed & at_cell_exit
+        positions[moved] = new_positions[moved]
+        directions[moved] = new_directions[moved]
+        reached = moved & (positions == self.targets).all(axis=1)
+        self.previous_states[reached] = new_states[reached]
+        self.states[reached] = TrainState.DONE
+
+        # Same check as env_utils.state_position_sync_check
+        on_map = positions[:, 0] != NONE
+        out_of_sync = np.flatnonzero((np.isin(self.states, ON_MAP_STATES) & ~on_map) | (np.isin(self.states, OFF_MAP_STATES) & on_map))
+        if len(out_of_sync) > 0:
+            handle = out_of_sync[0]
+            raise ValueError("Agent ID {} Agent State {} is {} map Agent Position {}".format(
+                handle, str(TRAIN_STATES[self.states[handle]]), "on" if on_map[handle] else "off", _position(positions[handle])))
+
+        done = self.states == TrainState.DONE
+        self.arrival_times[done] = env._elapsed_steps
+        if self.remove_agents_at_target:
+            positions[done] = NONE
+
+        # Counter updates
+        counting = (self.states == TrainState.MOVING) & (self.old_positions[:, 0] != NONE)
+        self.speed_counters[counting] = (self.speed_counters[counting] + 1) % (self.max_counts[counting] + 1)
+        malfunction_counters[malfunction_counters > 0] -= 1
+        saved_actions[(self.speed_counters == 0) & (positions[:, 0] != NONE)] = NONE
+
+        return bool(done.all())
+
+
+def compare_step_engines(env_fn, seed, reward_shaping=True):
+    """
+    Runs the same episode, with random actions, with RailEnv.step and with AgentArrays
+    :param env_fn: function returning a FastRailEnv, called with the vectorized_step argument
+    :return: description of the first difference, None if the episodes are identical
+    """
+    envs = [env_fn(vectorized_step=False), env_fn(vectorized_step=True)]
+    results = [env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=seed) for env in envs]
+    action_random = np.random.RandomState(seed)
+
+    for step in range(envs[0]._max_episode_steps + 1):
+        if results[0] != results[1]:
+            return "step {}: different observations, rewards, dones or infos".format(step)
+
+        agents = [[(agent.position, agent.direction, agent.old_position, agent.state, agent.state_machine.previous_state,
+                    agent.speed_counter.counter, agent.malfunction_handler.to_dict(), agent.action_saver.saved_action,
+                    agent.arrival_time) for agent in env.agents] for env in envs]
+        if agents[0] != agents[1]:
+            handle = next(handle for handle, (a, b) in enumerate(zip(*agents)) if a != b)
+            return "step {}: agent {} differs: {} != {}".format(step, handle, agents[0][handle], agents[1][handle])
+        if not np.array_equal(envs[0].agent_positions, envs[1].agent_positions):
+            return "step {}: different agent positions maps".format(step)
+        if envs[0].motionCheck.svDeadlocked != envs[1].motionCheck.svDeadlocked:
+            return "step {}: different deadlocked cells: {} != {}".format(step, envs[0].motionCheck.svDeadlocked, envs[1].motionCheck.svDeadlocked)
+
+        if envs[0].dones["__all__"]:
+            return None
+
+        actions = dict(enumerate(action_random.randint(0, len(RailEnvActions), size=envs[0].get_num_agents()).tolist()))
+        results = [env.step(actions, reward_shaping=reward_shaping) for env in envs]
+
+    return None
@@ -1,3 +1,4 @@
+import numpy as np
 from flatland.core.grid.grid4_utils import get_new_position
 from flatland.envs.rail_env import RailEnv
 from flatland.envs.step_utils.states import TrainState
@@ -38,3 +39,200 @@ def check_if_all_blocked(env: RailEnv):
 
     # No agent can move at all: full deadlock!
     return True
+
+
+class DeadlockDetector:
+    """
+    Keeps track of the agents which are permanently deadlocked, updated incrementally after each step.
+
+    An agent waits for the agents occupying the cells it could move to next. An agent whose next cells are all
+    occupied by deadlocked agents can never move again, so the deadlocked agents are the largest set of agents all
+    waiting on each other: agents head-on on a single track, agents waiting on each other in a cycle and the agents
+    stuck behind them.
+
+    Cycles of three or more agents are the exception: MotionCheck lets them move when all their agents move at once,
+    so agents on such cycles aren't reported. Agents which haven't departed yet aren't reported either, since an
+    agent whose malfunction ends before departure is placed on its initial cell even if it is occupied.
+
+    The cell occupancy and the wait-for graph are only updated for the agents which moved since the previous update,
+    and only these agents and the agents waiting on the cells they left or entered are looked at. Deadlocked agents
+    never move again, so the set of deadlocked agents only grows until the env is reset.
+    """
+
+    def __init__(self, env: RailEnv):
+        """
+        :param env: env to watch, the detector must be reset after each env reset
+        """
+        self.env = env
+        self.reset()
+
+    def reset(self):
+        n_agents = self.env.get_num_agents()
+
+        self.deadlocked = set()
+
+        # Deadlocked agents and done agents left on the map, which occupy their cell forever
+        self._permanent = set()
+
+        # Agents occupying each cell (several agents can share a cell) and agents waiting on each cell
+        self._occupants = {}
+        self._waiters = {}
+        self._next_cells = [()] * n_agents
+
+        # Last seen position, direction and done flag of each agent, -2 to see every agent as moved on the first update
+        self._positions = np.full((n_agents, 2), -2, dtype=np.int64)
+        self._directions = np.full(n_agents, -2, dtype=np.int64)
+        self._done = np.zeros(n_agents, dtype=bool)
+
+        self.update()
+
+    def update(self) -> set:
+        """
+        Looks at the agents which moved since the previous update
+        :return: set of the handles of the deadlocked agents
+        """
+        positions, directions, done = self._agent_arrays()
+        moved = np.flatnonzero((positions != self._positions).any(axis=1) | (directions != self._directions) | (done != self._done))
+        if len(moved) == 0:
+            return self.deadlocked
+
+        changed_cells = set()
+        for handle in moved.tolist():
+            old_position = tuple(self._positions[handle].tolist())
+            if old_position[0] >= 0:
+                self._occupants[old_position].discard(handle)
+                if not self._occupants[old_position]:
+                    del self._occupants[old_position]
+                changed_cells.add(old_position)
+            for cell in self._next_cells[handle]:
+                self._waiters[cell].discard(handle)
+
+            position = tuple(positions[handle].tolist())
+            if position[0] >= 0:
+                self._occupants.setdefault(position, set()).add(handle)
+                changed_cells.add(position)
+
+            if done[handle]:
+                next_cells = ()
+                if position[0] >= 0:
+                    self._permanent.add(handle)
+            elif position[0] >= 0:
+                next_cells = self._possible_next_cells(position, int(directions[handle]))
+            else:
+                next_cells = (self.env.agents[handle].initial_position,)
+
+            self._next_cells[handle] = next_cells
+            for cell in next_cells:
+                self._waiters.setdefault(cell, set()).add(handle)
+
+        self._positions[:] = positions
+        self._directions[:] = directions
+        self._done[:] = done
+
+        affected = set(moved.tolist())
+        for cell in changed_cells:
+            affected.update(self._waiters.get(cell, ()))
+        self._find_deadlocks(affected - self._permanent)
+
+        return self.deadlocked
+
+    def all_deadlocked(self) -> bool:
+        """
+        Checks whether all the agents which aren't done are deadlocked or waiting to depart from a cell occupied by
+        a deadlocked agent, in which case only the end of a malfunction before departure can make an agent move
+        :return: True if no agent can move anymore
+        """
+        on_map = self._positions[:, 0] >= 0
+        if len(self.deadlocked) == 0 or len(self.deadlocked) != np.count_nonzero(on_map & ~self._done):
+            return False
+
+        for handle in np.flatnonzero(~on_map & ~self._done).tolist():
+            initial_position = self._next_cells[handle][0]
+            if not any(occupant in self._permanent for occupant in self._occupants.get(initial_position, ())):
+                return False
+        return True
+
+    def _agent_arrays(self):
+        agent_arrays = getattr(self.env, "agent_arrays", None)
+        if agent_arrays is not None:
+            return agent_arrays.positions, agent_arrays.directions, agent_arrays.states == TrainState.DONE
+
+        agents = self.env.agents
+        positions = np.array([(-1, -1) if agent.position is None else agent.position for agent in agents], dtype=np.int64).reshape(-1, 2)
+        directions = np.array([agent.direction for agent in agents], dtype=np.int64)
+        done = np.array([agent.state == TrainState.DONE for agent in agents], dtype=bool)
+        return positions, directions, done
+
+    def _possible_next_cells(self, position, direction):
+        possible_transitions = self.env.rail.get_transitions(*position, direction)
+        return tuple(
+            get_new_position(position, branch_direction)
+            for branch_direction in range(4) if possible_transitions[branch_direction]
+        )
+
+    def _is_blocked(self, handle):
+        next_cells = self._next_cells[handle]
+        return len(next_cells) > 0 and all(cell in self._occupants for cell in next_cells)
+
+    def _successors(self, handle):
+        return [occupant for cell in self._next_cells[handle] for occupant in self._occupants[cell]]
+
+    def _find_deadlocks(self, affected):
+        # A new deadlock contains an affected agent, and every other agent of it either waits on that agent through
+        # other agents of the deadlock or is waited on by it, so the candidates are the blocked agents connected to
+        # the affected agents in either direction
+        candidates = {handle for handle in affected if self._positions[handle, 0] >= 0 and self._is_blocked(handle)}
+        stack = list(candidates)
+        while stack:
+            handle = stack.pop()
+            for successor in self._successors(handle):
+                if successor not in candidates and successor not in self._permanent and self._is_blocked(successor):
+                    candidates.add(successor)
+                    stack.append(successor)
+        stack = list(candidates)
+        while stack:
+            position = tuple(self._positions[stack.pop()].tolist())
+            for waiter in self._waiters.get(position, ()):
+                if waiter not in candidates and waiter not in self._permanent and self._positions[waiter, 0] >= 0 and self._is_blocked(waiter):
+                    candidates.add(waiter)
+                    stack.append(waiter)
+
+        # Drops the candidates with a next cell which may be freed until only the deadlocked ones are left
+        stuck = candidates
+        while True:
+            free = {
+                handle for handle in stuck
+                if not all(
+                    any(occupant in stuck or occupant in self._permanent for occupant in self._occupants[cell])
+                    for cell in self._next_cells[handle]
+                )
+            }
+            if not free:
+                break
+            stuck = stuck - free
+
+        stuck -= {handle for handle in stuck if self._on_long_cycle(handle, stuck)}
+        self.deadlocked |= stuck
+        self._permanent |= stuck
+
+    def _on_long_cycle(self, handle, agents):
+        """
+        :return: True if the agent could move along a cycle of three or more cells occupied by the given agents
+        """
+        start = tuple(self._positions[handle].tolist())
+        for first in self._next_cells[handle]:
+            # Looks for a path of two or more moves from the next cell back to the agent cell
+            visited = {start, first}
+            stack = [first]
+            while stack:
+                cell = stack.pop()
+                for other in self._occupants.get(cell, ()):
+                    if other not in agents:
+                        continue
+                    for next_cell in self._next_cells[other]:
+                        if next_cell == start and cell != first:
+                            return True
+                        if next_cell not in visited:
+                            visited.add(next_cell)
+                            stack.append(next_cell)
+        return False
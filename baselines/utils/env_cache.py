@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import pickle
+import random
+
+import numpy as np
+from flatland.core.grid.rail_env_grid import RailEnvTransitions
+from flatland.core.transition_map import GridTransitionMap
+from flatland.envs.agent_utils import EnvAgent
+from flatland.envs.timetable_utils import Line
+
+
+def config_hash(config) -> str:
+    """
+    :param config: JSON serializable dict with the parameters the envs are generated from
+    :return: short stable hash of the config
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class EnvCache:
+    """
+    On-disk cache of generated envs, one compressed .npz file per seed.
+
+    A file holds everything a regenerating reset produces: the rail grid, the line (agent positions, directions,
+    targets and speeds), the timetable, the distance map and the random states right after generation. Restoring
+    it gives exactly the env a reset with the same seed would have generated, including the malfunctions and
+    the other random draws made while stepping it.
+
+    The files are stored in a subdirectory named after the hash of the config, so the config has to identify
+    the generators: envs built from the same config with different generator settings must not share a cache.
+    """
+
+    def __init__(self, directory, config, seeds=()):
+        """
+        :param directory: root directory of the cache
+        :param config: dict with the parameters the envs are generated from, eg one of the Test_* dicts
+        :param seeds: seeds cycled through by next_seed
+        """
+        self.directory = os.path.join(directory, config_hash(config))
+        self.seeds = list(seeds)
+        self._cursor = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        config_file = os.path.join(self.directory, "config.json")
+        if not os.path.exists(config_file):
+            with open(config_file, "w") as f:
+                json.dump(config, f, sort_keys=True, indent=4)
+
+    def path(self, seed) -> str:
+        return os.path.join(self.directory, "{}.npz".format(seed))
+
+    def __contains__(self, seed) -> bool:
+        return os.path.exists(self.path(seed))
+
+    def next_seed(self) -> int:
+        """
+        :return: the next seed of the cycle
+        """
+        seed = self.seeds[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self.seeds)
+        return seed
+
+    def generate(self, env, seeds=None):
+        """
+        Generates and saves the missing envs of the given seeds (all the seeds of the cache by default)
+        :param env: FastRailEnv using this cache
+        """
+        assert env.env_cache is self, "The env must use this cache"
+        for seed in self.seeds if seeds is None else seeds:
+            if seed not in self:
+                env.reset(regenerate_rail=True, regenerate_schedule=True, random_seed=seed)
+
+    def save(self, env, seed):
+        """
+        Saves an env, which must have just been generated with the given seed
+        """
+        agents = env.agents
+        arrays = {
+            "grid": env.rail.grid,
+            "agent_positions": np.array([agent.initial_position for agent in agents], dtype=np.int64).reshape(-1, 2),
+            "agent_directions": np.array([agent.initial_direction for agent in agents], dtype=np.int64),
+            "agent_targets": np.array([agent.target for agent in agents], dtype=np.int64).reshape(-1, 2),
+            "agent_speeds": np.array([agent.speed_counter.speed for agent in agents], dtype=np.float64),
+            "earliest_departures": np.array([agent.earliest_departure for agent in agents], dtype=np.int64),
+            "latest_arrivals": np.array([agent.latest_arrival for agent in agents], dtype=np.int64),
+            "max_episode_steps": np.array(env._max_episode_steps, dtype=np.int64),
+            # Distances are whole numbers of cells or inf, float32 stores them exactly
+            "distance_map": env.distance_map.get().astype(np.float32),
+            "np_random_state": np.frombuffer(pickle.dumps(env.np_random.get_state()), dtype=np.uint8),
+            "random_state": np.frombuffer(pickle.dumps(random.getstate()), dtype=np.uint8),
+        }
+
+        # Written to a temporary file first so concurrent readers never see a partial file
+        tmp_path = "{}.{}.tmp".format(self.path(seed), os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, self.path(seed))
+
+    def restore(self, env, seed) -> bool:
+        """
+        Replaces the rail, agents, timetable and distance map of the env with the cached ones, the env then only
+        needs a reset without regeneration
+        :return: False if the seed isn't cached
+        """
+        if seed not in self:
+            return False
+
+        with np.load(self.path(seed)) as data:
+            grid = data["grid"]
+            height, width = grid.shape
+            rail = GridTransitionMap(width=width, height=height, transitions=RailEnvTransitions())
+            rail.grid = grid
+
+            env.rail = rail
+            env.height, env.width = height, width
+            env.obs_builder.set_env(env)
+
+            env.agents = EnvAgent.from_line(Line(
+                agent_positions=[tuple(position) for position in data["agent_positions"].tolist()],
+                agent_directions=data["agent_directions"].tolist(),
+                agent_targets=[tuple(target) for target in data["agent_targets"].tolist()],
+                agent_speeds=data["agent_speeds"].tolist()
+            ))
+            for agent, earliest_departure, latest_arrival in zip(env.agents, data["earliest_departures"].tolist(), data["latest_arrivals"].tolist()):
+                agent.earliest_departure = earliest_departure
+                agent.latest_arrival = latest_arrival
+            env._max_episode_steps = int(data["max_episode_steps"])
+
+            # A loaded distance map is only kept by DistanceMap.get() if it has no previous computation
+            env.distance_map.reset(env.agents, env.rail)
+            env.distance_map.set(data["distance_map"].astype(np.float64))
+            env.distance_map.agents_previous_computation = None
+
+            env._seed(seed)
+            env.np_random.set_state(pickle.loads(data["np_random_state"].tobytes()))
+            random.setstate(pickle.loads(data["random_state"].tobytes()))
+
+        return True
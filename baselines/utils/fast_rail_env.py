@@ -0,0 +1,244 @@
+import numpy as np
+from flatland.envs.rail_env import RailEnv
+
+from utils.agent_arrays import AgentArrays, OFF_MAP_STATES, ON_MAP_STATES
+
+
+class FastRailEnv(RailEnv):
+    """
+    RailEnv computing its shaped rewards from direct distance map lookups.
+
+    RailEnv.update_step_rewards calls EnvAgent.get_travel_time_on_shortest_path for every agent at every step,
+    which traces the whole shortest path through the distance map. The length of that path is known without
+    tracing it: it is the distance map value at the agent position plus one (the path includes both ends).
+
+    With an env cache, regenerating resets restore the env of the next seed from the cache instead of generating
+    it, and the envs which aren't cached yet are saved once generated.
+
+    With vectorized_step, the agents are stepped by AgentArrays instead of RailEnv.step, with the same results.
+    The motionCheck of the last step is only rebuilt from the agent arrays when it is read.
+
+    With partial_observations, reset and step only compute the observations of the agents in observation_handles,
+    or of the agents which require an action if it is None, and the other agents get None. The observation builder
+    must give the same observations whichever agents are observed, which TreeObsForRailEnv doesn't: use
+    SubsetTreeObsForRailEnv instead.
+
+    The rewards and dones of the last step are also kept in the step_rewards and agent_dones arrays, which are
+    allocated on reset and updated in place, so callers don't need to rebuild them from the dicts.
+    """
+
+    def __init__(self, *args, env_cache=None, vectorized_step=False, partial_observations=False, **kwargs):
+        self.env_cache = env_cache
+        self.vectorized_step = vectorized_step
+        self.agent_arrays = None
+        # MotionCheck of the last step, rebuilt from the agent arrays on first access with vectorized_step
+        self._motion_check = None
+
+        self.partial_observations = partial_observations
+        # Handles of the agents observed in partial observation mode, the agents which require an action if None
+        self.observation_handles = None
+
+        # True while step() defers the shaped rewards to a single vectorized update
+        self._batch_step_rewards = False
+        self.step_rewards = np.zeros(0, dtype=np.int64)
+        self.agent_dones = np.zeros(0, dtype=bool)
+
+        super().__init__(*args, **kwargs)
+
+    def reset(self, regenerate_rail: bool = True, regenerate_schedule: bool = True, *, random_seed: int = None):
+        self.agent_arrays = None
+        cached_seed = None
+        if self.env_cache is not None and regenerate_rail and regenerate_schedule and (random_seed is not None or self.env_cache.seeds):
+            seed = self.env_cache.next_seed() if random_seed is None else random_seed
+            if self.env_cache.restore(self, seed):
+                regenerate_rail = regenerate_schedule = False
+            else:
+                cached_seed = seed
+                self._seed(seed)
+                # Force the distance map to be computed, a restored one would otherwise be kept
+                self.distance_map.distance_map = None
+            random_seed = None
+
+        observations, info = super().reset(regenerate_rail, regenerate_schedule, random_seed=random_seed)
+
+        if cached_seed is not None:
+            self.env_cache.save(self, cached_seed)
+
+        n_agents = self.get_num_agents()
+        reward_dtype = np.result_type(np.int64, self.cancellation_factor, self.cancellation_time_buffer)
+        if len(self.step_rewards) != n_agents or self.step_rewards.dtype != reward_dtype:
+            self.step_rewards = np.zeros(n_agents, dtype=reward_dtype)
+            self.agent_dones = np.zeros(n_agents, dtype=bool)
+        self.step_rewards.fill(0)
+        self.agent_dones.fill(False)
+
+        if self.vectorized_step:
+            self.agent_arrays = AgentArrays(self)
+
+        return observations, info
+
+    @property
+    def motionCheck(self):
+        if self._motion_check is None and self.agent_arrays is not None:
+            self._motion_check = self.agent_arrays.motion_check()
+        return self._motion_check
+
+    @motionCheck.setter
+    def motionCheck(self, motion_check):
+        self._motion_check = motion_check
+
+    def clear_rewards_dict(self):
+        """ Reset the rewards dictionary """
+        super().clear_rewards_dict()
+        self.step_rewards.fill(0)
+
+    def get_agent_states(self) -> np.ndarray:
+        """
+        :return: integer array with the TrainState of each agent
+        """
+        return np.fromiter((agent.state for agent in self.agents), dtype=np.int64, count=len(self.agents))
+
+    def get_travel_times_on_shortest_path(self, handles=None) -> np.ndarray:
+        """
+        Same values as EnvAgent.get_travel_time_on_shortest_path, for several agents at once
+        :param handles: agents to look up, all agents if None
+        :return: integer array with the travel time of each agent
+        """
+        agents = self.agents if handles is None else [self.agents[handle] for handle in handles]
+
+        # The shortest path starts from the initial position before departure and from the target once done
+        positions = [
+            agent.position if agent.state.is_on_map_state() else
+            agent.initial_position if agent.state.is_off_map_state() else
+            agent.target
+            for agent in agents
+        ]
+        rows, cols = np.array(positions, dtype=np.int64).reshape(-1, 2).T
+        agent_handles = np.array([agent.handle for agent in agents], dtype=np.int64)
+        directions = np.array([agent.direction for agent in agents], dtype=np.int64)
+        speeds = np.array([agent.speed_counter.speed for agent in agents], dtype=np.float64)
+        at_target = np.array([position == agent.target for position, agent in zip(positions, agents)], dtype=bool)
+
+        distances = self.distance_map.get()[agent_handles, rows, cols, directions]
+
+        # Number of waypoints of the shortest path, 0 if the target can't be reached
+        path_lengths = np.where(at_target, 1, np.where(np.isinf(distances), 0, distances + 1))
+
+        for agent, path_length in zip(agents, path_lengths):
+            if agent.initial_shortest_path is None and path_length > 0:
+                agent.initial_shortest_path = int(path_length)
+
+        return np.ceil(path_lengths / speeds).astype(np.int64)
+
+    def update_step_rewards(self, i_agent: int):
+        """
+        Update the rewards dict for agent id i_agent for every timestep
+        """
+        # Inside step() the rewards of all agents are set at once by end_of_episode_update
+        if not self._batch_step_rewards:
+            self.step_rewards[i_agent] = -self.get_travel_times_on_shortest_path([i_agent])[0]
+            self.rewards_dict[i_agent] = self.step_rewards[i_agent].item()
+
+    def end_of_episode_update(self, have_all_agents_ended, reward_shaping=False):
+        """
+        Same updates as RailEnv.end_of_episode_update, with the end rewards of all agents computed in one pass
+        """
+        episode_ended = have_all_agents_ended or \
+            ((self._max_episode_steps is not None) and (self._elapsed_steps >= self._max_episode_steps))
+
+        if not (self._batch_step_rewards or episode_ended):
+            return
+
+        # A single lookup serves both the shaped step rewards and the end of episode penalties
+        travel_times = self.get_travel_times_on_shortest_path()
+
+        if self._batch_step_rewards:
+            np.negative(travel_times, out=self.step_rewards)
+
+        if episode_ended:
+            states = self.get_agent_states()
+            off_map = np.isin(states, OFF_MAP_STATES)
+            on_map = np.isin(states, ON_MAP_STATES)
+
+            # Unfinished agents are penalized by their remaining travel time, agents which never departed are
+            # penalized more. With reward shaping, the remaining travel time is already the step reward.
+            end_rewards = np.zeros_like(self.step_rewards)
+            end_rewards[off_map] = -self.cancellation_factor * (travel_times[off_map] + self.cancellation_time_buffer)
+            if reward_shaping:
+                # Agents whose end reward is 0, done agents included, get a reward of 1 for this step
+                self.step_rewards[~on_map & (end_rewards == 0)] = 1
+            else:
+                end_rewards[on_map] = -travel_times[on_map]
+            self.step_rewards += end_rewards
+
+            if have_all_agents_ended and reward_shaping:
+                self.step_rewards *= 2
+
+            self.agent_dones.fill(True)
+            self.dones.update(dict.fromkeys(range(len(self.agents)), True))
+            self.dones["__all__"] = True
+
+        self.rewards_dict.update(enumerate(self.step_rewards.tolist()))
+
+    def get_action_required(self) -> np.ndarray:
+        """
+        :return: boolean array, True for the agents which require an action
+        """
+        if self.agent_arrays is not None:
+            return self.agent_arrays.action_required()
+        return np.fromiter((self.action_required(agent) for agent in self.agents), dtype=bool, count=len(self.agents))
+
+    def _get_observations(self):
+        if not self.partial_observations:
+            return super()._get_observations()
+
+        handles = self.observation_handles
+        if handles is None:
+            handles = np.flatnonzero(self.get_action_required()).tolist()
+
+        self.obs_dict = dict.fromkeys(range(self.get_num_agents()))
+        self.obs_dict.update(self.obs_builder.get_many(list(handles)))
+        return self.obs_dict
+
+    def get_info_dict(self):
+        if self.agent_arrays is not None:
+            return self.agent_arrays.get_info_dict()
+        return super().get_info_dict()
+
+    def step(self, action_dict_, reward_shaping=False):
+        if self.agent_arrays is not None:
+            return self._step_agent_arrays(action_dict_, reward_shaping)
+
+        # The shaped reward of an agent only depends on its own state once it has been updated, so the rewards
+        # can be computed for all agents after the update loop, which always ends with end_of_episode_update
+        self._batch_step_rewards = reward_shaping
+        try:
+            return super().step(action_dict_, reward_shaping=reward_shaping)
+        finally:
+            self._batch_step_rewards = False
+
+    def _step_agent_arrays(self, action_dict_, reward_shaping):
+        """
+        Same step as RailEnv.step, with the agents updated by AgentArrays
+        """
+        self._elapsed_steps += 1
+
+        # Not allowed to step further once done
+        if self.dones["__all__"]:
+            raise Exception("Episode is done, cannot call step()")
+
+        self.clear_rewards_dict()
+
+        have_all_agents_ended = self.agent_arrays.step(self, action_dict_)
+        self._motion_check = None
+        self.agent_arrays.update_agents(self.agents)
+
+        self._batch_step_rewards = reward_shaping
+        try:
+            self.end_of_episode_update(have_all_agents_ended, reward_shaping=reward_shaping)
+        finally:
+            self._batch_step_rewards = False
+
+        self.agent_arrays.update_positions_map(self.agent_positions)
+
+        return self._get_observations(), self.rewards_dict, self.dones, self.get_info_dict()
@@ -1,6 +1,30 @@
 import numpy as np
 from flatland.envs.observations import TreeObsForRailEnv
 
+# Features of a tree node, in the order they appear in the normalized observation
+NODE_DATA_FEATURES = (
+    "dist_own_target_encountered",
+    "dist_other_target_encountered",
+    "dist_other_agent_encountered",
+    "dist_potential_conflict",
+    "dist_unusable_switch",
+    "dist_to_next_branch",
+)
+NODE_DISTANCE_FEATURES = (
+    "dist_min_to_target",
+)
+NODE_AGENT_DATA_FEATURES = (
+    "num_agents_same_direction",
+    "num_agents_opposite_direction",
+    "num_agents_malfunctioning",
+    "speed_min_fractional",
+)
+NODE_FEATURES = NODE_DATA_FEATURES + NODE_DISTANCE_FEATURES + NODE_AGENT_DATA_FEATURES
+
+# Reusable (n_agents, n_nodes, n_features) buffers, keyed by shape
+_node_features_buffers = {}
+
+
 def max_lt(seq, val):
     """
     Return greatest item in seq for which item < val applies.
@@ -37,88 +61,174 @@ def norm_obs_clip(obs, clip_min=-1, clip_max=1, fixed_radius=0, normalize_to_ran
     :param clip_max: max value where observation will be clipped
     :return: returnes normalized and clipped observatoin
     """
+    return norm_obs_clip_batch(np.array(obs)[np.newaxis], clip_min, clip_max, fixed_radius, normalize_to_range)[0]
+
+
+def norm_obs_clip_batch(obs, clip_min=-1, clip_max=1, fixed_radius=0, normalize_to_range=False, out=None):
+    """
+    Same as norm_obs_clip applied to each row of obs, with masked reductions instead of max_lt/min_gt.
+    :param obs: 2d array, one observation per row
+    :param out: optional array receiving the result
+    :return: normalized and clipped observations
+    """
     if fixed_radius > 0:
-        max_obs = fixed_radius
+        max_obs = np.full((len(obs), 1), fixed_radius)
     else:
-        max_obs = max(1, max_lt(obs, 1000)) + 1
+        # max_lt(obs, 1000)
+        max_obs = np.max(np.where((obs >= 0) & (obs < 1000), obs, 0), axis=1, keepdims=True)
+        max_obs = np.maximum(1, max_obs) + 1
 
-    min_obs = 0  # min(max_obs, min_gt(obs, 0))
+    min_obs = np.zeros((len(obs), 1))  # min(max_obs, min_gt(obs, 0))
     if normalize_to_range:
-        min_obs = min_gt(obs, 0)
-    if min_obs > max_obs:
-        min_obs = max_obs
-    if max_obs == min_obs:
-        return np.clip(np.array(obs) / max_obs, clip_min, clip_max)
-    norm = np.abs(max_obs - min_obs)
-    return np.clip((np.array(obs) - min_obs) / norm, clip_min, clip_max)
-
-
-def _split_node_into_feature_groups(node) -> (np.ndarray, np.ndarray, np.ndarray):
-    data = np.zeros(6)
-    distance = np.zeros(1)
-    agent_data = np.zeros(4)
-
-    data[0] = node.dist_own_target_encountered
-    data[1] = node.dist_other_target_encountered
-    data[2] = node.dist_other_agent_encountered
-    data[3] = node.dist_potential_conflict
-    data[4] = node.dist_unusable_switch
-    data[5] = node.dist_to_next_branch
-
-    distance[0] = node.dist_min_to_target
-
-    agent_data[0] = node.num_agents_same_direction
-    agent_data[1] = node.num_agents_opposite_direction
-    agent_data[2] = node.num_agents_malfunctioning
-    agent_data[3] = node.speed_min_fractional
-
-    return data, distance, agent_data
+        # min_gt(obs, 0)
+        min_obs = np.min(np.where(obs >= 0, obs, np.inf), axis=1, keepdims=True)
+    min_obs = np.minimum(min_obs, max_obs)
 
+    # Observations are only shifted and scaled by max_obs when min_obs == max_obs
+    same = max_obs == min_obs
+    min_obs = np.where(same, 0, min_obs)
+    norm = np.where(same, max_obs, np.abs(max_obs - min_obs))
 
-def _split_subtree_into_feature_groups(node, current_tree_depth: int, max_tree_depth: int) -> (np.ndarray, np.ndarray, np.ndarray):
-    if node == -np.inf:
-        remaining_depth = max_tree_depth - current_tree_depth
-        # reference: https://stackoverflow.com/questions/515214/total-number-of-nodes-in-a-tree-data-structure
-        num_remaining_nodes = int((4 ** (remaining_depth + 1) - 1) / (4 - 1))
-        return [-np.inf] * num_remaining_nodes * 6, [-np.inf] * num_remaining_nodes, [-np.inf] * num_remaining_nodes * 4
+    out = np.subtract(obs, min_obs, out=out)
+    np.divide(out, norm, out=out)
+    return np.clip(out, clip_min, clip_max, out=out)
 
-    data, distance, agent_data = _split_node_into_feature_groups(node)
 
-    if not node.childs:
-        return data, distance, agent_data
+def _tree_layout(max_tree_depth: int):
+    """
+    Nodes are laid out in depth-first order, children in TreeObsForRailEnv.tree_explored_actions_char order.
+    Returns the number of nodes and, for each depth, the number of nodes of a subtree rooted at that depth.
+    """
+    # reference: https://stackoverflow.com/questions/515214/total-number-of-nodes-in-a-tree-data-structure
+    subtree_sizes = [(4 ** (max_tree_depth - depth + 1) - 1) // (4 - 1) for depth in range(max_tree_depth + 2)]
+    return subtree_sizes[0], subtree_sizes
 
-    for direction in TreeObsForRailEnv.tree_explored_actions_char:
-        sub_data, sub_distance, sub_agent_data = _split_subtree_into_feature_groups(node.childs[direction], current_tree_depth + 1, max_tree_depth)
-        data = np.concatenate((data, sub_data))
-        distance = np.concatenate((distance, sub_distance))
-        agent_data = np.concatenate((agent_data, sub_agent_data))
 
-    return data, distance, agent_data
+def _fill_node_features(tree, max_tree_depth: int, node_features: np.ndarray):
+    """
+    Writes the features of every node of the tree in its row of node_features (n_nodes, len(NODE_FEATURES)).
+    Rows of missing subtrees are left untouched, so they should be set to -np.inf beforehand.
+    """
+    _, subtree_sizes = _tree_layout(max_tree_depth)
+
+    nodes = [(tree, 0, 0)]
+    while nodes:
+        node, index, depth = nodes.pop()
+        node_features[index] = (
+            node.dist_own_target_encountered,
+            node.dist_other_target_encountered,
+            node.dist_other_agent_encountered,
+            node.dist_potential_conflict,
+            node.dist_unusable_switch,
+            node.dist_to_next_branch,
+            node.dist_min_to_target,
+            node.num_agents_same_direction,
+            node.num_agents_opposite_direction,
+            node.num_agents_malfunctioning,
+            node.speed_min_fractional,
+        )
+
+        if not node.childs:
+            continue
+
+        for i, direction in enumerate(TreeObsForRailEnv.tree_explored_actions_char):
+            child = node.childs[direction]
+            if child != -np.inf:
+                nodes.append((child, index + 1 + i * subtree_sizes[depth + 1], depth + 1))
+
+
+def _get_node_features_buffer(n_agents: int, n_nodes: int):
+    shape = (n_agents, n_nodes, len(NODE_FEATURES))
+    if shape not in _node_features_buffers:
+        _node_features_buffers[shape] = np.empty(shape)
+    return _node_features_buffers[shape]
 
 
 def split_tree_into_feature_groups(tree, max_tree_depth: int) -> (np.ndarray, np.ndarray, np.ndarray):
     """
     This function splits the tree into three difference arrays of values
     """
-    data, distance, agent_data = _split_node_into_feature_groups(tree)
+    n_nodes, _ = _tree_layout(max_tree_depth)
+    node_features = np.full((n_nodes, len(NODE_FEATURES)), -np.inf)
+    _fill_node_features(tree, max_tree_depth, node_features)
+
+    n_data, n_distance = len(NODE_DATA_FEATURES), len(NODE_DISTANCE_FEATURES)
+    data = node_features[:, :n_data].ravel()
+    distance = node_features[:, n_data:n_data + n_distance].ravel()
+    agent_data = node_features[:, n_data + n_distance:].ravel()
+    return data, distance, agent_data
 
-    for direction in TreeObsForRailEnv.tree_explored_actions_char:
-        sub_data, sub_distance, sub_agent_data = _split_subtree_into_feature_groups(tree.childs[direction], 1, max_tree_depth)
-        data = np.concatenate((data, sub_data))
-        distance = np.concatenate((distance, sub_distance))
-        agent_data = np.concatenate((agent_data, sub_agent_data))
 
-    return data, distance, agent_data
+def normalize_observations(observations, handles, tree_depth: int, observation_radius=0, out=None):
+    """
+    This function normalizes the observations of several agents at once
+    :param observations: tree observations indexed by agent handle, as returned by the env
+    :param handles: handles of the agents to normalize
+    :param out: optional array indexed by handle, in which case the rows of the given handles are overwritten
+    :return: normalized observations, one row per handle (or out if given)
+    """
+    handles = list(handles)
+    n_nodes, _ = _tree_layout(tree_depth)
+    if not handles:
+        return np.zeros((0, n_nodes * len(NODE_FEATURES))) if out is None else out
+
+    node_features = _get_node_features_buffer(len(handles), n_nodes)
+    node_features.fill(-np.inf)
+    for i, handle in enumerate(handles):
+        _fill_node_features(observations[handle], tree_depth, node_features[i])
+
+    n_data, n_distance = len(NODE_DATA_FEATURES), len(NODE_DISTANCE_FEATURES)
+    data = node_features[:, :, :n_data].reshape(len(handles), -1)
+    distance = node_features[:, :, n_data:n_data + n_distance].reshape(len(handles), -1)
+    agent_data = node_features[:, :, n_data + n_distance:].reshape(len(handles), -1)
+
+    # Same feature order as the original concatenation: data, distance, agent_data
+    normalized_obs = np.empty((len(handles), n_nodes * len(NODE_FEATURES)))
+    data_end = data.shape[1]
+    distance_end = data_end + distance.shape[1]
+    norm_obs_clip_batch(data, fixed_radius=observation_radius, out=normalized_obs[:, :data_end])
+    norm_obs_clip_batch(distance, normalize_to_range=True, out=normalized_obs[:, data_end:distance_end])
+    np.clip(agent_data, -1, 1, out=normalized_obs[:, distance_end:])
+
+    if out is None:
+        return normalized_obs
+    out[handles] = normalized_obs
+    return out
 
 
 def normalize_observation(observation, tree_depth: int, observation_radius=0):
     """
     This function normalizes the observation used by the RL algorithm
     """
-    data, distance, agent_data = split_tree_into_feature_groups(observation, tree_depth)
+    return normalize_observations([observation], [0], tree_depth, observation_radius)[0]
+
+
+class SubsetTreeObsForRailEnv(TreeObsForRailEnv):
+    """
+    TreeObsForRailEnv which gives the same observations whichever subset of the agents is observed.
+
+    TreeObsForRailEnv.get_many only collects the predicted positions of the agents it is asked to observe, while the
+    tree search looks them up by handle, so observing a subset of the agents shifts the predicted positions of the
+    others and corrupts the conflict features. Here the predictions are always collected for all the agents, and
+    only the tree search is restricted to the observed agents.
+    """
 
-    data = norm_obs_clip(data, fixed_radius=observation_radius)
-    distance = norm_obs_clip(distance, normalize_to_range=True)
-    agent_data = np.clip(agent_data, -1, 1)
-    normalized_obs = np.concatenate((np.concatenate((data, distance)), agent_data))
-    return normalized_obs
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._observed = None
+
+    def get_many(self, handles=None):
+        if handles is None:
+            handles = []
+
+        self._observed = set(handles)
+        try:
+            observations = super().get_many(self.env.get_agent_handles())
+        finally:
+            self._observed = None
+        return {handle: observations[handle] for handle in handles}
+
+    def get(self, handle: int = 0):
+        if self._observed is not None and handle not in self._observed:
+            return None
+        return super().get(handle)
@@ -1,3 +1,6 @@
+import json
+import math
+from functools import wraps
 from timeit import default_timer
 
 
@@ -5,20 +8,63 @@ class Timer(object):
     """
     Utility to measure times.
 
-    TODO:
-    - add "lap" method to make it easier to measure average time (+std) when measuring the same thing multiple times.
+    Each start/end pair is a lap. Besides the total time, the laps are counted and their durations binned in a
+    fixed size histogram of log spaced bins, so percentiles are estimated within about 5% whatever the number of laps.
+
+    A timer is also a context manager (with timer: ...) and a decorator (@timer.timed).
     """
 
+    # Bin i of the histogram holds the laps from MIN_LAP * BIN_RATIO ** i to MIN_LAP * BIN_RATIO ** (i + 1),
+    # the first and last bins also hold the shorter and longer laps: 1us to about 11h
+    MIN_LAP = 1e-6
+    BIN_RATIO = 1.1
+    N_BINS = 256
+    _LOG_MIN_LAP = math.log(MIN_LAP)
+    _LOG_BIN_RATIO = math.log(BIN_RATIO)
+
     def __init__(self):
         self.total_time = 0.0
         self.start_time = 0.0
         self.end_time = 0.0
 
+        self.count = 0
+        self.total_squares = 0.0
+        self.max_lap = 0.0
+        self.bins = [0] * self.N_BINS
+
     def start(self):
         self.start_time = default_timer()
 
     def end(self):
-        self.total_time += default_timer() - self.start_time
+        """
+        Ends a lap
+        :return: duration of the lap
+        """
+        self.end_time = default_timer()
+        lap = self.end_time - self.start_time
+        self.add_lap(lap)
+        return lap
+
+    def lap(self):
+        """
+        Ends a lap and starts the next one
+        :return: duration of the lap
+        """
+        lap = self.end()
+        self.start_time = self.end_time
+        return lap
+
+    def add_lap(self, lap):
+        """
+        Records a lap measured elsewhere
+        """
+        self.total_time += lap
+        self.count += 1
+        self.total_squares += lap * lap
+        if lap > self.max_lap:
+            self.max_lap = lap
+        index = int((math.log(lap) - self._LOG_MIN_LAP) / self._LOG_BIN_RATIO) if lap > self.MIN_LAP else 0
+        self.bins[index if index < self.N_BINS else self.N_BINS - 1] += 1
 
     def get(self):
         return self.total_time
@@ -26,8 +72,172 @@ class Timer(object):
     def get_current(self):
         return default_timer() - self.start_time
 
+    def mean(self):
+        return self.total_time / max(1, self.count)
+
+    def std(self):
+        return math.sqrt(max(0.0, self.total_squares / max(1, self.count) - self.mean() ** 2))
+
+    def percentile(self, q):
+        """
+        :param q: percentile, between 0 and 100
+        :return: estimated lap duration below which q% of the laps are, 0 if there is no lap
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.bins):
+            seen += count
+            if seen >= rank and count > 0:
+                # Geometric middle of the bin, never more than the longest lap
+                return min(self.MIN_LAP * self.BIN_RATIO ** (index + 0.5), self.max_lap)
+        return self.max_lap
+
+    def stats(self):
+        """
+        :return: dict with the total, number of laps, mean, std, p50, p95, p99 and max lap durations
+        """
+        return {
+            "total": self.total_time,
+            "count": self.count,
+            "mean": self.mean(),
+            "std": self.std(),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max_lap,
+        }
+
+    def merge(self, other):
+        """
+        Adds the laps of another timer, eg measured in another process
+        """
+        self.total_time += other.total_time
+        self.count += other.count
+        self.total_squares += other.total_squares
+        self.max_lap = max(self.max_lap, other.max_lap)
+        self.bins = [count + other_count for count, other_count in zip(self.bins, other.bins)]
+
+    def timed(self, function):
+        """
+        Decorator timing each call of a function as a lap
+        """
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with self:
+                return function(*args, **kwargs)
+        return timed_function
+
     def reset(self):
         self.__init__()
 
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end()
+
     def __repr__(self):
-        return self.get()
\ No newline at end of file
+        return "Timer(total={:.6f}, count={})".format(self.total_time, self.count)
+
+
+class TimerRegistry(object):
+    """
+    Named timers and counters of a run, exported along with the rates derived from the counters.
+
+    The counters count the work done (env_steps, agent_steps, inferences, learn_steps...), their rates are per second
+    of wall time since the registry was created or reset, so resetting after each export gives the rates of each
+    interval.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.start_time = default_timer()
+
+    def __getitem__(self, name):
+        """
+        :return: timer called name, created on first use
+        """
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        return timer
+
+    def timed(self, name):
+        """
+        Decorator timing each call of a function with the timer called name
+        """
+        return self[name].timed
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def elapsed(self):
+        return default_timer() - self.start_time
+
+    def rates(self):
+        """
+        :return: dict with the rate of each counter, eg env_steps_per_second
+        """
+        elapsed = max(self.elapsed(), 1e-9)
+        return {name + "_per_second": count / elapsed for name, count in self.counters.items()}
+
+    def stats(self):
+        """
+        :return: dict with the elapsed time, the stats of each timer, the counters and their rates
+        """
+        return {
+            "elapsed": self.elapsed(),
+            "timers": {name: timer.stats() for name, timer in self.timers.items()},
+            "counters": dict(self.counters),
+            "rates": self.rates(),
+        }
+
+    def merge(self, other):
+        """
+        Adds the laps and counts of another registry, eg of an episode run in another process. The elapsed time
+        stays the one of this registry, so the rates are the overall ones.
+        """
+        for name, timer in other.timers.items():
+            self[name].merge(timer)
+        for name, count in other.counters.items():
+            self.count(name, count)
+
+    def summary(self):
+        """
+        :return: printable lines with the timers and the rates
+        """
+        lines = [
+            "{}: {:.3f}s in {} laps, mean {:.3f}ms p50 {:.3f}ms p95 {:.3f}ms p99 {:.3f}ms".format(
+                name, timer.total_time, timer.count, 1e3 * timer.mean(), 1e3 * timer.percentile(50),
+                1e3 * timer.percentile(95), 1e3 * timer.percentile(99))
+            for name, timer in self.timers.items()
+        ]
+        lines.extend("{}: {:.1f}".format(name, rate) for name, rate in self.rates().items())
+        return "\n".join(lines)
+
+    def write_tensorboard(self, writer, step, prefix="timer/", rates_prefix="throughput/"):
+        """
+        Logs the total of each timer as prefix + name, its percentiles as prefix + name + "_p50"... and the rates
+        :param writer: SummaryWriter
+        """
+        for name, timer in self.timers.items():
+            writer.add_scalar(prefix + name, timer.total_time, step)
+            for q in (50, 95, 99):
+                writer.add_scalar("{}{}_p{}".format(prefix, name, q), timer.percentile(q), step)
+        for name, rate in self.rates().items():
+            writer.add_scalar(rates_prefix + name, rate, step)
+
+    def write_jsonl(self, filename, **fields):
+        """
+        Appends the stats as a JSON line
+        :param fields: values added to the line, eg the episode index
+        """
+        with open(filename, "a") as f:
+            f.write(json.dumps(dict(fields, **self.stats())) + "\n")
+
+    def reset(self):
+        self.__init__()
@@ -0,0 +1,236 @@
+import multiprocessing
+import traceback
+
+import numpy as np
+
+from utils.observation_utils import normalize_observations
+from utils.timer import Timer
+
+
+def _shared_array(shape, dtype):
+    """
+    Allocates a zeroed array in shared memory
+    :return: the raw shared buffer, which can be passed to worker processes, and a NumPy view of it
+    """
+    dtype = np.dtype(dtype)
+    raw = multiprocessing.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return raw, _as_array(raw, shape, dtype)
+
+
+def _as_array(raw, shape, dtype):
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+class VecRailEnv:
+    """
+    Runs several rail envs in worker processes, which step them in parallel.
+
+    Each worker writes the normalized observations, rewards, dones and action required masks of its env into
+    shared memory arrays with one row per env, so a step only sends a short command through a pipe: the actions
+    are read from shared memory and no observation or reward dict is ever pickled.
+
+    Observation rows are only overwritten for the agents which got an observation, like normalize_observations
+    does with its out parameter.
+    """
+
+    FIELDS = ("observations", "rewards", "dones", "action_required", "actions", "dones_all")
+
+    def __init__(self, env_fn, num_envs, n_agents, state_size, tree_depth, observation_radius=0, reward_shaping=True):
+        """
+        :param env_fn: picklable function called with the index of a worker, which returns the env it runs
+        :param num_envs: number of envs, each one runs in its own process
+        :param n_agents: number of agents of each env
+        :param state_size: size of a normalized observation
+        :param reward_shaping: passed to every env step
+        """
+        self.num_envs = num_envs
+        self.n_agents = n_agents
+        self.state_size = state_size
+
+        shapes = {
+            "observations": ((num_envs, n_agents, state_size), np.float32),
+            "rewards": ((num_envs, n_agents), np.float64),
+            "dones": ((num_envs, n_agents), bool),
+            "action_required": ((num_envs, n_agents), bool),
+            "actions": ((num_envs, n_agents), np.int64),
+            "dones_all": ((num_envs,), bool),
+        }
+        buffers = {}
+        for field in self.FIELDS:
+            shape, dtype = shapes[field]
+            buffers[field], array = _shared_array(shape, dtype)
+            setattr(self, field, array)
+
+        # Envs currently stepping, see step_async
+        self._stepping = np.zeros(num_envs, dtype=bool)
+
+        self._pipes = []
+        self._processes = []
+        self.closed = False
+        for index in range(num_envs):
+            parent_pipe, worker_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_worker,
+                args=(index, env_fn, worker_pipe, parent_pipe, buffers, shapes, tree_depth, observation_radius, reward_shaping),
+                daemon=True
+            )
+            process.start()
+            worker_pipe.close()
+            self._pipes.append(parent_pipe)
+            self._processes.append(process)
+
+        # Wait for all the envs to be created
+        self._receive_all()
+
+    def reset(self):
+        """
+        Resets all the envs, regenerating their rail and schedule
+        :return: the max number of steps of each env
+        """
+        self._send_all("reset")
+        return np.array(self._receive_all())
+
+    def step_async(self, actions, envs=None):
+        """
+        Starts stepping the envs, without waiting for them
+        :param actions: array of shape (num_envs, n_agents)
+        :param envs: boolean mask of the envs to step, all of them if None. The other envs keep their last results.
+        """
+        envs = np.ones(self.num_envs, dtype=bool) if envs is None else np.asarray(envs, dtype=bool)
+        self.actions[envs] = actions[envs]
+        self._stepping[:] = envs
+        for index in np.flatnonzero(envs):
+            self._pipes[index].send(("step", None))
+
+    def step_wait(self):
+        """
+        Waits for the envs started by step_async, their results are then in the shared arrays
+        """
+        for index in np.flatnonzero(self._stepping):
+            self._receive(index)
+        self._stepping[:] = False
+
+    def step(self, actions, envs=None):
+        self.step_async(actions, envs)
+        self.step_wait()
+
+    def get_timers(self):
+        """
+        Collects and resets the reset/step/preproc times measured in each worker
+        :return: dict with the times of all the workers in an array
+        """
+        self._send_all("timers")
+        times = self._receive_all()
+        return {name: np.array([worker_times[name] for worker_times in times]) for name in times[0]}
+
+    def render(self, index=0, close=False):
+        """
+        Renders (or closes the rendering window of) one of the envs, from its worker process
+        """
+        self._pipes[index].send(("render", close))
+        self._receive(index)
+
+    def close(self):
+        if self.closed:
+            return
+        self.step_wait()
+        self._send_all("close")
+        for process in self._processes:
+            process.join()
+        self.closed = True
+
+    def _send_all(self, command):
+        for pipe in self._pipes:
+            pipe.send((command, None))
+
+    def _receive(self, index):
+        result = self._pipes[index].recv()
+        if isinstance(result, Exception):
+            # The other workers may be waiting for a command, they can't be closed gracefully
+            for process in self._processes:
+                process.terminate()
+            self.closed = True
+            raise result
+        return result
+
+    def _receive_all(self):
+        return [self._receive(index) for index in range(self.num_envs)]
+
+
+def _worker(index, env_fn, pipe, parent_pipe, buffers, shapes, tree_depth, observation_radius, reward_shaping):
+    parent_pipe.close()
+
+    arrays = {field: _as_array(buffers[field], *shapes[field]) for field in buffers}
+    observations = arrays["observations"][index]
+    rewards = arrays["rewards"][index]
+    dones = arrays["dones"][index]
+    action_required = arrays["action_required"][index]
+    actions = arrays["actions"][index]
+    dones_all = arrays["dones_all"]
+
+    timers = {"reset": Timer(), "step": Timer(), "preproc": Timer()}
+    env_renderer = None
+
+    def write_results(obs, info):
+        timers["preproc"].start()
+        handles = env.get_agent_handles()
+        observed = [handle for handle in handles if obs[handle]]
+        normalize_observations(obs, observed, tree_depth, observation_radius=observation_radius, out=observations)
+        action_required[:] = [info['action_required'][handle] for handle in handles]
+        timers["preproc"].end()
+
+    try:
+        env = env_fn(index)
+        pipe.send(None)
+
+        while True:
+            command, data = pipe.recv()
+
+            if command == "reset":
+                timers["reset"].start()
+                obs, info = env.reset(regenerate_rail=True, regenerate_schedule=True)
+                timers["reset"].end()
+                if env_renderer is not None:
+                    env_renderer.set_new_rail()
+                rewards.fill(0)
+                dones.fill(False)
+                dones_all[index] = False
+                write_results(obs, info)
+                pipe.send(env._max_episode_steps)
+
+            elif command == "step":
+                timers["step"].start()
+                obs, _, done, info = env.step(dict(enumerate(actions.tolist())), reward_shaping=reward_shaping)
+                timers["step"].end()
+                rewards[:] = env.step_rewards
+                dones[:] = env.agent_dones
+                dones_all[index] = done["__all__"]
+                write_results(obs, info)
+                pipe.send(None)
+
+            elif command == "timers":
+                pipe.send({name: timer.get() for name, timer in timers.items()})
+                for timer in timers.values():
+                    timer.reset()
+
+            elif command == "render":
+                if data:
+                    if env_renderer is not None:
+                        env_renderer.close_window()
+                else:
+                    if env_renderer is None:
+                        from flatland.utils.rendertools import RenderTool
+                        env_renderer = RenderTool(env, gl="PGL")
+                        env_renderer.set_new_rail()
+                    env_renderer.render_env(show=True, frames=False, show_observations=False, show_predictions=False)
+                pipe.send(None)
+
+            elif command == "close":
+                break
+
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        pipe.send(RuntimeError("Env worker {} failed:\n{}".format(index, traceback.format_exc())))
+    finally:
+        pipe.close()